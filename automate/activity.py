@@ -0,0 +1,77 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from celery import shared_task
+from django.conf import settings
+
+from automate.choices import ActivitySinkChoices
+from automate.models import ProjectActivities
+from repo.utils import logger
+
+# Activities logged inside buffered_activities, None outside of it
+_buffer = ContextVar("activity_buffer", default=None)
+
+
+def write_activities(records):
+    """Insert activity records in a single query."""
+    ProjectActivities.objects.bulk_create(
+        [ProjectActivities(**record) for record in records]
+    )
+
+
+@shared_task(ignore_result=True)
+def store_activities(records):
+    """Write a batch of activities sent through the broker."""
+    write_activities(records)
+
+
+def flush_activities(records):
+    """Hand activity records to the configured ACTIVITY_SINK."""
+    if not records:
+        return
+    if settings.ACTIVITY_SINK == ActivitySinkChoices.QUEUE:
+        try:
+            store_activities.delay(records)
+            return
+        except Exception:  # pylint: disable=broad-except
+            # Activities are not worth losing to a broker that is down
+            logger.warning("Could not queue activities", exc_info=True)
+    write_activities(records)
+
+
+def log_activity(user, activity, project, status=None):
+    """Log activity function.
+
+    Inside buffered_activities the activity is written when the block
+    exits, along with the others.
+    """
+    record = {
+        "user_id": user.id,
+        "project_id": project.id,
+        "action": str(activity),
+        "status": bool(status),
+    }
+    buffer = _buffer.get()
+    if buffer is None:
+        flush_activities([record])
+    else:
+        buffer.append(record)
+
+
+@contextmanager
+def buffered_activities():
+    """Buffer the activities logged inside the block and flush them at once
+    when it exits.
+
+    Nested blocks add to the outermost buffer.
+    """
+    if _buffer.get() is not None:
+        yield
+        return
+    buffer = []
+    token = _buffer.set(buffer)
+    try:
+        yield
+    finally:
+        _buffer.reset(token)
+        flush_activities(buffer)
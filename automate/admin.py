@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import History, Project, ProjectActivities
+from .models import History, Project, ProjectActivities, SyncedComment, WebhookEvent
 
 
 class ProjectAdmin(admin.ModelAdmin):
@@ -17,3 +17,5 @@ class ProjectAdmin(admin.ModelAdmin):
 admin.site.register(Project, ProjectAdmin)
 admin.site.register(History)
 admin.site.register(ProjectActivities)
+admin.site.register(SyncedComment)
+admin.site.register(WebhookEvent)
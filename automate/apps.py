@@ -6,3 +6,8 @@ class AutomateConfig(AppConfig):
 
     default_auto_field = "django.db.models.BigAutoField"
     name = "automate"
+
+    def ready(self):
+        """Connect the signal receivers."""
+        # pylint: disable=import-outside-toplevel,unused-import
+        from automate import signals  # noqa: F401
@@ -6,3 +6,27 @@ class RepoTypeChoices(models.TextChoices):
 
     GITHUB = "github", "Github"
     BITBUCKET = "bitbucket", "Bitbucket"
+
+
+class ReplicationModeChoices(models.TextChoices):
+    """How the primary repository is fetched before pushing to the
+    secondary."""
+
+    MIRROR = "mirror", "Mirror"
+    REFS = "refs", "Refs only"
+
+
+class WebhookEventStatusChoices(models.TextChoices):
+    """Progress of a webhook delivery through the inbox."""
+
+    PENDING = "pending", "Pending"
+    CLAIMED = "claimed", "Claimed"
+    PROCESSED = "processed", "Processed"
+    FAILED = "failed", "Failed"
+
+
+class ActivitySinkChoices(models.TextChoices):
+    """Where buffered project activities are written."""
+
+    DATABASE = "database", "Database"
+    QUEUE = "queue", "Queue"
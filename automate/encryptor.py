@@ -1,4 +1,7 @@
 import base64
+import threading
+import time
+from collections import OrderedDict
 
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
@@ -12,24 +15,86 @@ info = b"django-fernet-fields"
 # We need reproducible key derivation, so we can't use a random salt
 salt = b"django-fernet-fields-hkdf-salt"
 
+_fernets = {}
+_fernets_lock = threading.Lock()
+
+
+def derive_fernet_key(key):
+    """Salt key for fernet."""
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=info,
+        backend=backend,
+    )
+    return base64.urlsafe_b64encode(hkdf.derive(force_bytes(key)))
+
+
+def fernet_for(key):
+    """Return the process wide Fernet of a key, deriving it only once."""
+    with _fernets_lock:
+        if key not in _fernets:
+            _fernets[key] = Fernet(derive_fernet_key(key))
+        return _fernets[key]
+
+
+class SecretCache:
+    """LRU of decrypted secrets keyed by their ciphertext.
+
+    Entries expire ``timeout`` seconds after they are stored. Secrets
+    only ever live in this process' memory.
+    """
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ciphertext):
+        """Return the cached plaintext of a ciphertext, if any."""
+        with self._lock:
+            entry = self._entries.get(ciphertext)
+            if entry is None:
+                return None
+            plaintext, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[ciphertext]
+                return None
+            self._entries.move_to_end(ciphertext)
+            return plaintext
+
+    def set(self, ciphertext, plaintext):
+        """Store the plaintext of a ciphertext, evicting the least recently
+        used entries past the size limit."""
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[ciphertext] = (plaintext, time.monotonic() + self.timeout)
+            self._entries.move_to_end(ciphertext)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Forget every cached secret."""
+        with self._lock:
+            self._entries.clear()
+
 
 class Crypt:
-    """Encryptor class for encrypting and decrypting."""
-
-    def __init__(self):
-        self.key = settings.SECRET_KEY
-        self.fernet = Fernet(self.derive_fernet_key(self.key))
-
-    def derive_fernet_key(self, key):
-        """Salt key for fernet."""
-        hkdf = HKDF(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            info=info,
-            backend=backend,
+    """Encryptor class for encrypting and decrypting.
+
+    Use the shared ``crypt`` instance, it caches the secrets it
+    decrypts.
+    """
+
+    def __init__(self, key=None):
+        self.key = key or settings.SECRET_KEY
+        self.fernet = fernet_for(self.key)
+        self.secrets = SecretCache(
+            settings.CREDENTIAL_CACHE_SIZE, settings.CREDENTIAL_CACHE_TIMEOUT
         )
-        return base64.urlsafe_b64encode(hkdf.derive(force_bytes(key)))
 
     def encrypt(self, message):
         """This function encrypts the message."""
@@ -42,11 +107,25 @@ class Crypt:
     def decrypt(self, encrypted_message):
         """This function decrypts the function."""
         if encrypted_message:
-            encrypted_message_bytes = encrypted_message.encode()
-            decrypted_message = self.fernet.decrypt(encrypted_message_bytes)
-            return decrypted_message.decode()
+            decrypted_message = self.secrets.get(encrypted_message)
+            if decrypted_message is None:
+                encrypted_message_bytes = encrypted_message.encode()
+                decrypted_message = self.fernet.decrypt(
+                    encrypted_message_bytes
+                ).decode()
+                self.secrets.set(encrypted_message, decrypted_message)
+            return decrypted_message
         return None
 
+    def multi_encrypt(self, messages: dict):
+        """This method returns the encrypted versions of information sent to it
+        in a dictionary."""
+        for key, value in messages.items():
+            if value:
+                messages[key] = self.encrypt(value)
+
+        return messages
+
     def multi_decrypt(self, messages: dict):
         """This method returns the decrypted versions of information sent to it
         in a dictionary."""
@@ -55,3 +134,6 @@ class Crypt:
                 messages[key] = self.decrypt(value)
 
         return messages
+
+
+crypt = Crypt()
@@ -1,6 +1,13 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F, IntegerField
+from django.db.models.functions import Cast
 from django_filters.rest_framework import FilterSet
+from rest_framework import filters
 
 from automate.models import Project
+from repo.pagination import CreatedCursorPagination
 
 
 class RepositoryFilter(FilterSet):
@@ -26,3 +33,42 @@ class RepositoryFilter(FilterSet):
             "secondary_repo_type",
             "secondary_repo_project_name",
         ]
+
+
+class ProjectSearchFilter(filters.SearchFilter):
+    """Full-text search of projects by name, slug, repo owners and repo names.
+
+    Every term matches words starting with it, e.g. "repo auto" matches
+    the "repo-automator" project. Matches are looked up on the
+    project_search index and ordered by rank, best first.
+    """
+
+    # Ranks are scaled to integers so cursors compare them exactly
+    rank_scale = 1_000_000
+    ordering = ("-search_rank",) + CreatedCursorPagination.ordering
+
+    def get_search_query(self, request):
+        """Return the prefix query of the search terms, if any."""
+        words = re.findall(r"\w+", " ".join(self.get_search_terms(request)))
+        if not words:
+            return None
+        return SearchQuery(
+            " & ".join(f"{word}:*" for word in words),
+            config="simple",
+            search_type="raw",
+        )
+
+    def filter_queryset(self, request, queryset, view):
+        query = self.get_search_query(request)
+        if query is None:
+            return queryset
+        rank = SearchRank(F("search_vector"), query) * self.rank_scale
+        return queryset.filter(search_vector=query).annotate(
+            search_rank=Cast(rank, IntegerField())
+        )
+
+    def get_ordering(self, request, queryset, view):
+        """Order searches by rank, other lists as the ordering filter does."""
+        if self.get_search_query(request) is not None:
+            return self.ordering
+        return filters.OrderingFilter().get_ordering(request, queryset, view)
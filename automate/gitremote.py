@@ -1,14 +1,38 @@
 import tempfile
 
-import requests
-from git import Repo
+from django.conf import settings
+from git import GitCommandError, Repo
 
-from automate.choices import RepoTypeChoices
-from automate.encryptor import Crypt
+from automate.activity import log_activity
+from automate.choices import ReplicationModeChoices, RepoTypeChoices
+from automate.encryptor import crypt
+from automate.metrics import ReplicationMetrics, run_git
+from automate.mirrors import mirrors
 from automate.models import History, Project
-from automate.utils import log_activity, refresh_bitbucket_token
+from automate.utils import get_bitbucket_access_token
+from repo.utils import MakeRequest
 
-crypt = Crypt()
+
+def authenticated_url(url, repo_type, user, token):
+    """Return the repository url with credentials embedded for git."""
+    if repo_type == RepoTypeChoices.GITHUB:
+        return url.replace("https://", f"https://oauth2:{token}@")
+    if repo_type == RepoTypeChoices.BITBUCKET:
+        return url.replace(f"https://{user}", f"https://{user}:{token}")
+    return ""
+
+
+def warm_mirror(project):
+    """Create or refresh the mirror of a project's primary repository."""
+    clone_from = authenticated_url(
+        project.primary_repo_url,
+        project.primary_repo_type,
+        project.primary_repo_owner,
+        crypt.decrypt(project.primary_repo_token),
+    )
+    with mirrors.lock(project.id):
+        mirrors.sync(project.id, clone_from)
+    mirrors.evict(keep=project.id)
 
 
 class GitRemote:
@@ -37,55 +61,91 @@ class GitRemote:
         self.pr_url = data["pull_request"]["url"]
         self.project = instance
         self.repository = None
+        self.metrics = ReplicationMetrics(instance)
 
-    def clone(self, temp_dir):
-        """This function clones the primary repository into a temporary
-        folder."""
-        clone_from = ""
+    def clone(self):
+        """This function brings the project's mirror of the primary repository
+        up to date, cloning it on first use."""
+        clone_from = authenticated_url(
+            self.primary_url, self.primary_type, self.primary_user, self.primary_access
+        )
+        self.repository = mirrors.sync(
+            self.project.id, clone_from, progress=self.metrics.received
+        )
 
-        if self.primary_type == RepoTypeChoices.GITHUB:
-            clone_from = self.primary_url.replace(
-                "https://", f"https://oauth2:{self.primary_access}@"
-            )
-        elif self.primary_type == RepoTypeChoices.BITBUCKET:
-            clone_from = self.primary_url.replace(
-                f"https://{self.primary_user}",
-                f"https://{self.primary_user}:{self.primary_access}",
-            )
+    def fetch_ref(self, temp_dir):
+        """This function fetches only the PR branch into a bare repository,
+        without a working tree.
 
-        self.repository = Repo.clone_from(clone_from, temp_dir)
+        Blob filtering and a history depth limit are applied when
+        configured, to keep the transfer as small as possible.
+        """
+        clone_from = authenticated_url(
+            self.primary_url, self.primary_type, self.primary_user, self.primary_access
+        )
+        self.repository = Repo.init(temp_dir, bare=True)
+        self.repository.create_remote("origin", clone_from)
+
+        options = {"no_tags": True}
+        if settings.GIT_FETCH_FILTER:
+            options["filter"] = settings.GIT_FETCH_FILTER
+        if settings.GIT_FETCH_DEPTH:
+            options["depth"] = settings.GIT_FETCH_DEPTH
+        refspec = f"+refs/heads/{self.branch_name}:refs/heads/{self.branch_name}"
+        run_git(
+            self.repository,
+            "fetch",
+            "origin",
+            refspec,
+            progress=self.metrics.received,
+            **options,
+        )
 
     def checkout(self):
-        """This function checkouts to the new branch."""
-        self.repository.git.checkout(self.branch_name)
+        """This function ensures the PR branch was fetched."""
+        self.repository.git.rev_parse("--verify", f"refs/heads/{self.branch_name}")
 
     def push(self):
-        """This function pushes the code to the secondary url."""
-        push_to = ""
-
-        if self.secondary_type == RepoTypeChoices.GITHUB:
-            push_to = self.secondary_url.replace(
-                "https://", f"https://oauth2:{self.secondary_access}@"
-            )
-
-        elif self.secondary_type == RepoTypeChoices.BITBUCKET:
-            # Due to bitbucket expiring token, we would always refresh bitbucket token here
+        """This function pushes the PR branch to the secondary url."""
+        if self.secondary_type == RepoTypeChoices.BITBUCKET:
+            # Due to bitbucket expiring token, we would always get a fresh bitbucket token here
             credentials = {
                 "refresh_token": self.project.secondary_refresh_token,
                 "client_id": self.project.secondary_client_id,
                 "client_secret": self.project.secondary_client_secret,
             }
             credentials = crypt.multi_decrypt(credentials)
-            self.secondary_access = refresh_bitbucket_token(credentials)
+            self.secondary_access = get_bitbucket_access_token(credentials)
 
-            push_to = self.secondary_url.replace(
-                f"https://{self.secondary_user}",
-                f"https://{self.secondary_user}:{self.secondary_access}",
+        push_to = authenticated_url(
+            self.secondary_url,
+            self.secondary_type,
+            self.secondary_user,
+            self.secondary_access,
+        )
+        # Push by url rather than a named remote so the token never lands in the mirror's config
+        refspec = f"refs/heads/{self.branch_name}:refs/heads/{self.branch_name}"
+        try:
+            run_git(
+                self.repository, "push", push_to, refspec, progress=self.metrics.sent
+            )
+        except GitCommandError:
+            if self.repository.git.rev_parse("--is-shallow-repository") != "true":
+                raise
+            # The secondary doesn't have the history a shallow push relies on, send all of it.
+            # Only the PR branch's history is fetched, not every branch of the origin
+            run_git(
+                self.repository,
+                "fetch",
+                "origin",
+                f"+{refspec}",
+                unshallow=True,
+                no_tags=True,
+                progress=self.metrics.received,
+            )
+            run_git(
+                self.repository, "push", push_to, refspec, progress=self.metrics.sent
             )
-
-        self.repository.create_remote(self.secondary_repo, push_to)
-        secondary = self.repository.remote(self.secondary_repo)
-        secondary.push()
 
     def populate_history(self, content, project):
         """This function populates the history of PRs."""
@@ -145,13 +205,16 @@ class GitRemote:
             }
             api_url = f"https://api.bitbucket.org/2.0/repositories/{self.secondary_user}/{self.secondary_repo}/pullrequests"
 
-        response = requests.post(api_url, headers=headers, json=data, timeout=30)
+        response = MakeRequest(api_url, headers, raise_errors=True).post(
+            data, json=True
+        )
         status = response.status_code
         status_ = False
         project = Project.objects.get(id=self.project.id)
         if status == 201:
             status_ = True
-            self.populate_history(response.json(), project)
+            with self.metrics.phase("populate_history"):
+                self.populate_history(response.json(), project)
             activity = f"`{user}` made a pull request to `{self.secondary_repo}` from project `{self.project.name}`"
         else:
             pr_res = response.json()
@@ -169,9 +232,29 @@ class GitRemote:
     def run(self):
         """This function runs all functions required to clone, push and merge
         PRs."""
-        if self.action == "closed":
-            with tempfile.TemporaryDirectory() as parent_dir:
-                self.clone(parent_dir)
-                self.checkout()
-                self.push()
+        if self.action != "closed":
+            return
+
+        metrics = self.metrics
+        try:
+            if settings.GIT_REPLICATION_MODE == ReplicationModeChoices.REFS:
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    with metrics.phase("clone"):
+                        self.fetch_ref(temp_dir)
+                    with metrics.phase("checkout"):
+                        self.checkout()
+                    with metrics.phase("push"):
+                        self.push()
+            else:
+                with mirrors.lock(self.project.id):
+                    with metrics.phase("clone"):
+                        self.clone()
+                    with metrics.phase("checkout"):
+                        self.checkout()
+                    with metrics.phase("push"):
+                        self.push()
+                mirrors.evict(keep=self.project.id)
+            with metrics.phase("make_pr"):
                 self.make_pr()
+        finally:
+            metrics.emit()
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.urls import reverse
+
+from automate.encryptor import crypt
+from automate.models import Project
+from automate.serializers import ProjectSerializer
+from automate.utils import primary_hook, register_hook, secondary_hook
+
+
+class Command(BaseCommand):
+    """Register the webhooks of existing projects again, signed with their
+    secret."""
+
+    help = (
+        "Register the webhooks of existing projects again, signed with their "
+        "secret. Run it before turning WEBHOOK_REQUIRE_SIGNATURE on."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--domain",
+            required=True,
+            help="Scheme and host providers deliver to, e.g. https://automator.example.com",
+        )
+        parser.add_argument(
+            "slugs", nargs="*", help="Projects to register, all by default"
+        )
+
+    def handle(self, *args, **options):
+        domain = options["domain"].rstrip("/")
+        projects = Project.objects.order_by("id")
+        if options["slugs"]:
+            projects = projects.filter(slug__in=options["slugs"])
+
+        for project in projects:
+            try:
+                self.register(project, domain)
+            except Exception as err:  # pylint: disable=broad-except
+                # One project's broken credentials don't stop the others
+                self.stderr.write(f"{project.slug}\tfailed\t{err!r}")
+
+    def register(self, project, domain):
+        """Register the hooks of a project in its primary and secondary
+        repositories."""
+        project_data = ProjectSerializer(project).data
+        project_data["primary_repo_token"] = crypt.decrypt(
+            project_data["primary_repo_token"]
+        )
+        url = domain + reverse("project:project-webhook", args=(project.slug,))
+        response = register_hook(*primary_hook(url, project_data))
+        self.report(project, "primary", response)
+
+        url = domain + reverse(
+            "project:project-secondary-webhook", args=(project.slug,)
+        )
+        response = register_hook(*secondary_hook(url, project))
+        self.report(project, "secondary", response)
+
+    def report(self, project, repo, response):
+        """Write the outcome of a hook registration."""
+        status = "unreachable" if response is None else response.status_code
+        self.stdout.write(f"{project.slug}\t{repo}\t{status}")
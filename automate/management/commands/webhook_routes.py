@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from automate.views import WEBHOOK_REPOS
+from automate.webhooks import ROUTE_OUTCOMES, route_counters
+
+
+class Command(BaseCommand):
+    """Show how many webhook deliveries each route queued or dropped."""
+
+    help = "Show how many webhook deliveries each route queued or dropped."
+
+    def handle(self, *args, **options):
+        header = ("repository", "provider", "event", "action") + ROUTE_OUTCOMES
+        self.stdout.write("\t".join(header))
+        for repo, (routes, _) in WEBHOOK_REPOS.items():
+            for counter, counts in route_counters(routes, repo).items():
+                values = [str(counts[outcome]) for outcome in ROUTE_OUTCOMES]
+                self.stdout.write("\t".join([repo, *counter] + values))
@@ -0,0 +1,125 @@
+import json
+import logging
+import re
+import time
+from contextlib import contextmanager
+
+from git import RemoteProgress
+from git.cmd import handle_process_output
+from git.util import finalize_process
+
+logger = logging.getLogger(__name__)
+
+SIZE_UNITS = {"bytes": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3}
+SIZE_PATTERN = re.compile(r"([\d.]+) (bytes|KiB|MiB|GiB)")
+TOTAL_PATTERN = re.compile(r"Total (\d+)")
+
+
+def parse_size(message):
+    """Return the first size in a git progress message in bytes, if any."""
+    match = SIZE_PATTERN.search(message or "")
+    if not match:
+        return 0
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+class TransferProgress(RemoteProgress):
+    """Progress handler counting the objects and bytes git transfers.
+
+    Counts add up over every fetch or push the handler is passed to.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.objects = 0
+        self.bytes = 0
+        self._reported = False
+        self._pending_total = 0
+
+    def update(self, op_code, cur_count, max_count=None, message=""):
+        """Record the totals git reports once an object transfer ends."""
+        if not op_code & self.END:
+            return
+        if op_code & (self.RECEIVING | self.WRITING):
+            self.objects += int(max_count or cur_count)
+            self.bytes += parse_size(message)
+            self._reported = True
+
+    def line_dropped(self, line):
+        """Fall back to the object total of small transfers, which git unpacks
+        without reporting received objects."""
+        match = TOTAL_PATTERN.search(line)
+        if match and line.startswith("remote:"):
+            self._pending_total = int(match.group(1))
+
+    def finish(self):
+        """Account for a transfer that reported no object counts."""
+        if not self._reported:
+            self.objects += self._pending_total
+        self._pending_total = 0
+        self._reported = False
+
+
+def run_git(repository, command, *args, progress=None, **kwargs):
+    """Run a git network command, feeding its progress to ``progress`` when
+    given."""
+    if progress is None:
+        return getattr(repository.git, command)(*args, **kwargs)
+
+    process = getattr(repository.git, command)(
+        *args, progress=True, as_process=True, universal_newlines=True, **kwargs
+    )
+    try:
+        handle_process_output(
+            process,
+            None,
+            progress.new_message_handler(),
+            finalize_process,
+            decode_streams=False,
+        )
+    finally:
+        progress.finish()
+    return None
+
+
+class ReplicationMetrics:
+    """Phase timings and transfer sizes of one replication of a project."""
+
+    def __init__(self, project):
+        self.project = project
+        self.phases = {}
+        self.received = TransferProgress()
+        self.sent = TransferProgress()
+        self.status = "ok"
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of the replication, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.status = "failed"
+            raise
+        finally:
+            self.phases[name] = round(
+                self.phases.get(name, 0) + time.perf_counter() - start, 3
+            )
+
+    def as_dict(self):
+        """Return the metrics as a dictionary."""
+        return {
+            "project_id": self.project.id,
+            "project": self.project.name,
+            "status": self.status,
+            "phases": self.phases,
+            "received": {
+                "objects": self.received.objects,
+                "bytes": self.received.bytes,
+            },
+            "sent": {"objects": self.sent.objects, "bytes": self.sent.bytes},
+        }
+
+    def emit(self):
+        """Log the metrics as a single JSON line."""
+        logger.info("git replication %s", json.dumps(self.as_dict()))
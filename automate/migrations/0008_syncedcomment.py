@@ -0,0 +1,60 @@
+# Generated by Django 3.2.16 on 2026-10-18 09:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("automate", "0007_auto_20230122_1636"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="history",
+            name="comments_synced_at",
+            field=models.DateTimeField(
+                help_text="Latest update time of the secondary comments already synced",
+                null=True,
+            ),
+        ),
+        migrations.CreateModel(
+            name="SyncedComment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("secondary_comment_id", models.BigIntegerField()),
+                (
+                    "primary_comment_id",
+                    models.BigIntegerField(
+                        help_text="Empty until the primary repository accepts the comment",
+                        null=True,
+                    ),
+                ),
+                (
+                    "history",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="synced_comments",
+                        to="automate.history",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="syncedcomment",
+            constraint=models.UniqueConstraint(
+                fields=("history", "secondary_comment_id"), name="unique_synced_comment"
+            ),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.16 on 2026-10-18 10:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("automate", "0009_webhookevent"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="history",
+            index=models.Index(
+                fields=["project", "created_at", "id"], name="history_project_created"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="project",
+            index=models.Index(
+                fields=["owner", "created_at", "id"], name="project_owner_created"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="projectactivities",
+            index=models.Index(
+                fields=["project", "created_at", "id"], name="activity_project_created"
+            ),
+        ),
+    ]
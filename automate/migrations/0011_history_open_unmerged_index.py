@@ -0,0 +1,21 @@
+# Generated by Django 3.2.16 on 2026-10-18 10:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("automate", "0010_cursor_pagination_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="history",
+            index=models.Index(
+                condition=models.Q(("action", "open"), ("merged_at__isnull", True)),
+                fields=["id"],
+                name="history_open_unmerged",
+            ),
+        ),
+    ]
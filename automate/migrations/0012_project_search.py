@@ -0,0 +1,60 @@
+# Generated by Django 3.2.16 on 2026-10-18 10:16
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+# Projects are searched by name first, then by their repositories. The
+# "simple" config keeps owner and repository names unstemmed.
+SEARCH_VECTOR_TRIGGER = """
+CREATE FUNCTION automate_project_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('simple',
+            coalesce(NEW.name, '') || ' ' || coalesce(NEW.slug, '')
+        ), 'A') ||
+        setweight(to_tsvector('simple',
+            coalesce(NEW.primary_repo_owner, '') || ' ' ||
+            coalesce(NEW.primary_repo_name, '') || ' ' ||
+            coalesce(NEW.secondary_repo_owner, '') || ' ' ||
+            coalesce(NEW.secondary_repo_name, '')
+        ), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER project_search_vector
+    BEFORE INSERT OR UPDATE ON automate_project
+    FOR EACH ROW EXECUTE PROCEDURE automate_project_search_vector();
+
+UPDATE automate_project SET search_vector = NULL;
+"""
+
+DROP_SEARCH_VECTOR_TRIGGER = """
+DROP TRIGGER project_search_vector ON automate_project;
+DROP FUNCTION automate_project_search_vector();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("automate", "0011_history_open_unmerged_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="project",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="project",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="project_search"
+            ),
+        ),
+        migrations.RunSQL(SEARCH_VECTOR_TRIGGER, DROP_SEARCH_VECTOR_TRIGGER),
+    ]
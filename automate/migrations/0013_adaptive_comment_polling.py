@@ -0,0 +1,40 @@
+# Generated by Django 3.2.16 on 2026-10-18 10:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("automate", "0012_project_search"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="history",
+            name="history_open_unmerged",
+        ),
+        migrations.AddField(
+            model_name="history",
+            name="next_check_at",
+            field=models.DateTimeField(
+                help_text="When the PR is next polled for comments, empty when due",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="history",
+            name="poll_interval",
+            field=models.IntegerField(
+                default=0, help_text="Seconds between the latest polls of the PR"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="history",
+            index=models.Index(
+                condition=models.Q(("action", "open"), ("merged_at__isnull", True)),
+                fields=["next_check_at"],
+                name="history_open_unmerged",
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.16 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("automate", "0013_adaptive_comment_polling"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="history",
+            name="review_count",
+            field=models.IntegerField(
+                help_text="Reviews of the secondary PR at its latest sync", null=True
+            ),
+        ),
+    ]
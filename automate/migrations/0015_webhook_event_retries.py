@@ -0,0 +1,27 @@
+# Generated by Django 3.2.16 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("automate", "0014_history_review_count"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="webhookevent",
+            name="attempts",
+            field=models.IntegerField(
+                default=0, help_text="Failed replications so far"
+            ),
+        ),
+        migrations.AddField(
+            model_name="webhookevent",
+            name="retry_at",
+            field=models.DateTimeField(
+                help_text="When a failed event is drained again", null=True
+            ),
+        ),
+    ]
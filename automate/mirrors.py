@@ -0,0 +1,135 @@
+import fcntl
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from git import Repo
+
+from automate.metrics import run_git
+from repo.utils import logger
+
+
+class MirrorStore:
+    """On-disk store of bare mirrors of primary repositories, keyed by project.
+
+    A mirror is created once and then kept up to date with incremental
+    fetches, so replicating a PR no longer needs a full clone. Mirrors
+    that have not been used recently are evicted once the store grows
+    past its disk quota.
+    """
+
+    refspec = "+refs/heads/*:refs/heads/*"
+
+    def __init__(self, root=None, quota=None):
+        self._root = root
+        self._quota = quota
+
+    @property
+    def root(self):
+        """Directory holding the mirrors."""
+        return Path(self._root or settings.GIT_MIRROR_ROOT)
+
+    @property
+    def quota(self):
+        """Disk quota of the store in bytes."""
+        return settings.GIT_MIRROR_QUOTA if self._quota is None else self._quota
+
+    def path_for(self, project_id):
+        """Return the path of the mirror belonging to a project."""
+        return self.root / f"{project_id}.git"
+
+    @contextmanager
+    def lock(self, project_id, blocking=True):
+        """Hold an exclusive lock on a project's mirror.
+
+        Yields True once the lock is held, or False when ``blocking`` is
+        off and another process already holds it.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / f"{project_id}.lock", "w", encoding="utf-8") as handle:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(handle, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def sync(self, project_id, url, progress=None):
+        """Create the mirror if needed, fetch the latest branches into it and
+        return the repository.
+
+        The url is only passed on the command line so credentials are
+        never written to the mirror's config. Callers should hold
+        ``lock(project_id)``. Transfer progress is reported to
+        ``progress`` when given.
+        """
+        path = self.path_for(project_id)
+        if path.exists():
+            repository = Repo(path)
+        else:
+            repository = Repo.init(path, bare=True)
+        run_git(
+            repository,
+            "fetch",
+            url,
+            self.refspec,
+            progress=progress,
+            prune=True,
+            no_tags=True,
+        )
+        # The mirror's mtime doubles as its last used time for eviction
+        os.utime(path)
+        return repository
+
+    def mirrors(self):
+        """Return (project_id, path, size, last_used) for every mirror."""
+        if not self.root.exists():
+            return []
+        return [
+            (path.stem, path, self.disk_usage(path), path.stat().st_mtime)
+            for path in self.root.glob("*.git")
+        ]
+
+    @staticmethod
+    def disk_usage(path):
+        """Return the size in bytes of everything under path."""
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, filename)).st_size
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def evict(self, keep=None):
+        """Remove the least recently used mirrors until the store fits its
+        quota.
+
+        The mirror of ``keep`` and mirrors locked by another process are
+        never removed.
+        """
+        candidates = sorted(self.mirrors(), key=lambda mirror: mirror[3])
+        total = sum(mirror[2] for mirror in candidates)
+
+        for project_id, path, size, _ in candidates:
+            if total <= self.quota:
+                break
+            if project_id == str(keep):
+                continue
+            with self.lock(project_id, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            logger.info("Evicted git mirror %s (%s bytes)", path, size)
+        return total
+
+
+mirrors = MirrorStore()
@@ -1,9 +1,11 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.utils.text import slugify
 
-from automate.choices import RepoTypeChoices
+from automate.choices import RepoTypeChoices, WebhookEventStatusChoices
 from repo.models import BaseModel
 
 User = get_user_model()
@@ -78,6 +80,19 @@ class Project(BaseModel):
     secondary_refresh_token = models.TextField(
         verbose_name="Secondary Bitbucket Refresh Token", null=True
     )
+    # Kept up to date by the project_search_vector trigger, see the
+    # project_search migration
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        """Meta class for Project."""
+
+        indexes = [
+            models.Index(
+                fields=["owner", "created_at", "id"], name="project_owner_created"
+            ),
+            GinIndex(fields=["search_vector"], name="project_search"),
+        ]
 
     @property
     def primary_repo_webhook_url(self):
@@ -88,6 +103,17 @@ class Project(BaseModel):
             url = settings.BITBUCKET_BASE_URL + "/repositories/{owner}/{repo}/hooks"
         return url.format(owner=self.primary_repo_owner, repo=self.primary_repo_name)
 
+    @property
+    def secondary_repo_webhook_url(self):
+        """Construct the secondary repo webhook endpoint."""
+        if self.secondary_repo_type == RepoTypeChoices.GITHUB:
+            url = settings.GITHUB_BASE_URL + "/repos/{owner}/{repo}/hooks"
+        else:
+            url = settings.BITBUCKET_BASE_URL + "/repositories/{owner}/{repo}/hooks"
+        return url.format(
+            owner=self.secondary_repo_owner, repo=self.secondary_repo_name
+        )
+
     def save(self, *args, **kwargs):
         self.slug = slugify(self.name)
         super().save(*args, **kwargs)
@@ -109,11 +135,64 @@ class History(BaseModel):
     comments = models.IntegerField(default=0)
     merged_at = models.DateTimeField(null=True)
     closed_at = models.DateTimeField(null=True)
+    comments_synced_at = models.DateTimeField(
+        null=True,
+        help_text="Latest update time of the secondary comments already synced",
+    )
+    next_check_at = models.DateTimeField(
+        null=True, help_text="When the PR is next polled for comments, empty when due"
+    )
+    poll_interval = models.IntegerField(
+        default=0, help_text="Seconds between the latest polls of the PR"
+    )
+    review_count = models.IntegerField(
+        null=True, help_text="Reviews of the secondary PR at its latest sync"
+    )
+
+    class Meta:
+        """Meta class for History."""
+
+        indexes = [
+            models.Index(
+                fields=["project", "created_at", "id"], name="history_project_created"
+            ),
+            # Only the open PRs are polled, they are a sliver of the table
+            models.Index(
+                fields=["next_check_at"],
+                condition=models.Q(action="open", merged_at__isnull=True),
+                name="history_open_unmerged",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.project}: {self.action}"
 
 
+class SyncedComment(BaseModel):
+    """A secondary PR comment copied to the primary PR."""
+
+    history = models.ForeignKey(
+        History, on_delete=models.CASCADE, related_name="synced_comments"
+    )
+    secondary_comment_id = models.BigIntegerField()
+    primary_comment_id = models.BigIntegerField(
+        null=True, help_text="Empty until the primary repository accepts the comment"
+    )
+
+    class Meta:
+        """Meta class for Synced Comment."""
+
+        constraints = [
+            models.UniqueConstraint(
+                fields=["history", "secondary_comment_id"],
+                name="unique_synced_comment",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.history}: {self.secondary_comment_id}"
+
+
 class ProjectActivities(models.Model):
     """Project Activities Model."""
 
@@ -129,6 +208,43 @@ class ProjectActivities(models.Model):
         ordering = ("-created_at",)
         verbose_name = "Activity"
         verbose_name_plural = "Activities"
+        indexes = [
+            models.Index(
+                fields=["project", "created_at", "id"], name="activity_project_created"
+            )
+        ]
 
     def __str__(self):
         return f"{self.action}"
+
+
+class WebhookEvent(BaseModel):
+    """A webhook delivery waiting in the inbox to be replicated.
+
+    The webhook view only inserts rows, workers claim them in batches.
+    """
+
+    project = models.ForeignKey(
+        Project, on_delete=models.CASCADE, related_name="webhook_events"
+    )
+    payload = models.JSONField(help_text="Fields of the event the git job needs")
+    status = models.CharField(
+        max_length=10,
+        choices=WebhookEventStatusChoices.choices,
+        default=WebhookEventStatusChoices.PENDING,
+    )
+    claimed_at = models.DateTimeField(null=True)
+    attempts = models.IntegerField(default=0, help_text="Failed replications so far")
+    retry_at = models.DateTimeField(
+        null=True, help_text="When a failed event is drained again"
+    )
+
+    class Meta:
+        """Meta class for Webhook Event."""
+
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="webhook_event_queue")
+        ]
+
+    def __str__(self):
+        return f"{self.project}: {self.payload.get('action')} ({self.status})"
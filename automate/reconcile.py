@@ -0,0 +1,29 @@
+import hashlib
+import json
+
+# Fields that identify a review comment regardless of which repository it lives in
+FINGERPRINT_FIELDS = ("body", "path", "line", "side", "commit_id")
+
+
+def fingerprint(comment, fields=FINGERPRINT_FIELDS):
+    """Return a stable hash of the fields that identify a comment.
+
+    Missing fields count as None, so comments of different shapes can be
+    compared on the fields they share.
+    """
+    values = [comment.get(field) for field in fields]
+    encoded = json.dumps(values, separators=(",", ":"), default=str).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def missing_comments(source, target, fields=FINGERPRINT_FIELDS):
+    """Return the comments of ``source`` that have no equivalent in ``target``,
+    in their original order.
+
+    The fingerprints of ``target`` are indexed once so each lookup is a
+    set membership test, instead of comparing every pair of comments.
+    """
+    existing = {fingerprint(comment, fields) for comment in target}
+    return [
+        comment for comment in source if fingerprint(comment, fields) not in existing
+    ]
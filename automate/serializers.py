@@ -4,14 +4,16 @@ from rest_framework.reverse import reverse
 
 from accounts.serializers import UserSerializer
 from automate.choices import RepoTypeChoices
-from automate.encryptor import Crypt
-from automate.models import Project
-from automate.tasks import add_hook_to_repo_task, init_run_git
+from automate.encryptor import crypt
+from automate.models import History, Project, ProjectActivities
+from automate.tasks import (
+    add_hook_to_repo_task,
+    add_secondary_hook_task,
+    warm_mirror_task,
+)
 from automate.utils import refresh_bitbucket_token
 from repo.utils import MakeRequest
 
-crypt = Crypt()
-
 
 class ProjectSerializer(serializers.ModelSerializer):
     """Project Serializer."""
@@ -22,7 +24,7 @@ class ProjectSerializer(serializers.ModelSerializer):
         """Metaclass for Project Serializer."""
 
         model = Project
-        fields = "__all__"
+        exclude = ("search_vector",)
         lookup_field = "slug"
         extra_kwargs = {"owner": {"read_only": True}}
 
@@ -111,7 +113,8 @@ class ProjectSerializer(serializers.ModelSerializer):
         project_ = super().create(validated_data)
         # project_ = Project.objects.last()
         context = self.context["request"]
-        domain = context.domain
+        # Deliveries go to the webhooks service when it is served apart
+        domain = settings.WEBHOOK_DOMAIN or context.domain
         user_ = UserSerializer(context.user).data
         path = reverse("project:project-webhook", args=(project_.slug,))
         project_webhook_url = domain + path
@@ -123,6 +126,9 @@ class ProjectSerializer(serializers.ModelSerializer):
             user_["email"],
             project.data,
         )
+        path = reverse("project:project-secondary-webhook", args=(project_.slug,))
+        add_secondary_hook_task.delay(domain + path, project_.id)
+        warm_mirror_task.delay(project_.id)
         return project_
 
     def test_if_repo_exists(self, git_type, credentials: dict, repo, owner):
@@ -183,9 +189,9 @@ class ProjectSerializer(serializers.ModelSerializer):
         }
 
         # Use a loop to update the data i.e., This helps to pass validation during updating
-        for key, value in initial_data.items():
+        for key, value in crypt.multi_encrypt(initial_data).items():
             if value:
-                data[key] = crypt.encrypt(value)
+                data[key] = value
 
         return data
 
@@ -198,45 +204,21 @@ class ProjectSerializer(serializers.ModelSerializer):
         return attrs
 
 
-class RepoSerializer(serializers.Serializer):
-    """Serializer for the Repository."""
-
-    name = serializers.CharField()
-
-
-class HeadSerializer(serializers.Serializer):
-    """Head Serializer for the project that contains information about the
-    branch and the repository."""
-
-    ref = serializers.CharField()
-    repo = RepoSerializer()
-
-
-class PullRequestSerializer(serializers.Serializer):
-    """Pull Request Serializer."""
-
-    id = serializers.IntegerField()
-    url = serializers.URLField()
-    state = serializers.CharField()
-    title = serializers.CharField()
-    body = serializers.CharField(allow_blank=True, required=False, allow_null=True)
-    head = HeadSerializer()
+class ProjectActivitySerializer(serializers.ModelSerializer):
+    """Project Activity Serializer."""
 
+    class Meta:
+        """Metaclass for Project Activity Serializer."""
 
-class WebHookSerializer(serializers.Serializer):
-    """Serializer to automate cloning process between repositories."""
+        model = ProjectActivities
+        fields = ("id", "user", "action", "status", "created_at")
 
-    action = serializers.CharField()
-    pull_request = PullRequestSerializer()
 
-    def clone_push_make_pr(self, project, data):
-        """This method runs the cloning and pushing process.
+class HistorySerializer(serializers.ModelSerializer):
+    """Serializer for the PRs replicated for a project."""
 
-        This should be moved into tasks.
-        """
-        init_run_git.delay(project, data)
+    class Meta:
+        """Metaclass for History Serializer."""
 
-    def to_representation(self, instance):
-        data = super().to_representation(instance)
-        self.clone_push_make_pr(self.context.get("queryset"), data)
-        return data
+        model = History
+        exclude = ("project",)
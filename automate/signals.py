@@ -0,0 +1,13 @@
+from django.core.cache import cache
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from automate.models import Project
+from automate.webhooks import project_cache_key
+
+
+@receiver(post_delete, sender=Project)
+def forget_deleted_project(instance, **_kwargs):
+    """Drop the cached id of a deleted project, so its webhook deliveries are
+    refused instead of queued for a project that is gone."""
+    cache.delete(project_cache_key(instance.slug))
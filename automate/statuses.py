@@ -0,0 +1,73 @@
+import re
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from repo.utils import LOW_PRIORITY, MakeRequest
+
+# API url path of a GitHub pull request
+PULL_REQUEST_PATH = re.compile(
+    r"/repos/(?P<owner>[^/]+)/(?P<name>[^/]+)/pulls/(?P<number>\d+)/?$"
+)
+
+
+def status_query(urls):
+    """Return a GraphQL query asking for the state, closing time and review
+    count of the pull requests at urls, and its variables.
+
+    Each pull request is asked for under its own alias, ``pr<index>``.
+    Urls that aren't GitHub pull requests are left out.
+    """
+    declarations, fields, variables = [], [], {}
+    for index, url in enumerate(urls):
+        match = PULL_REQUEST_PATH.search(urlsplit(url).path)
+        if not match:
+            continue
+        declarations.append(
+            f"$owner{index}: String!, $name{index}: String!, $number{index}: Int!"
+        )
+        fields.append(
+            f"pr{index}: repository(owner: $owner{index}, name: $name{index}) "
+            f"{{ pullRequest(number: $number{index}) "
+            "{ merged state closedAt reviews { totalCount } } }"
+        )
+        variables[f"owner{index}"] = match["owner"]
+        variables[f"name{index}"] = match["name"]
+        variables[f"number{index}"] = int(match["number"])
+    query = f"query({', '.join(declarations)}) {{ {' '.join(fields)} }}"
+    return query, variables
+
+
+def pull_request_statuses(token, urls):
+    """Return the merged flag, state, closing time and review count of GitHub
+    pull requests by url, asking for all of them in a single GraphQL request.
+
+    Pull requests GitHub couldn't resolve are left out, so callers fall
+    back to looking them up one by one.
+    """
+    query, variables = status_query(urls)
+    if not variables:
+        return {}
+    req = MakeRequest(
+        settings.GITHUB_BASE_URL + "/graphql",
+        {"Authorization": f"Bearer {token}"},
+        raise_errors=True,
+        priority=LOW_PRIORITY,
+    )
+    response = req.post({"query": query, "variables": variables}, json=True)
+    if response.status_code != 200:
+        return {}
+    # Unresolved aliases are null, with the reason under "errors"
+    data = response.json().get("data") or {}
+
+    statuses = {}
+    for index, url in enumerate(urls):
+        pull_request = (data.get(f"pr{index}") or {}).get("pullRequest")
+        if pull_request:
+            statuses[url] = {
+                "merged": pull_request["merged"],
+                "state": pull_request["state"],
+                "closed_at": pull_request["closedAt"],
+                "reviews": pull_request["reviews"]["totalCount"],
+            }
+    return statuses
@@ -1,15 +1,35 @@
 import json
-
-from celery import shared_task
-
-from automate.choices import RepoTypeChoices
-from automate.encryptor import Crypt
-from automate.gitremote import GitRemote
-from automate.models import History
-from automate.utils import add_hook_to_repo, log_activity, refresh_bitbucket_token
-from repo.utils import MakeRequest, logger
-
-crypt = Crypt()
+from collections import defaultdict
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from celery import group, shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from requests.exceptions import RequestException
+
+from automate.activity import buffered_activities, log_activity
+from automate.choices import RepoTypeChoices, WebhookEventStatusChoices
+from automate.encryptor import crypt
+from automate.gitremote import GitRemote, warm_mirror
+from automate.models import History, Project, SyncedComment, WebhookEvent
+from automate.reconcile import missing_comments
+from automate.statuses import pull_request_statuses
+from automate.utils import (
+    add_hook_to_repo,
+    add_secondary_hook_to_repo,
+    get_bitbucket_access_token,
+)
+from repo.utils import LOW_PRIORITY, MakeRequest, RateLimitedError, cache_lock, logger
+
+DRAIN_PENDING_KEY = "webhooks:drain:pending"
+COMMENTS_CHECK_PENDING_KEY = "comments:check:pending"
+# A lost wake up is covered by the periodic task after this many seconds
+WAKE_TIMEOUT = 60
 
 
 @shared_task()
@@ -19,10 +39,147 @@ def add_hook_to_repo_task(project_webhook_url, user, project):
 
 
 @shared_task()
-def init_run_git(project, data):
-    """This is a delayed method to initialize and run git processes."""
-    git = GitRemote(instance=project, data=data)
-    git.run()
+def add_secondary_hook_task(webhook_url, project_id):
+    """This task adds the comment and merge hook to the secondary repo."""
+    add_secondary_hook_to_repo(webhook_url, project_id)
+
+
+@shared_task()
+def warm_mirror_task(project_id):
+    """This task prepares the primary repository mirror of a new project."""
+    project = Project.objects.get(id=project_id)
+    warm_mirror(project)
+
+
+def wake(task, pending_key):
+    """Ask for a periodic task to run right away.
+
+    The periodic run still happens when the broker can't be reached.
+    """
+    if not cache.add(pending_key, True, WAKE_TIMEOUT):
+        return
+    try:
+        task.delay()
+    except Exception:  # pylint: disable=broad-except
+        # The key stays, so deliveries don't each wait on a broker that is down
+        logger.warning("Could not wake %s", task.name, exc_info=True)
+
+
+def wake_drain():
+    """Ask for the inbox to be drained right away."""
+    wake(drain_webhook_events, DRAIN_PENDING_KEY)
+
+
+def wake_comment_sync():
+    """Ask for the PRs due a sync to be dispatched right away."""
+    wake(check_new_comments, COMMENTS_CHECK_PENDING_KEY)
+
+
+def claimable_webhook_events():
+    """Return the pending webhook events that are due and those whose claim was
+    abandoned, oldest first."""
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.WEBHOOK_CLAIM_TIMEOUT)
+    return WebhookEvent.objects.filter(
+        Q(status=WebhookEventStatusChoices.PENDING)
+        & (Q(retry_at=None) | Q(retry_at__lte=now))
+        | Q(status=WebhookEventStatusChoices.CLAIMED, claimed_at__lt=stale)
+    ).order_by("created_at")
+
+
+def claim_webhook_events(limit):
+    """Claim a batch of pending webhook events that are due, and events whose
+    claim was abandoned, and return their ids grouped by project."""
+    with transaction.atomic():
+        events = list(
+            claimable_webhook_events()
+            .select_for_update(skip_locked=True)
+            .values_list("id", "project_id")[:limit]
+        )
+        WebhookEvent.objects.filter(id__in=[event_id for event_id, _ in events]).update(
+            status=WebhookEventStatusChoices.CLAIMED, claimed_at=timezone.now()
+        )
+
+    batches = {}
+    for event_id, project_id in events:
+        batches.setdefault(project_id, []).append(event_id)
+    return batches
+
+
+@shared_task(ignore_result=True)
+def drain_webhook_events():
+    """Claim pending webhook events and queue one git job per project.
+
+    Returns the number of events claimed.
+    """
+    cache.delete(DRAIN_PENDING_KEY)
+    batches = claim_webhook_events(settings.WEBHOOK_DRAIN_BATCH_SIZE)
+    for project_id, event_ids in batches.items():
+        process_webhook_events.delay(project_id, event_ids)
+    return sum(len(event_ids) for event_ids in batches.values())
+
+
+@shared_task(bind=True, max_retries=None)
+def process_webhook_events(self, project_id, event_ids):
+    """This is a delayed method to run the git processes of a project's webhook
+    events.
+
+    Jobs of the same project run one at a time, others are retried until
+    the project is free. Only the latest event of a PR branch and action
+    is replicated. Failed events are put back in the inbox until
+    WEBHOOK_MAX_ATTEMPTS.
+    """
+    lock_key = f"gitremote:lock:{project_id}"
+    with cache_lock(lock_key, settings.GIT_JOB_LOCK_TIMEOUT) as acquired:
+        events = WebhookEvent.objects.filter(
+            id__in=event_ids, status=WebhookEventStatusChoices.CLAIMED
+        )
+        if not acquired:
+            # Keep the claim while waiting for the project
+            events.update(claimed_at=timezone.now())
+            raise self.retry(countdown=settings.GIT_JOB_RETRY_DELAY)
+
+        events = list(events.select_related("project").order_by("created_at"))
+        latest = {}
+        for event in events:
+            branch = event.payload["pull_request"]["head"]["ref"]
+            latest[(event.payload["action"], branch)] = event
+
+        failed = []
+        with buffered_activities():
+            for event in latest.values():
+                try:
+                    GitRemote(instance=event.project, data=event.payload).run()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Webhook event %s failed", event.id)
+                    failed.append(event)
+
+        # The delivery was acknowledged, so the provider won't send it again
+        for event in failed:
+            event.attempts += 1
+            if event.attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+                event.status = WebhookEventStatusChoices.FAILED
+            else:
+                delay = settings.WEBHOOK_RETRY_DELAY * 2 ** (event.attempts - 1)
+                event.status = WebhookEventStatusChoices.PENDING
+                event.retry_at = timezone.now() + timedelta(seconds=delay)
+        WebhookEvent.objects.bulk_update(failed, ["attempts", "status", "retry_at"])
+        WebhookEvent.objects.filter(
+            id__in=[event.id for event in events if event not in failed]
+        ).update(status=WebhookEventStatusChoices.PROCESSED)
+
+
+@shared_task(ignore_result=True)
+def purge_webhook_events():
+    """Delete the processed webhook events older than WEBHOOK_RETENTION.
+
+    Returns the number of events deleted.
+    """
+    expired = timezone.now() - timedelta(seconds=settings.WEBHOOK_RETENTION)
+    deleted, _ = WebhookEvent.objects.filter(
+        status=WebhookEventStatusChoices.PROCESSED, created_at__lt=expired
+    ).delete()
+    return deleted
 
 
 def bitbucket_refresh_access_token(project):
@@ -39,277 +196,553 @@ def bitbucket_refresh_access_token(project):
         "client_secret": project.secondary_client_secret,
     }
     credentials = crypt.multi_decrypt(credentials)
-    token = refresh_bitbucket_token(credentials)
+    token = get_bitbucket_access_token(credentials)
     return token
 
 
-@shared_task()
-def check_new_comments():
-    """I'd get all Open PRs that have not been closed."""
-    open_pr = History.objects.filter(action="open", merged_at=None)
+def secondary_comments_url(pr):
+    """Return the url listing the comments of a secondary PR updated since they
+    were last synced."""
+    if pr.project.secondary_repo_type == RepoTypeChoices.GITHUB.value:
+        params = {"per_page": 100}
+        if pr.comments_synced_at:
+            params["since"] = pr.comments_synced_at.strftime("%Y-%m-%dT%H:%M:%SZ")
+    else:
+        params = {"pagelen": 100}
+        if pr.comments_synced_at:
+            params["q"] = f"updated_on > {pr.comments_synced_at.isoformat()}"
+    return f"{pr.url}/comments?{urlencode(params)}"
+
+
+def secondary_comments(pr, sec_req):
+    """Return every comment of a secondary PR updated since they were last
+    synced, following the pages of the listing."""
+    github = pr.project.secondary_repo_type == RepoTypeChoices.GITHUB.value
+    url = secondary_comments_url(pr)
+    comments = []
+    while url:
+        response = sec_req.get(url)
+        content = json.loads(response.content)
+        if github:
+            comments.extend(content)
+            url = response.links.get("next", {}).get("url")
+        else:
+            comments.extend(content["values"])
+            url = content.get("next")
+    return comments
+
+
+def unsynced_comments(pr, comments):
+    """Return the secondary comments that were never copied to the primary
+    PR."""
+    synced = set(
+        pr.synced_comments.filter(
+            secondary_comment_id__in=[comment["id"] for comment in comments]
+        ).values_list("secondary_comment_id", flat=True)
+    )
+    return [comment for comment in comments if comment["id"] not in synced]
+
+
+def record_existing_comments(pr, comments):
+    """Record secondary comments already present in the primary PR, found by
+    content on the first sync of a PR."""
+    SyncedComment.objects.bulk_create(
+        [
+            SyncedComment(history=pr, secondary_comment_id=comment["id"])
+            for comment in comments
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def claim_comment(pr, comment_id):
+    """Record that a secondary comment is being copied to the primary PR.
+
+    Returns None when it was claimed before, so a comment is never
+    posted twice even when a previous run crashed midway.
+    """
+    claim, created = SyncedComment.objects.get_or_create(
+        history=pr, secondary_comment_id=comment_id
+    )
+    return claim if created else None
 
-    # If there's an open PR then it would run a for-loop checking comments on all of them
-    if open_pr:
 
-        for pr in open_pr:
-            # Setup headers
-            primary_header = {
-                "Authorization": f"Bearer {crypt.decrypt(pr.project.primary_repo_token)}"
-            }
-            secondary_header = {
-                "Authorization": f"Bearer {crypt.decrypt(pr.project.secondary_repo_token)}"
-            }
+def release_comment(pr, comment_id):
+    """Forget a claimed comment the primary repository refused, so it is
+    retried."""
+    SyncedComment.objects.filter(history=pr, secondary_comment_id=comment_id).delete()
 
-            # Urls
-            primary_url = pr.primary_url
-            secondary_url = pr.url
 
-            # Initialize MakeRequest
-            pri_req = MakeRequest(primary_url, primary_header)
-            sec_req = MakeRequest(secondary_url, secondary_header)
+def schedule_next_check(pr, active):
+    """Set when the PR is next polled, soon when it is active and twice as late
+    as last time when it is idle."""
+    interval = settings.COMMENT_POLL_MIN_INTERVAL
+    if not active:
+        interval = min(
+            max(pr.poll_interval * 2, interval), settings.COMMENT_POLL_MAX_INTERVAL
+        )
+    pr.poll_interval = interval
+    pr.next_check_at = timezone.now() + timedelta(seconds=interval)
 
-            owner = pr.project.owner
-            project = pr.project
 
-            # Check if the secondary PR is github or bitbucket for merging operations
-            if pr.project.secondary_repo_type == RepoTypeChoices.GITHUB.value:
-                # Checks if secondary PR is merged
-                response = sec_req.get()
-                content = response.json()
-                if content.get("merged"):
-                    # Merge the primary PR and not proceed to updating comments
-                    data = {
-                        "commit_title": "Pull requests merged automatically.",
-                        "commit_message": f"""This pull request has been merged from {pr.project.secondary_repo_name}
-                                        ({secondary_url})""",
-                    }
-                    response = pri_req.put(data, json=True, url=pri_req.url + "/merge")
-                    status_code = response.status_code
-                    if status_code in (200, 201):
-                        # Update Open PR History
-                        pr.action = "merged"
-                        pr.save()
-
-                        activity = f"""`{owner}`; {pr.project.primary_repo_name} was automatically merged with
-                                    {pr.project.secondary_repo_name}. Passed with response `{status_code}`"""
-                        log_activity(
-                            user=owner,
-                            activity=activity,
-                            project=pr.project,
-                            status=True,
-                        )
-                    else:
-                        content = response.json()
-                        activity = f"""`{owner}`; {pr.project.primary_repo_name} couldn't merged with
-                                    {pr.project.secondary_repo_name}. Failed with response `{status_code}`."""
-                        log_activity(
-                            user=owner,
-                            activity=activity,
-                            project=pr.project,
-                            status=False,
-                        )
-                    break
+def advance_cursor(pr, comments, field, complete, posted):
+    """Record the primary ids of the posted comments and move the PR's comment
+    cursor to the latest update among comments.
+
+    The cursor stays put when a comment couldn't be copied, so it is
+    fetched again on the next run. The PR's next poll is scheduled by
+    whether any comment changed since the cursor.
+    """
+    SyncedComment.objects.bulk_update(posted, ["primary_comment_id"])
+    updates = [parse_datetime(comment[field]) for comment in comments]
+    # The provider may return the comments updated at the cursor too
+    cursor = pr.comments_synced_at
+    schedule_next_check(
+        pr, active=any(cursor is None or update > cursor for update in updates)
+    )
+    if complete and updates:
+        pr.comments_synced_at = max([*updates, pr.comments_synced_at or updates[0]])
+    pr.comments = pr.synced_comments.exclude(primary_comment_id=None).count()
+    pr.save()
+
+
+def sync_github_comments(pr, pri_req, sec_req):
+    """Copy the new review comments of a GitHub secondary PR to the primary PR,
+    and return whether every one of them was copied."""
+    # Only ask for the comments updated since the last sync
+    comments = secondary_comments(pr, sec_req)
+    comments_not_in_primary = unsynced_comments(pr, comments)
+
+    if comments_not_in_primary and pr.comments_synced_at is None:
+        # Comments copied before their ids were recorded are found by content
+        primary_response = pri_req.get(pri_req.url + "/comments")
+        primary_comments = json.loads(primary_response.content)
+        missing = missing_comments(comments_not_in_primary, primary_comments)
+        missing_ids = {comment["id"] for comment in missing}
+        record_existing_comments(
+            pr,
+            [
+                comment
+                for comment in comments_not_in_primary
+                if comment["id"] not in missing_ids
+            ],
+        )
+        comments_not_in_primary = missing
+
+    complete = True
+    posted = []
+    # Update the primary PR with comments
+    for comment in comments_not_in_primary:
+        claim = claim_comment(pr, comment["id"])
+        if claim is None:
+            continue
+        data = {
+            "body": comment["body"],
+            "position": comment["position"],
+            "commit_id": comment["commit_id"],
+            "path": comment["path"],
+            "start_line": comment["start_line"],
+            "start_side": comment["start_side"],
+            "line": comment["line"],
+            "side": comment["side"],
+        }
+        try:
+            response = pri_req.post(data=data, json=True, url=pri_req.url + "/comments")
+            status = response.status_code
+            if status == 201:
+                claim.primary_comment_id = response.json().get("id")
+                posted.append(claim)
+            else:
+                release_comment(pr, comment["id"])
+                complete = False
+        except (AttributeError, RequestException) as err:
+            logger.error(err)
+            logger.critical(response)
+            release_comment(pr, comment["id"])
+            complete = False
+
+    advance_cursor(pr, comments, "updated_at", complete, posted)
+    return complete
+
+
+def sync_bitbucket_comments(pr, pri_req, sec_req):
+    """Copy the new comments of a Bitbucket secondary PR to the primary PR, and
+    return whether every one of them was copied."""
+    owner = pr.project.owner
+    comments = secondary_comments(pr, sec_req)
+
+    # Reduced comparable comment body
+    comments_not_in_primary = [
+        {"id": comment["id"], "body": comment.get("content")["html"]}
+        for comment in unsynced_comments(pr, comments)
+    ]
+
+    if comments_not_in_primary and pr.comments_synced_at is None:
+        # Comments copied before their ids were recorded are found by content.
+        # Bitbucket comments can only be matched with the primary ones on their body.
+        primary_response = pri_req.get(pri_req.url + "/comments")
+        primary_comments = json.loads(primary_response.content)
+        missing = missing_comments(
+            comments_not_in_primary, primary_comments, fields=("body",)
+        )
+        missing_ids = {comment["id"] for comment in missing}
+        record_existing_comments(
+            pr,
+            [
+                comment
+                for comment in comments_not_in_primary
+                if comment["id"] not in missing_ids
+            ],
+        )
+        comments_not_in_primary = missing
+
+    complete = True
+    posted = []
+    # Update the primary PR with comments
+    for comment in comments_not_in_primary:
+        claim = claim_comment(pr, comment["id"])
+        if claim is None:
+            continue
+        data = {"body": comment["body"], "commit_id": comment["id"]}
+        try:
+            response = pri_req.post(url=pri_req.url + "/comments", data=data, json=True)
+            status = response.status_code
+            content = response.json()
+            if status == 201:
+                claim.primary_comment_id = content.get("id")
+                posted.append(claim)
+                activity = f"""`{owner}`; {pr.project.primary_repo_name} was automatically merged with
+                            {pr.project.secondary_repo_name}. Passed with response `{status}`"""
+                log_activity(
+                    user=owner,
+                    activity=activity,
+                    project=pr.project,
+                    status=True,
+                )
             else:
-                # Refresh Token
-                new_token = bitbucket_refresh_access_token(project)
-                new_header = {"Authorization": f"Bearer {new_token}"}
+                release_comment(pr, comment["id"])
+                complete = False
+                activity = f"""`{owner}`; {pr.project.primary_repo_name} wasn't merged with
+                            {pr.project.secondary_repo_name}. Failed with response `{status}`"""
+                log_activity(
+                    user=owner,
+                    activity=activity,
+                    project=pr.project,
+                    status=False,
+                )
+        except (AttributeError, RequestException) as err:
+            logger.error(err)
+            logger.critical(response)
+            release_comment(pr, comment["id"])
+            complete = False
+            log_activity(
+                user=owner,
+                activity=err,
+                project=pr.project,
+                status=True,
+            )
+
+    advance_cursor(pr, comments, "updated_on", complete, posted)
+    return complete
+
+
+def sync_pr(pr, status=None):
+    """Merge the primary PR once its secondary PR is merged, otherwise copy the
+    new secondary comments to it.
+
+    The status of a GitHub secondary PR already looked up, see
+    pull_request_statuses, saves asking for it again. Return whether the
+    sync is complete, False when a comment is left to retry.
+    """
+    # Setup headers
+    primary_header = {
+        "Authorization": f"Bearer {crypt.decrypt(pr.project.primary_repo_token)}"
+    }
+    secondary_header = {
+        "Authorization": f"Bearer {crypt.decrypt(pr.project.secondary_repo_token)}"
+    }
 
-                # checks if secondary PR is merged
-                req = MakeRequest(secondary_url, new_header)
-                response = req.get()
+    # Urls
+    primary_url = pr.primary_url
+    secondary_url = pr.url
+
+    # Initialize MakeRequest, revalidating cached responses of unchanged PRs
+    pri_req = MakeRequest(
+        primary_url,
+        primary_header,
+        conditional=True,
+        raise_errors=True,
+        priority=LOW_PRIORITY,
+    )
+    sec_req = MakeRequest(
+        secondary_url,
+        secondary_header,
+        conditional=True,
+        raise_errors=True,
+        priority=LOW_PRIORITY,
+    )
+
+    # Merges are user visible, they may use the budget the polling leaves them
+    merge_req = MakeRequest(primary_url, primary_header, raise_errors=True)
+
+    owner = pr.project.owner
+    project = pr.project
+
+    # Check if the secondary PR is github or bitbucket for merging operations
+    if pr.project.secondary_repo_type == RepoTypeChoices.GITHUB.value:
+        # Checks if secondary PR is merged, unless it was looked up already
+        if status is None:
+            status = {"merged": sec_req.get().json().get("merged")}
+        if status["merged"]:
+            # Merge the primary PR and not proceed to updating comments
+            data = {
+                "commit_title": "Pull requests merged automatically.",
+                "commit_message": f"""This pull request has been merged from {pr.project.secondary_repo_name}
+                                ({secondary_url})""",
+            }
+            response = merge_req.put(data, json=True, url=merge_req.url + "/merge")
+            status_code = response.status_code
+            if status_code in (200, 201):
+                # Update Open PR History
+                pr.action = "merged"
+
+                activity = f"""`{owner}`; {pr.project.primary_repo_name} was automatically merged with
+                            {pr.project.secondary_repo_name}. Passed with response `{status_code}`"""
+                log_activity(
+                    user=owner,
+                    activity=activity,
+                    project=pr.project,
+                    status=True,
+                )
+            else:
                 content = response.json()
-
-                if content.get("state") == "MERGED":
-                    # Here we merge the primary github account
-                    merge_commit = content.get("merge_commit")["links"]
-                    data = {
-                        "commit_title": "Pull requests merged automatically.",
-                        "commit_message": f"""This pull request has been merged from {pr.project.secondary_repo_name}
-                                            ({merge_commit['self']} and {merge_commit['html']})""",
-                    }
-                    response = pri_req.put(data, json=True, url=pri_req.url + "/merge")
-                    status_code = response.status_code
-                    if status_code == 200:
-                        # Update Open PR History
-                        pr.action = "merged"
-                        pr.merged_at = content.get("updated_on")
-                        pr.save()
-
-                        activity = f"""`{owner}`; {pr.project.primary_repo_name} was automatically merged with
-                                    {pr.project.secondary_repo_name}. Passed with response `{status_code}`"""
-                        log_activity(
-                            user=owner,
-                            activity=activity,
-                            project=pr.project,
-                            status=True,
-                        )
-                    else:
-                        content = response.json()
-                        activity = f"""`{owner}`; {pr.project.primary_repo_name} couldn't merged with
-                                    {pr.project.secondary_repo_name}. Failed with response `{status_code}`.
-                                    Reason is :{content.get('message')}"""
-                        log_activity(
-                            user=owner,
-                            activity=activity,
-                            project=pr.project,
-                            status=False,
-                        )
-                    break
-
-            if pr.project.secondary_repo_type == RepoTypeChoices.GITHUB.value:
-                # Get the number of comments existing in the PR online
-                response = sec_req.get(pr.url + "/comments")
-                secondary_comments = json.loads(response.content)
-
-                primary_response = pri_req.get(pri_req.url + "/comments")
-                primary_comments = json.loads(primary_response.content)
-
-                # Get's comments that are in the secondary that are not in the primary
-                comments_not_in_primary = []
-                for comment in secondary_comments:
-                    # Reduced comparable comment body
-                    sub_comment = {
-                        "body": comment["body"],
-                        "position": comment["position"],
-                        "commit_id": comment["commit_id"],
-                        "path": comment["path"],
-                        "start_line": comment["start_line"],
-                        "start_side": comment["start_side"],
-                        "line": comment["line"],
-                        "side": comment["side"],
-                    }
-                    # Run a loop going through all comments in the primary comments and ensuring they are the same
-                    counter = 0
-
-                    for pri_comment in primary_comments:
-                        sub_primary_comment = {
-                            "body": pri_comment["body"],
-                            "position": pri_comment["position"],
-                            "commit_id": pri_comment["commit_id"],
-                            "path": pri_comment["path"],
-                            "start_line": pri_comment["start_line"],
-                            "start_side": pri_comment["start_side"],
-                            "line": pri_comment["line"],
-                            "side": pri_comment["side"],
-                        }
-
-                        #  Compares the sub_comment with the primary comment. If they are the same,
-                        #  it increments the counter. If at the end of the loop there is no counter,
-                        #  it means the comment doesn't exist and it should be added
-
-                        if sub_comment == sub_primary_comment:
-                            counter += 1
-                            break
-
-                    if not counter:
-                        comments_not_in_primary.append(comment)
-
-                # Next we check if the length of the content (comments) matches the comment field
-                if comments_not_in_primary:
-                    # Update the primary PR with comments
-                    for comment in comments_not_in_primary:
-                        data = {
-                            "body": comment["body"],
-                            "position": comment["position"],
-                            "commit_id": comment["commit_id"],
-                            "path": comment["path"],
-                            "start_line": comment["start_line"],
-                            "start_side": comment["start_side"],
-                            "line": comment["line"],
-                            "side": comment["side"],
-                        }
-                        try:
-                            response = pri_req.post(data=data, json=True)
-                            status = response.status_code
-                            if status == 201:
-                                # Increment comments
-                                pr.comments = len(comments_not_in_primary)
-                                pr.save()
-                                # log_activity(user=user, activity=activity, project=project, status=status_)
-                        except AttributeError as err:
-                            logger.error(err)
-                            logger.critical(response)
+                activity = f"""`{owner}`; {pr.project.primary_repo_name} couldn't merged with
+                            {pr.project.secondary_repo_name}. Failed with response `{status_code}`."""
+                log_activity(
+                    user=owner,
+                    activity=activity,
+                    project=pr.project,
+                    status=False,
+                )
+            # Failed merges are tried again later, not on every tick
+            schedule_next_check(pr, active=False)
+            pr.save()
+            return True
+    else:
+        # Refresh Token
+        new_token = bitbucket_refresh_access_token(project)
+        new_header = {"Authorization": f"Bearer {new_token}"}
+
+        # checks if secondary PR is merged
+        req = MakeRequest(
+            secondary_url,
+            new_header,
+            conditional=True,
+            raise_errors=True,
+            priority=LOW_PRIORITY,
+        )
+        response = req.get()
+        content = response.json()
+
+        if content.get("state") == "MERGED":
+            # Here we merge the primary github account
+            merge_commit = content.get("merge_commit")["links"]
+            data = {
+                "commit_title": "Pull requests merged automatically.",
+                "commit_message": f"""This pull request has been merged from {pr.project.secondary_repo_name}
+                                    ({merge_commit['self']} and {merge_commit['html']})""",
+            }
+            response = merge_req.put(data, json=True, url=merge_req.url + "/merge")
+            status_code = response.status_code
+            if status_code == 200:
+                # Update Open PR History
+                pr.action = "merged"
+                pr.merged_at = content.get("updated_on")
+
+                activity = f"""`{owner}`; {pr.project.primary_repo_name} was automatically merged with
+                            {pr.project.secondary_repo_name}. Passed with response `{status_code}`"""
+                log_activity(
+                    user=owner,
+                    activity=activity,
+                    project=pr.project,
+                    status=True,
+                )
             else:
-                # Get number of comments existing in both Github and Bitbucket repositories
-                primary_response = pri_req.get(pri_req.url + "/comments")
-                primary_comments = json.loads(primary_response.content)
-
-                new_token = bitbucket_refresh_access_token(project)
-                header = {"Authorization": f"Bearer {new_token}"}
-                sec_req = MakeRequest(pr.url + "/comments?pagelen=100", headers=header)
-
-                response = sec_req.get()
-                secondary_comments = json.loads(response.content)
-
-                # Get's comments that are in the secondary that are not in the primary
-                comments_not_in_primary = []
-                for comment in secondary_comments["values"]:
-                    # Reduced comparable comment body
-                    sub_comment = comment.get("content")["html"]
-                    commit_id = comment.get("id")
-                    # Run a loop going through all comments in the primary comments and ensuring they are the same
-                    counter = 0
-
-                    if not primary_comments:
-                        # If there are no comments existing in the primary repository,
-                        # Add all secondary comments to the repository
-                        comments_not_in_primary.append(
-                            {"body": sub_comment, "commit_id": commit_id}
-                        )
-                    else:
-                        for pri_comment in primary_comments:
-                            primary_sub_comment = pri_comment.get("body")
-
-                            #  Compares the sub_comment with the primary comment. If they are the same,
-                            #  it increments the counter. If at the end of the loop there is no counter,
-                            #  it means the comment doesn't exist and it should be added
-
-                            if sub_comment == primary_sub_comment:
-                                counter += 1
-                                break
-
-                        if not counter:
-                            comments_not_in_primary.append(
-                                {"body": sub_comment, "commit_id": commit_id}
-                            )
-
-                # Next we check if the length of the content (comments) matches the comment field
-                if comments_not_in_primary:
-                    # Update the primary PR with comments
-                    for data in comments_not_in_primary:
+                content = response.json()
+                activity = f"""`{owner}`; {pr.project.primary_repo_name} couldn't merged with
+                            {pr.project.secondary_repo_name}. Failed with response `{status_code}`.
+                            Reason is :{content.get('message')}"""
+                log_activity(
+                    user=owner,
+                    activity=activity,
+                    project=pr.project,
+                    status=False,
+                )
+            # Failed merges are tried again later, not on every tick
+            schedule_next_check(pr, active=False)
+            pr.save()
+            return True
+
+    if pr.project.secondary_repo_type == RepoTypeChoices.GITHUB.value:
+        return sync_github_comments(pr, pri_req, sec_req)
+
+    new_token = bitbucket_refresh_access_token(project)
+    header = {"Authorization": f"Bearer {new_token}"}
+    sec_req = MakeRequest(
+        pr.url, header, conditional=True, raise_errors=True, priority=LOW_PRIORITY
+    )
+    return sync_bitbucket_comments(pr, pri_req, sec_req)
+
+
+@shared_task(bind=True, max_retries=None)
+def sync_pull_request(self, pr_id, status=None):
+    """Sync a single open PR.
+
+    At most COMMENT_SYNC_CONCURRENCY PRs are synced at once, others are
+    retried COMMENT_SYNC_MAX_RETRIES times, then left for the next
+    dispatch. The PR isn't dispatched again until its sync is over. The
+    review count of the looked up status is recorded once the sync is
+    complete, so PRs with comments left to retry aren't taken for idle.
+    """
+    for slot in range(settings.COMMENT_SYNC_CONCURRENCY):
+        with cache_lock(
+            f"comments:slot:{slot}", settings.COMMENT_SYNC_SLOT_TIMEOUT
+        ) as acquired:
+            if not acquired:
+                continue
+            pr = (
+                History.objects.select_related("project", "project__owner")
+                .filter(id=pr_id, action="open", merged_at=None)
+                .first()
+            )
+            try:
+                if pr:
+                    # Activities of the whole sync are written at once
+                    with buffered_activities():
                         try:
-                            response = pri_req.post(
-                                url=pri_req.url + "/comments", data=data, json=True
+                            complete = sync_pr(pr, status)
+                        except RequestException as err:
+                            # Poll again once the provider has recovered
+                            logger.warning("Sync of PR %s failed: %s", pr_id, err)
+                            countdown = settings.HTTP_BREAKER_COOLDOWN
+                            if isinstance(err, RateLimitedError):
+                                countdown = err.retry_in
+                            History.objects.filter(id=pr_id).update(
+                                next_check_at=timezone.now()
+                                + timedelta(seconds=countdown)
                             )
-                            status = response.status_code
-                            content = response.json()
-                            if status == 201:
-
-                                pr.comments = len(comments_not_in_primary)
-                                pr.save()
-                                activity = f"""`{owner}`; {pr.project.primary_repo_name} was automatically merged with
-                                            {pr.project.secondary_repo_name}. Passed with response `{status}`"""
-                                log_activity(
-                                    user=owner,
-                                    activity=activity,
-                                    project=pr.project,
-                                    status=True,
-                                )
-                            else:
-                                activity = f"""`{owner}`; {pr.project.primary_repo_name} wasn't merged with
-                                            {pr.project.secondary_repo_name}. Failed with response `{status}`"""
-                                log_activity(
-                                    user=owner,
-                                    activity=activity,
-                                    project=pr.project,
-                                    status=False,
-                                )
-                        except AttributeError as err:
-                            logger.error(err)
-                            logger.critical(response)
-                            log_activity(
-                                user=owner,
-                                activity=err,
-                                project=pr.project,
-                                status=True,
+                        except Exception:
+                            # Back off like an idle PR instead of failing on every tick
+                            schedule_next_check(pr, active=False)
+                            History.objects.filter(id=pr_id).update(
+                                next_check_at=pr.next_check_at,
+                                poll_interval=pr.poll_interval,
                             )
+                            raise
+                        else:
+                            if complete and status is not None:
+                                History.objects.filter(id=pr_id).update(
+                                    review_count=status["reviews"]
+                                )
+            finally:
+                # Crashed syncs don't hold the PR until COMMENT_SYNC_TIMEOUT
+                cache.delete(f"comments:pending:{pr_id}")
+            return
+    if self.request.retries >= settings.COMMENT_SYNC_MAX_RETRIES:
+        # The PR is still due, the next dispatch picks it up
+        cache.delete(f"comments:pending:{pr_id}")
+        return
+    raise self.retry(countdown=settings.COMMENT_SYNC_RETRY_DELAY)
+
+
+def free_sync_slots():
+    """Return how many PR syncs could start right now."""
+    keys = [
+        f"comments:slot:{slot}" for slot in range(settings.COMMENT_SYNC_CONCURRENCY)
+    ]
+    return len(keys) - len(cache.get_many(keys))
+
+
+def changed_pull_requests(prs):
+    """Split PRs into those worth a sync, with their status, and the idle ones.
+
+    The PRs of GitHub secondaries are looked up in batches of
+    GITHUB_STATUS_BATCH_SIZE, one GraphQL request each. Those that
+    aren't merged and got no review since their last sync are scheduled
+    for a later poll instead, those closed without a merge are marked
+    closed. PRs that couldn't be looked up are synced with an unknown
+    status.
+    """
+    changed, idle, closed = {}, [], []
+    github_prs = defaultdict(list)
+    for pr in prs:
+        if pr.project.secondary_repo_type == RepoTypeChoices.GITHUB.value:
+            github_prs[pr.project_id].append(pr)
+        else:
+            changed[pr] = None
+
+    size = settings.GITHUB_STATUS_BATCH_SIZE
+    for project_prs in github_prs.values():
+        token = crypt.decrypt(project_prs[0].project.secondary_repo_token)
+        for start in range(0, len(project_prs), size):
+            batch = project_prs[start : start + size]
+            try:
+                statuses = pull_request_statuses(token, [pr.url for pr in batch])
+            except RequestException as err:
+                logger.warning("Could not look up the status of PRs: %s", err)
+                statuses = {}
+            for pr in batch:
+                status = statuses.get(pr.url)
+                if status is None or status["merged"]:
+                    changed[pr] = status
+                elif status["state"] == "CLOSED":
+                    # Closed without a merge, there is nothing left to sync
+                    pr.action = "closed"
+                    pr.closed_at = status["closed_at"]
+                    closed.append(pr)
+                elif status["reviews"] != pr.review_count:
+                    changed[pr] = status
+                else:
+                    schedule_next_check(pr, active=False)
+                    idle.append(pr)
+
+    History.objects.bulk_update(idle, ["next_check_at", "poll_interval"])
+    History.objects.bulk_update(closed, ["action", "closed_at"])
+    return changed, idle
+
+
+def due_pull_requests():
+    """Return the open PRs that are due a poll."""
+    return History.objects.filter(
+        Q(next_check_at=None) | Q(next_check_at__lte=timezone.now()),
+        action="open",
+        merged_at=None,
+    )
+
+
+@shared_task()
+def check_new_comments():
+    """I'd get all Open PRs that have not been closed and are due a poll, and
+    dispatch a sync task for each of them that changed, so one slow PR doesn't
+    hold up the others.
+
+    Only as many PRs as there are free sync slots are dispatched, the
+    others stay due for the next run.
+    """
+    cache.delete(COMMENTS_CHECK_PENDING_KEY)
+    open_pr = due_pull_requests().select_related("project")
+
+    # PRs whose previous sync is still waiting for a slot are skipped
+    prs = [
+        pr
+        for pr in open_pr
+        if cache.add(f"comments:pending:{pr.id}", True, settings.COMMENT_SYNC_TIMEOUT)
+    ]
+    changed, _ = changed_pull_requests(prs)
+    changed = dict(list(changed.items())[: free_sync_slots()])
+    cache.delete_many([f"comments:pending:{pr.id}" for pr in prs if pr not in changed])
+    if changed:
+        group(
+            sync_pull_request.s(pr.id, status=status) for pr, status in changed.items()
+        ).apply_async()
+    return len(changed)
@@ -0,0 +1,40 @@
+"""Micro-benchmark of comment reconciliation.
+
+Run with ``python -m automate.tests.bench_reconcile``.
+"""
+import timeit
+from functools import partial
+
+from automate.reconcile import FINGERPRINT_FIELDS, missing_comments
+from automate.tests.test_reconcile import make_comment
+
+
+def pairwise_missing_comments(source, target):
+    """The previous nested loop comparison, kept as a baseline."""
+    missing = []
+    for comment in source:
+        sub_comment = {field: comment.get(field) for field in FINGERPRINT_FIELDS}
+        for other in target:
+            if sub_comment == {field: other.get(field) for field in FINGERPRINT_FIELDS}:
+                break
+        else:
+            missing.append(comment)
+    return missing
+
+
+def main():
+    """Time both strategies for growing numbers of comments."""
+    print(f"{'comments':>10} {'pairwise (s)':>14} {'indexed (s)':>13}")
+    for size in (100, 1000, 5000):
+        source = [make_comment(index) for index in range(size)]
+        target = [make_comment(index) for index in range(0, size, 2)]
+        runs = 3 if size <= 1000 else 1
+        pairwise = timeit.timeit(
+            partial(pairwise_missing_comments, source, target), number=runs
+        )
+        indexed = timeit.timeit(partial(missing_comments, source, target), number=runs)
+        print(f"{size:>10} {pairwise / runs:>14.4f} {indexed / runs:>13.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Time project searches over an owner with many projects.
+
+Searches go through ProjectSearchFilter, so they use the
+project_search index and the same ranking as the API.
+
+Run with ``python -m automate.tests.bench_search`` against a migrated
+database. The projects are created in a transaction that is rolled back.
+"""
+import os
+import statistics
+import time
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "repo.settings")
+django.setup()
+
+# pylint: disable=wrong-import-position
+from django.db import connection, transaction  # noqa: E402
+from faker import Faker  # noqa: E402
+from rest_framework.request import Request  # noqa: E402
+from rest_framework.test import APIRequestFactory  # noqa: E402
+
+from accounts.factories import UserFactory  # noqa: E402
+from automate.filtersets import ProjectSearchFilter  # noqa: E402
+from automate.models import Project  # noqa: E402
+
+PROJECTS = 50_000
+RUNS = 50
+PAGE_SIZE = 20
+TERMS = ("game", "dev", "mirror", "their pol")
+
+
+class Rollback(Exception):
+    """Raised to roll the benchmark data back."""
+
+
+def projects(owner):
+    """Return unsaved projects with realistic names."""
+    fake = Faker()
+    Faker.seed(0)
+    for index in range(PROJECTS):
+        name = f"{fake.word()}-{fake.word()}-{index}"
+        yield Project(
+            owner=owner,
+            name=name,
+            slug=name,
+            primary_repo_owner=fake.user_name(),
+            primary_repo_name=f"{fake.word()}-{fake.word()}",
+            primary_repo_token="",
+            primary_repo_url="",
+            base="main",
+            secondary_repo_owner=fake.user_name(),
+            secondary_repo_name=f"{fake.word()}-{fake.word()}",
+            secondary_repo_token="",
+            secondary_repo_url="",
+        )
+
+
+def search(owner, term):
+    """Return the first page of a search, the way the API runs it."""
+    request = Request(APIRequestFactory().get("/", {"search": term}))
+    queryset = ProjectSearchFilter().filter_queryset(
+        request, Project.objects.filter(owner=owner), None
+    )
+    return list(queryset.order_by(*ProjectSearchFilter.ordering)[:PAGE_SIZE])
+
+
+def main():
+    """Time every search term."""
+    try:
+        with transaction.atomic():
+            owner = UserFactory(email="bench-search@example.com")
+            Project.objects.bulk_create(projects(owner), batch_size=1000)
+            with connection.cursor() as cursor:
+                # Merge the pending list of the GIN index, as autovacuum would
+                cursor.execute("SELECT gin_clean_pending_list('project_search')")
+                cursor.execute("ANALYZE automate_project")
+
+            print(f"{PROJECTS} projects, median of {RUNS} runs")
+            print(f"{'search':>12} {'matches':>8} {'p50 (ms)':>9} {'max (ms)':>9}")
+            for term in TERMS:
+                timings = []
+                for _ in range(RUNS):
+                    start = time.perf_counter()
+                    results = search(owner, term)
+                    timings.append((time.perf_counter() - start) * 1000)
+                print(
+                    f"{term:>12} {len(results):>8} "
+                    f"{statistics.median(timings):>9.2f} {max(timings):>9.2f}"
+                )
+            raise Rollback
+    except Rollback:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Load test of the webhook endpoint under WSGI and ASGI workers.
+
+Every client sends its request headers, stalls like a slow network
+would, then sends the body. A threaded WSGI worker holds a thread for
+each of these connections, the ASGI worker holds them on its event loop.
+
+Run with ``python -m automate.tests.bench_webhooks`` against a migrated
+database. A project is created for the run and deleted afterwards.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "repo.settings")
+django.setup()
+
+# pylint: disable=wrong-import-position
+from automate.factories import ProjectFactory  # noqa: E402
+from automate.webhooks import webhook_secret  # noqa: E402
+
+CLIENTS = 200
+STALL = 0.5
+SERVERS = {
+    "wsgi (gthread, 10 threads)": [
+        "repo.wsgi:application",
+        "--worker-class=gthread",
+        "--threads=10",
+    ],
+    "asgi (uvicorn)": [
+        "repo.asgi:application",
+        "--worker-class=uvicorn.workers.UvicornWorker",
+    ],
+}
+
+
+def free_port():
+    """Return a free local port."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, port):
+    """Start a single gunicorn worker and wait until it accepts connections."""
+    # An in-memory broker keeps a missing Redis out of the timings
+    env = {
+        **os.environ,
+        "CELERY_BROKER_URL": "memory://",
+        "CELERY_RESULT_BACKEND": "cache+memory://",
+    }
+    process = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, "-m", "gunicorn", f"--config={os.devnull}", "--workers=1"]
+        + [f"--bind=127.0.0.1:{port}"]
+        + args,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The server did not start")
+
+
+def delivery(project, pr_id):
+    """Return the signed headers and body of a closed PR event."""
+    body = json.dumps(
+        {
+            "action": "closed",
+            "pull_request": {
+                "id": pr_id,
+                "url": f"https://api.github.com/repos/fidepad/repo/pulls/{pr_id}",
+                "title": "Load test",
+                "body": "",
+                "head": {"ref": f"feature-{pr_id}", "repo": {"name": "repo"}},
+            },
+        }
+    ).encode()
+    digest = hmac.new(
+        webhook_secret(project.id).encode(), body, hashlib.sha256
+    ).hexdigest()
+    headers = (
+        f"POST /projects/{project.slug}/webhook/ HTTP/1.1\r\n"
+        "Host: 127.0.0.1\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"X-Hub-Signature-256: sha256={digest}\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode()
+    return headers, body
+
+
+async def send(port, headers, body):
+    """Send a delivery slowly and return its response status and latency."""
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(headers)
+    await writer.drain()
+    await asyncio.sleep(STALL)
+    writer.write(body)
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1]), time.perf_counter() - start
+
+
+async def load(port, deliveries):
+    """Send every delivery at once and return their statuses and latencies."""
+    return await asyncio.gather(
+        *(send(port, headers, body) for headers, body in deliveries)
+    )
+
+
+def main():
+    """Time the same burst of deliveries against both servers."""
+    project = ProjectFactory()
+    print(f"{CLIENTS} clients stalling {STALL}s each")
+    print(
+        f"{'server':>28} {'seconds':>8} {'deliveries/s':>13} "
+        f"{'p50 (s)':>8} {'p95 (s)':>8} {'accepted':>9}"
+    )
+    try:
+        for offset, (name, args) in enumerate(SERVERS.items()):
+            port = free_port()
+            server = start_server(args, port)
+            try:
+                deliveries = [
+                    delivery(project, offset * CLIENTS + index)
+                    for index in range(CLIENTS)
+                ]
+                start = time.perf_counter()
+                results = asyncio.run(load(port, deliveries))
+                elapsed = time.perf_counter() - start
+            finally:
+                server.terminate()
+                server.wait()
+            accepted = [status for status, _ in results].count(202)
+            latencies = sorted(latency for _, latency in results)
+            p50 = latencies[len(latencies) // 2]
+            p95 = latencies[int(len(latencies) * 0.95)]
+            print(
+                f"{name:>28} {elapsed:>8.2f} {CLIENTS / elapsed:>13.1f} "
+                f"{p50:>8.2f} {p95:>8.2f} {accepted:>9}"
+            )
+    finally:
+        project.owner.delete()
+
+
+if __name__ == "__main__":
+    main()
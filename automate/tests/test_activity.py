@@ -0,0 +1,75 @@
+from unittest.mock import patch
+
+from django.test import override_settings
+from kombu.exceptions import OperationalError
+
+from automate.activity import buffered_activities, log_activity, store_activities
+from automate.factories import ProjectFactory
+from automate.models import ProjectActivities
+from repo.testing.model import BaseModelTestCase
+
+
+class ActivityTestCase(BaseModelTestCase):
+    """Test class for logging project activities."""
+
+    def setUp(self):
+        self.project = ProjectFactory()
+
+    def log(self, activity, status=True):
+        """Log an activity of the test project."""
+        log_activity(
+            user=self.project.owner,
+            activity=activity,
+            project=self.project,
+            status=status,
+        )
+
+    def test_unbuffered_activities_are_written_right_away(self):
+        """Assert an activity logged outside a buffer is written at once."""
+        with self.assertNumQueries(1):
+            self.log("merged")
+        self.assertEqual(
+            list(ProjectActivities.objects.values_list("action", "status")),
+            [("merged", True)],
+        )
+
+    def test_buffered_activities_are_written_in_one_query(self):
+        """Assert activities of a block, nested ones included, are inserted
+        together when it exits."""
+        with self.assertNumQueries(1):
+            with buffered_activities():
+                self.log("first")
+                with buffered_activities():
+                    self.log(ValueError("second"), status=None)
+        self.assertEqual(
+            set(ProjectActivities.objects.values_list("action", "status")),
+            {("first", True), ("second", False)},
+        )
+
+    def test_activities_are_written_when_the_block_fails(self):
+        """Assert activities logged before an exception are kept."""
+        with self.assertRaises(RuntimeError):
+            with buffered_activities():
+                self.log("before")
+                raise RuntimeError
+        self.assertTrue(ProjectActivities.objects.filter(action="before").exists())
+
+    @override_settings(ACTIVITY_SINK="queue")
+    @patch("automate.activity.store_activities.delay")
+    def test_queued_activities(self, delay_mock):
+        """Assert a buffer is sent through the broker as one batch, and written
+        directly when the broker is down."""
+        with self.assertNumQueries(0):
+            with buffered_activities():
+                self.log("first")
+                self.log("second")
+        records = delay_mock.call_args.args[0]
+        self.assertEqual([record["action"] for record in records], ["first", "second"])
+
+        store_activities.run(records)
+        self.assertEqual(ProjectActivities.objects.count(), 2)
+
+        with self.subTest("Broker down"):
+            delay_mock.side_effect = OperationalError
+            self.log("third")
+            self.assertTrue(ProjectActivities.objects.filter(action="third").exists())
@@ -0,0 +1,59 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from automate.encryptor import Crypt, SecretCache
+
+
+class CryptTestCase(TestCase):
+    """Test class for the credential encryptor."""
+
+    def setUp(self):
+        self.crypt = Crypt("test-key")
+
+    def test_fernet_is_shared_per_key(self):
+        """Assert instances with the same key share one Fernet."""
+        self.assertIs(Crypt("test-key").fernet, self.crypt.fernet)
+        self.assertIsNot(Crypt("other-key").fernet, self.crypt.fernet)
+
+    def test_decrypted_secrets_are_cached(self):
+        """Assert a ciphertext is only decrypted once."""
+        ciphertext = self.crypt.encrypt("token")
+        with patch.object(
+            self.crypt.fernet, "decrypt", wraps=self.crypt.fernet.decrypt
+        ) as decrypt_mock:
+            self.assertEqual(self.crypt.decrypt(ciphertext), "token")
+            self.assertEqual(self.crypt.decrypt(ciphertext), "token")
+        decrypt_mock.assert_called_once()
+
+    def test_multi_encrypt(self):
+        """Assert only provided credentials are encrypted."""
+        messages = self.crypt.multi_encrypt({"client_id": "id", "client_secret": None})
+        self.assertIsNone(messages["client_secret"])
+        self.assertNotEqual(messages["client_id"], "id")
+        self.assertEqual(self.crypt.multi_decrypt(messages)["client_id"], "id")
+
+
+class SecretCacheTestCase(TestCase):
+    """Test class for the decrypted secret cache."""
+
+    def test_least_recently_used_secrets_are_evicted(self):
+        """Assert the cache keeps at most size secrets."""
+        secrets = SecretCache(size=2, timeout=60)
+        secrets.set("a", "1")
+        secrets.set("b", "2")
+        secrets.get("a")
+        secrets.set("c", "3")
+        self.assertEqual(secrets.get("a"), "1")
+        self.assertIsNone(secrets.get("b"))
+        self.assertEqual(secrets.get("c"), "3")
+
+    @patch("automate.encryptor.time.monotonic")
+    def test_secrets_expire(self, monotonic_mock):
+        """Assert secrets are forgotten after the timeout."""
+        secrets = SecretCache(size=2, timeout=60)
+        monotonic_mock.return_value = 100
+        secrets.set("a", "1")
+        monotonic_mock.return_value = 159
+        self.assertEqual(secrets.get("a"), "1")
+        monotonic_mock.return_value = 160
+        self.assertIsNone(secrets.get("a"))
@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+from django.test import override_settings
+from git import Repo
+
+from automate.choices import ReplicationModeChoices, RepoTypeChoices
+from automate.encryptor import crypt
+from automate.factories import ProjectFactory
+from automate.gitremote import GitRemote
+from repo.testing.model import BaseModelTestCase
+
+
+class GitRemoteTestCase(BaseModelTestCase):
+    """Test class for replicating a PR branch between local repositories."""
+
+    def setUp(self):
+        root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root)
+        self.mirror_root = str(root / "mirrors")
+
+        self.origin = Repo.init(root / "origin")
+        with self.origin.config_writer() as config:
+            config.set_value("user", "name", "Repo Automator")
+            config.set_value("user", "email", "automator@example.com")
+            config.set_value("uploadpack", "allowFilter", "true")
+        for name in ("README.md", "setup.py", "main.py"):
+            self.commit(name)
+        self.origin.git.branch("feature")
+        self.secondary = Repo.init(root / "secondary", bare=True)
+
+        self.project = ProjectFactory(
+            primary_repo_url=self.origin.working_dir,
+            primary_repo_type=RepoTypeChoices.GITHUB,
+            primary_repo_token=crypt.encrypt("primary-token"),
+            secondary_repo_url=self.secondary.git_dir,
+            secondary_repo_type=RepoTypeChoices.GITHUB,
+            secondary_repo_token=crypt.encrypt("secondary-token"),
+        )
+        self.data = {
+            "action": "closed",
+            "pull_request": {
+                "url": "https://api.github.com/repos/fidepad/primary/pulls/1",
+                "title": "Feature",
+                "body": "",
+                "head": {"ref": "feature", "repo": {"name": "primary"}},
+            },
+        }
+
+    def commit(self, name):
+        """Commit a file to the origin repository."""
+        with open(
+            os.path.join(self.origin.working_dir, name), "w", encoding="utf-8"
+        ) as file:
+            file.write(name)
+        self.origin.index.add([name])
+        return self.origin.index.commit(f"Add {name}")
+
+    def assert_replicated(self):
+        """Assert the PR branch reached the secondary repository."""
+        self.assertEqual(
+            self.secondary.commit("refs/heads/feature").hexsha,
+            self.origin.commit("feature").hexsha,
+        )
+
+    @patch("automate.gitremote.GitRemote.make_pr")
+    def test_run_from_mirror(self, make_pr_mock):
+        """Assert the branch is pushed from the project's mirror."""
+        with override_settings(
+            GIT_MIRROR_ROOT=self.mirror_root,
+            GIT_REPLICATION_MODE=ReplicationModeChoices.MIRROR,
+        ):
+            with self.assertLogs("automate.metrics") as logs:
+                GitRemote(self.project, self.data).run()
+
+        self.assert_replicated()
+        self.assertTrue(make_pr_mock.called)
+        self.assertTrue(os.path.isdir(f"{self.mirror_root}/{self.project.id}.git"))
+
+        with self.subTest("Phase timings and transfer sizes are reported"):
+            metrics = json.loads(logs.records[0].args[0])
+            self.assertEqual(metrics["project_id"], self.project.id)
+            self.assertEqual(metrics["status"], "ok")
+            self.assertEqual(
+                set(metrics["phases"]), {"clone", "checkout", "push", "make_pr"}
+            )
+            self.assertEqual(metrics["received"]["objects"], 9)
+            self.assertEqual(metrics["sent"]["objects"], 9)
+            self.assertGreater(metrics["sent"]["bytes"], 0)
+
+    @patch("automate.gitremote.GitRemote.make_pr")
+    def test_run_refs_only(self, make_pr_mock):
+        """Assert only the PR branch is fetched and pushed without a working
+        tree."""
+        with override_settings(
+            GIT_MIRROR_ROOT=self.mirror_root,
+            GIT_REPLICATION_MODE=ReplicationModeChoices.REFS,
+            GIT_FETCH_FILTER="blob:none",
+            GIT_FETCH_DEPTH=1,
+        ):
+            git = GitRemote(self.project, self.data)
+            git.run()
+
+        # A shallow push is refused by the empty secondary, so the history is fetched before retrying
+        self.assert_replicated()
+        self.assertTrue(make_pr_mock.called)
+        self.assertFalse(os.path.exists(self.mirror_root))
+        self.assertEqual(
+            self.secondary.git.branch("--format=%(refname)"), "refs/heads/feature"
+        )
+
+    def test_unshallow_fetches_the_branch_only(self):
+        """Assert the history fetched for a refused shallow push is the PR
+        branch's only."""
+        self.origin.git.checkout("-b", "other")
+        self.commit("other.py")
+        self.origin.create_tag("v1")
+        self.origin.git.checkout("-")
+
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        with override_settings(GIT_FETCH_DEPTH=1):
+            git = GitRemote(self.project, self.data)
+            git.fetch_ref(temp_dir)
+            git.push()
+
+        self.assert_replicated()
+        self.assertEqual(
+            git.repository.git.rev_parse("--is-shallow-repository"), "false"
+        )
+        refs = git.repository.git.for_each_ref("--format=%(refname)").split()
+        self.assertNotIn("refs/heads/other", refs)
+        self.assertNotIn("refs/remotes/origin/other", refs)
+        self.assertNotIn("refs/tags/v1", refs)
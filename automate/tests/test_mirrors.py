@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from git import Repo
+
+from automate.mirrors import MirrorStore
+
+
+class MirrorStoreTestCase(TestCase):
+    """Test class for the git mirror store."""
+
+    def setUp(self):
+        root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root)
+
+        self.origin = Repo.init(root / "origin")
+        with self.origin.config_writer() as config:
+            config.set_value("user", "name", "Repo Automator")
+            config.set_value("user", "email", "automator@example.com")
+        self.commit("README.md", "Hello")
+        self.origin.git.branch("feature")
+
+        self.root = root / "mirrors"
+        self.store = MirrorStore(root=self.root, quota=10 * 1024**2)
+
+    def commit(self, name, content):
+        """Commit a file to the origin repository."""
+        with open(
+            os.path.join(self.origin.working_dir, name), "w", encoding="utf-8"
+        ) as file:
+            file.write(content)
+        self.origin.index.add([name])
+        return self.origin.index.commit(f"Add {name}")
+
+    def test_sync_creates_and_updates_mirror(self):
+        """Assert sync creates a bare mirror and fetches new commits
+        incrementally."""
+        mirror = self.store.sync(1, self.origin.working_dir)
+        self.assertTrue(mirror.bare)
+        self.assertEqual(
+            mirror.commit("refs/heads/feature").hexsha,
+            self.origin.commit("feature").hexsha,
+        )
+
+        with self.subTest("New commits are fetched into the existing mirror"):
+            self.origin.git.checkout("feature")
+            commit = self.commit("feature.txt", "feature")
+            mirror = self.store.sync(1, self.origin.working_dir)
+            self.assertEqual(mirror.commit("refs/heads/feature").hexsha, commit.hexsha)
+
+        with self.subTest("Credentials are not stored in the mirror"):
+            with mirror.config_reader() as config:
+                self.assertFalse(
+                    any(section.startswith("remote") for section in config.sections())
+                )
+
+    def test_evict_least_recently_used(self):
+        """Assert the oldest mirrors are evicted once over quota."""
+        for project_id in (1, 2, 3):
+            self.store.sync(project_id, self.origin.working_dir)
+            path = self.store.path_for(project_id)
+            os.utime(path, (project_id, project_id))
+        size = self.store.disk_usage(self.store.path_for(1))
+
+        self.store = MirrorStore(root=self.root, quota=size * 2)
+        self.store.evict()
+        self.assertFalse(self.store.path_for(1).exists())
+        self.assertTrue(self.store.path_for(2).exists())
+        self.assertTrue(self.store.path_for(3).exists())
+
+        with self.subTest("The kept and locked mirrors are never evicted"):
+            self.store = MirrorStore(root=self.root, quota=0)
+            with self.store.lock(3):
+                self.store.evict(keep=2)
+            self.assertTrue(self.store.path_for(2).exists())
+            self.assertTrue(self.store.path_for(3).exists())
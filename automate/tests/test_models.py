@@ -1,7 +1,14 @@
 from django.conf import settings
+from django.db import connection
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
 
 from automate.choices import RepoTypeChoices
 from automate.factories import ProjectFactory
+from automate.filtersets import ProjectSearchFilter
+from automate.models import Project
+from automate.tasks import claimable_webhook_events, due_pull_requests
+from repo.pagination import CreatedCursorPagination
 from repo.testing.model import BaseModelTestCase
 
 
@@ -24,3 +31,42 @@ class ProjectTestCase(BaseModelTestCase):
             settings.BITBUCKET_BASE_URL
             + f"/repositories/{project.primary_repo_owner}/{project.primary_repo_name}/hooks",
         )
+
+
+class QueryPlanTestCase(BaseModelTestCase):
+    """Test that the hot queries are served by an index."""
+
+    def setUp(self):
+        self.project = ProjectFactory()
+        ordering = CreatedCursorPagination.ordering
+        # The queries the tasks run, not copies of them
+        self.queries = {
+            "history_open_unmerged": due_pull_requests().select_related("project"),
+            "project_owner_created": Project.objects.filter(
+                owner=self.project.owner
+            ).order_by(*ordering),
+            "history_project_created": self.project.history_set.order_by(*ordering),
+            "activity_project_created": self.project.projectactivities_set.order_by(
+                *ordering
+            ),
+            "project_search": ProjectSearchFilter().filter_queryset(
+                Request(APIRequestFactory().get("/", {"search": "repo auto"})),
+                Project.objects.all(),
+                None,
+            ),
+            "webhook_event_queue": claimable_webhook_events().values_list(
+                "id", "project_id"
+            )[: settings.WEBHOOK_DRAIN_BATCH_SIZE],
+        }
+
+    def test_hot_queries_use_their_index(self):
+        """Test the hot queries do not fall back to sequential scans."""
+        with connection.cursor() as cursor:
+            # Tables of a test database are tiny, only a missing index should
+            # make the planner scan them
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        for index, queryset in self.queries.items():
+            with self.subTest(index=index):
+                plan = queryset.explain()
+                self.assertNotIn("Seq Scan", plan)
+                self.assertIn(index, plan)
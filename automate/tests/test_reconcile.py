@@ -0,0 +1,69 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from automate.reconcile import fingerprint, missing_comments
+
+
+def make_comment(index, **kwargs):
+    """Return a GitHub shaped review comment."""
+    comment = {
+        "id": index,
+        "body": f"Comment {index}",
+        "path": f"app/module_{index % 20}.py",
+        "line": index % 300,
+        "side": "RIGHT",
+        "commit_id": "6dcb09b5b57875f334f61aebed695e2e4193db5e",
+        "position": index % 300,
+    }
+    comment.update(kwargs)
+    return comment
+
+
+class FingerprintTestCase(TestCase):
+    """Test class for comment fingerprints."""
+
+    def test_fingerprint(self):
+        """Assert fingerprints only depend on the identifying fields."""
+        comment = make_comment(1)
+        self.assertEqual(fingerprint(comment), fingerprint(make_comment(1, id=99)))
+        self.assertNotEqual(fingerprint(comment), fingerprint(make_comment(1, line=2)))
+        self.assertNotEqual(
+            fingerprint(comment), fingerprint(make_comment(1, body="Changed"))
+        )
+
+        with self.subTest("Missing fields count as None"):
+            self.assertEqual(
+                fingerprint({"body": "Hi"}, fields=("body", "path")),
+                fingerprint({"body": "Hi", "path": None}, fields=("body", "path")),
+            )
+
+    def test_missing_comments(self):
+        """Assert only the comments absent from the target are returned, in
+        order."""
+        source = [make_comment(index) for index in range(5)]
+        target = [make_comment(1, id=11), make_comment(3, id=13)]
+        missing = missing_comments(source, target)
+        self.assertEqual([comment["id"] for comment in missing], [0, 2, 4])
+
+        with self.subTest("Everything is missing from an empty target"):
+            self.assertEqual(missing_comments(source, []), source)
+
+        with self.subTest("Comments can be matched on a subset of fields"):
+            bitbucket = [{"body": "Comment 1", "commit_id": 7}, {"body": "New"}]
+            missing = missing_comments(bitbucket, target, fields=("body",))
+            self.assertEqual(missing, [{"body": "New"}])
+
+    def test_missing_comments_scales_linearly(self):
+        """Assert each comment is fingerprinted once, instead of once per pair
+        of comments.
+
+        Timings are left to ``bench_reconcile``.
+        """
+        source = [make_comment(index) for index in range(5000)]
+        target = [make_comment(index) for index in range(0, 5000, 2)]
+
+        with patch("automate.reconcile.fingerprint", wraps=fingerprint) as mock:
+            missing = missing_comments(source, target)
+
+        self.assertEqual(len(missing), 2500)
+        self.assertEqual(mock.call_count, len(source) + len(target))
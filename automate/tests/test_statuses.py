@@ -0,0 +1,85 @@
+import json
+import os
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from automate.statuses import pull_request_statuses
+from repo.testing.server import LocalHTTPSServer
+
+
+def graphql_stand_in(pull_requests):
+    """Return a respond callable answering status queries like GitHub's GraphQL
+    API, from the pull requests by (owner, name, number)."""
+
+    def respond(handler):
+        _, path, _, body = handler.server.requests[-1]
+        if path != "/graphql":
+            return 404, {}, {"message": "Not Found"}
+        variables = json.loads(body)["variables"]
+        data, errors = {}, []
+        for key in variables:
+            if not key.startswith("number"):
+                continue
+            index = key[len("number") :]
+            repo = (variables[f"owner{index}"], variables[f"name{index}"])
+            pull_request = pull_requests.get((*repo, variables[key]))
+            data[f"pr{index}"] = pull_request and {"pullRequest": pull_request}
+            if pull_request is None:
+                errors.append({"type": "NOT_FOUND", "path": [f"pr{index}"]})
+        return 200, {}, {"data": data, "errors": errors}
+
+    return respond
+
+
+class TestPullRequestStatuses(SimpleTestCase):
+    """This tests the batched lookup of GitHub pull request statuses."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_statuses_are_fetched_in_one_request(self):
+        """Assert the statuses of many PRs come from a single GraphQL query."""
+        pull_requests = {
+            ("fidepad", "repo", number): {
+                "merged": number == 1,
+                "state": "MERGED" if number == 1 else "OPEN",
+                "closedAt": "2023-01-22T10:00:00Z" if number == 1 else None,
+                "reviews": {"totalCount": number},
+            }
+            for number in range(1, 51)
+        }
+        urls = [
+            f"https://api.github.com/repos/fidepad/repo/pulls/{number}"
+            for number in range(1, 52)
+        ]
+        with LocalHTTPSServer(graphql_stand_in(pull_requests)) as server:
+            with patch.dict(os.environ, {"REQUESTS_CA_BUNDLE": server.ca_bundle}):
+                with override_settings(GITHUB_BASE_URL=server.url):
+                    statuses = pull_request_statuses("token", urls)
+
+        self.assertEqual(len(server.requests), 1)
+        method, _, headers, _ = server.requests[0]
+        self.assertEqual(method, "POST")
+        self.assertEqual(headers["Authorization"], "Bearer token")
+        self.assertEqual(
+            statuses[urls[0]],
+            {
+                "merged": True,
+                "state": "MERGED",
+                "closed_at": "2023-01-22T10:00:00Z",
+                "reviews": 1,
+            },
+        )
+        self.assertEqual(
+            statuses[urls[49]],
+            {"merged": False, "state": "OPEN", "closed_at": None, "reviews": 50},
+        )
+        # PRs GitHub doesn't know are left to the REST lookup
+        self.assertEqual(len(statuses), 50)
+        self.assertNotIn(urls[50], statuses)
+
+        with self.subTest("Urls that aren't GitHub PRs aren't asked for"):
+            urls = ["https://api.bitbucket.org/2.0/repositories/w/r/pullrequests/1"]
+            self.assertEqual(pull_request_statuses("token", urls), {})
@@ -0,0 +1,493 @@
+import json
+from datetime import timedelta
+from unittest.mock import Mock, patch
+
+from celery.exceptions import Retry
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from faker import Faker
+from git import GitCommandError
+from requests import Response
+
+from automate.choices import RepoTypeChoices, WebhookEventStatusChoices
+from automate.encryptor import crypt
+from automate.factories import ProjectFactory
+from automate.models import History, SyncedComment, WebhookEvent
+from automate.tasks import (
+    check_new_comments,
+    claim_webhook_events,
+    drain_webhook_events,
+    process_webhook_events,
+    purge_webhook_events,
+    sync_github_comments,
+    sync_pr,
+    sync_pull_request,
+)
+from repo.testing.model import BaseModelTestCase
+from repo.utils import CircuitOpenError, cache_lock
+
+fake = Faker()
+
+
+class WebhookInboxTestCase(BaseModelTestCase):
+    """Test class for draining the webhook inbox."""
+
+    def setUp(self):
+        cache.clear()
+        self.project = ProjectFactory()
+        self.data = {
+            "action": "closed",
+            "pull_request": {"id": fake.random_number(9), "head": {"ref": "feature"}},
+        }
+
+    def add_events(self, project, count=1, **data):
+        """Write webhook events of a project to the inbox."""
+        return [
+            WebhookEvent.objects.create(project=project, payload={**self.data, **data})
+            for _ in range(count)
+        ]
+
+    @patch("automate.tasks.process_webhook_events.delay")
+    def test_events_are_claimed_once_in_project_batches(self, delay_mock):
+        """Assert a drain queues one job per project with its events."""
+        events = self.add_events(self.project, 2)
+        other = self.add_events(ProjectFactory())
+
+        self.assertEqual(drain_webhook_events(), 3)
+        self.assertCountEqual(
+            [call.args for call in delay_mock.call_args_list],
+            [
+                (self.project.id, [event.id for event in events]),
+                (other[0].project_id, [other[0].id]),
+            ],
+        )
+        self.assertFalse(
+            WebhookEvent.objects.filter(
+                status=WebhookEventStatusChoices.PENDING
+            ).exists()
+        )
+        self.assertEqual(drain_webhook_events(), 0)
+
+        with self.subTest("Abandoned claims are drained again"):
+            WebhookEvent.objects.filter(id=other[0].id).update(
+                claimed_at=timezone.now() - timedelta(days=1)
+            )
+            self.assertEqual(drain_webhook_events(), 1)
+
+    @patch("automate.tasks.GitRemote")
+    def test_jobs_of_a_project_run_one_at_a_time(self, git_mock):
+        """Assert a job waits while another job holds the project."""
+        events = self.add_events(self.project, 2) + self.add_events(
+            self.project, action="opened"
+        )
+        event_ids = [event.id for event in events]
+        WebhookEvent.objects.update(status=WebhookEventStatusChoices.CLAIMED)
+
+        with cache_lock(f"gitremote:lock:{self.project.id}", 60):
+            with self.assertRaises(Retry):
+                process_webhook_events.run(self.project.id, event_ids)
+        self.assertFalse(git_mock.called)
+
+        process_webhook_events.run(self.project.id, event_ids)
+        # Duplicate events of a PR branch are replicated once
+        self.assertEqual(git_mock.call_count, 2)
+        self.assertEqual(
+            WebhookEvent.objects.filter(
+                status=WebhookEventStatusChoices.PROCESSED
+            ).count(),
+            3,
+        )
+
+        with self.subTest("Failed events are retried, then recorded"):
+            event = self.add_events(self.project)[0]
+            git_mock.return_value.run.side_effect = GitCommandError("push")
+            for attempt in range(1, 4):
+                WebhookEvent.objects.filter(id=event.id).update(
+                    status=WebhookEventStatusChoices.CLAIMED
+                )
+                with override_settings(WEBHOOK_MAX_ATTEMPTS=3):
+                    process_webhook_events.run(self.project.id, [event.id])
+                event.refresh_from_db()
+                self.assertEqual(event.attempts, attempt)
+                if attempt == 1:
+                    self.assertEqual(event.status, WebhookEventStatusChoices.PENDING)
+                    # It waits for its retry before being drained again
+                    self.assertGreater(event.retry_at, timezone.now())
+                    self.assertEqual(claim_webhook_events(10), {})
+            self.assertEqual(event.status, WebhookEventStatusChoices.FAILED)
+
+        with self.subTest("Processed events are purged after the retention"):
+            WebhookEvent.objects.filter(id=event_ids[0]).update(
+                created_at=timezone.now() - timedelta(days=30)
+            )
+            self.assertEqual(purge_webhook_events(), 1)
+            self.assertEqual(WebhookEvent.objects.count(), 3)
+
+
+def make_response(status_code, data):
+    """Return a requests response holding data as JSON."""
+    response = Response()
+    response.status_code = status_code
+    response._content = json.dumps(data).encode()  # pylint: disable=protected-access
+    return response
+
+
+class SyncCommentsTestCase(BaseModelTestCase):
+    """Test class for copying secondary PR comments to the primary PR."""
+
+    def setUp(self):
+        project = ProjectFactory(secondary_repo_type=RepoTypeChoices.GITHUB)
+        self.pr = History.objects.create(
+            project=project,
+            pr_id=1,
+            action="open",
+            url="https://api.github.com/repos/secondary/repo/pulls/1",
+            primary_url="https://api.github.com/repos/primary/repo/pulls/1",
+            author="automator",
+        )
+        self.comments = [
+            self.make_comment(1, "Looks good", "2023-01-22T10:00:00Z"),
+            self.make_comment(2, "Rename this", "2023-01-22T11:00:00Z"),
+        ]
+        self.pri_req = Mock(url=self.pr.primary_url)
+        self.sec_req = Mock(url=self.pr.url)
+
+    @staticmethod
+    def make_comment(comment_id, body, updated_at):
+        """Return a GitHub review comment."""
+        return {
+            "id": comment_id,
+            "body": body,
+            "position": 1,
+            "commit_id": "6dcb09b",
+            "path": "README.md",
+            "start_line": None,
+            "start_side": None,
+            "line": 1,
+            "side": "RIGHT",
+            "updated_at": updated_at,
+        }
+
+    def test_sync_github_comments(self):
+        """Assert only new comments are posted and the cursor advances."""
+        self.sec_req.get.return_value = make_response(200, self.comments)
+        # The first comment was copied before comment ids were recorded
+        self.pri_req.get.return_value = make_response(200, self.comments[:1])
+        self.pri_req.post.return_value = make_response(201, {"id": 500})
+
+        sync_github_comments(self.pr, self.pri_req, self.sec_req)
+
+        self.assertEqual(self.pri_req.post.call_count, 1)
+        self.assertEqual(
+            self.pri_req.post.call_args.kwargs["data"]["body"], "Rename this"
+        )
+        self.assertEqual(
+            dict(
+                self.pr.synced_comments.values_list(
+                    "secondary_comment_id", "primary_comment_id"
+                )
+            ),
+            {1: None, 2: 500},
+        )
+        self.pr.refresh_from_db()
+        self.assertEqual(
+            self.pr.comments_synced_at.isoformat(), "2023-01-22T11:00:00+00:00"
+        )
+        self.assertEqual(self.pr.comments, 1)
+
+        with self.subTest("Later runs only ask for updated comments"):
+            self.pri_req.reset_mock()
+            sync_github_comments(self.pr, self.pri_req, self.sec_req)
+            url = self.sec_req.get.call_args.args[0]
+            self.assertIn("since=2023-01-22T11%3A00%3A00Z", url)
+            self.assertFalse(self.pri_req.get.called)
+            self.assertFalse(self.pri_req.post.called)
+
+    def test_idle_prs_are_polled_less_often(self):
+        """Assert the poll interval doubles while a PR is idle and resets once
+        a comment changes."""
+        self.sec_req.get.return_value = make_response(200, self.comments)
+        self.pri_req.get.return_value = make_response(200, self.comments)
+
+        intervals = []
+        for _ in range(3):
+            sync_github_comments(self.pr, self.pri_req, self.sec_req)
+            intervals.append(self.pr.poll_interval)
+        self.pr.refresh_from_db()
+        self.assertEqual(intervals, [60, 120, 240])
+        self.assertAlmostEqual(
+            (self.pr.next_check_at - timezone.now()).total_seconds(), 240, delta=5
+        )
+
+        with override_settings(COMMENT_POLL_MAX_INTERVAL=300):
+            sync_github_comments(self.pr, self.pri_req, self.sec_req)
+            self.assertEqual(self.pr.poll_interval, 300)
+
+        self.sec_req.get.return_value = make_response(
+            200, [self.make_comment(3, "Done", "2023-01-22T12:00:00Z")]
+        )
+        self.pri_req.post.return_value = make_response(201, {"id": 501})
+        sync_github_comments(self.pr, self.pri_req, self.sec_req)
+        self.assertEqual(self.pr.poll_interval, 60)
+
+    def test_sync_queries_do_not_grow_with_comments(self):
+        """Assert posting more comments only costs their claims."""
+        self.pri_req.get.return_value = make_response(200, [])
+        self.pri_req.post.side_effect = lambda **kwargs: make_response(
+            201, {"id": kwargs["data"]["body"]}
+        )
+
+        queries = []
+        for start, count in ((10, 1), (20, 3)):
+            comments = [
+                self.make_comment(start + index, start + index, "2023-01-22T10:00:00Z")
+                for index in range(count)
+            ]
+            self.sec_req.get.return_value = make_response(200, comments)
+            self.pr.comments_synced_at = None
+            with CaptureQueriesContext(connection) as context:
+                sync_github_comments(self.pr, self.pri_req, self.sec_req)
+            # get_or_create selects and inserts in a savepoint
+            queries.append(len(context) - 4 * count)
+
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(self.pr.comments, 4)
+
+    def test_every_page_is_synced(self):
+        """Assert the cursor only advances once every page of comments was
+        fetched."""
+        first_page = make_response(200, self.comments[:1])
+        next_url = self.pr.url + "/comments?per_page=100&page=2"
+        first_page.headers["Link"] = f'<{next_url}>; rel="next"'
+        self.sec_req.get.side_effect = [
+            first_page,
+            make_response(200, self.comments[1:]),
+        ]
+        self.pri_req.get.return_value = make_response(200, [])
+        self.pri_req.post.return_value = make_response(201, {"id": 500})
+
+        sync_github_comments(self.pr, self.pri_req, self.sec_req)
+
+        self.assertEqual(self.sec_req.get.call_args.args[0], next_url)
+        self.assertEqual(self.pri_req.post.call_count, 2)
+        self.pr.refresh_from_db()
+        self.assertEqual(
+            self.pr.comments_synced_at.isoformat(), "2023-01-22T11:00:00+00:00"
+        )
+
+    def test_claimed_comments_are_never_reposted(self):
+        """Assert a comment claimed by a crashed run isn't posted again."""
+        SyncedComment.objects.create(history=self.pr, secondary_comment_id=2)
+        self.sec_req.get.return_value = make_response(200, self.comments[1:])
+        self.pri_req.get.return_value = make_response(200, [])
+
+        sync_github_comments(self.pr, self.pri_req, self.sec_req)
+        self.assertFalse(self.pri_req.post.called)
+
+    def test_refused_comments_are_retried(self):
+        """Assert the cursor stays put when the primary refuses a comment."""
+        self.sec_req.get.return_value = make_response(200, self.comments)
+        self.pri_req.get.return_value = make_response(200, [])
+        self.pri_req.post.return_value = make_response(422, {"message": "Invalid"})
+
+        self.assertFalse(sync_github_comments(self.pr, self.pri_req, self.sec_req))
+
+        self.pr.refresh_from_db()
+        self.assertIsNone(self.pr.comments_synced_at)
+        self.assertFalse(self.pr.synced_comments.exists())
+
+    @patch("automate.tasks.MakeRequest")
+    def test_failed_merges_back_off(self, request_mock):
+        """Assert a PR whose merge is refused isn't polled again on every
+        tick."""
+        self.pr.project.primary_repo_token = crypt.encrypt("token")
+        self.pr.project.secondary_repo_token = crypt.encrypt("token")
+        self.pr.project.save()
+        request_mock.return_value.get.return_value = make_response(
+            200, {"merged": True}
+        )
+        request_mock.return_value.put.side_effect = lambda *args, **kwargs: (
+            make_response(405, {"message": "Pull Request is not mergeable"})
+        )
+
+        intervals = []
+        for _ in range(2):
+            sync_pr(self.pr)
+            self.pr.refresh_from_db()
+            intervals.append(self.pr.poll_interval)
+        self.assertEqual(intervals, [60, 120])
+        self.assertGreater(self.pr.next_check_at, timezone.now())
+        self.assertEqual(self.pr.action, "open")
+
+        with self.subTest("A looked up status isn't asked for again"):
+            request_mock.return_value.get.reset_mock()
+            sync_pr(self.pr, {"merged": True, "state": "MERGED", "reviews": 0})
+            self.assertFalse(request_mock.return_value.get.called)
+            self.assertTrue(request_mock.return_value.put.called)
+
+
+class CheckNewCommentsTestCase(BaseModelTestCase):
+    """Test class for dispatching PR syncs."""
+
+    def setUp(self):
+        cache.clear()
+        project = ProjectFactory(
+            secondary_repo_type=RepoTypeChoices.GITHUB,
+            secondary_repo_token=crypt.encrypt("token"),
+        )
+        patcher = patch("automate.tasks.pull_request_statuses", return_value={})
+        self.statuses_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.prs = [
+            History.objects.create(
+                project=project,
+                pr_id=pr_id,
+                action=action,
+                url=f"https://api.github.com/repos/secondary/repo/pulls/{pr_id}",
+                primary_url=f"https://api.github.com/repos/primary/repo/pulls/{pr_id}",
+                author="automator",
+            )
+            for pr_id, action in ((1, "open"), (2, "open"), (3, "merged"))
+        ]
+
+    @patch("automate.tasks.group")
+    def test_open_prs_are_dispatched_once(self, group_mock):
+        """Assert one sync task is dispatched per open PR, unless the previous
+        one is still pending."""
+        self.assertEqual(check_new_comments(), 2)
+        signatures = list(group_mock.call_args.args[0])
+        self.assertEqual(
+            [signature.args for signature in signatures],
+            [(self.prs[0].id,), (self.prs[1].id,)],
+        )
+
+        self.assertEqual(check_new_comments(), 0)
+
+    @patch("automate.tasks.group")
+    def test_prs_are_dispatched_to_free_slots(self, group_mock):
+        """Assert PRs without a free sync slot are left for the next run."""
+        with override_settings(COMMENT_SYNC_CONCURRENCY=2):
+            with cache_lock("comments:slot:1", 60):
+                self.assertEqual(check_new_comments(), 1)
+            signatures = list(group_mock.call_args.args[0])
+            self.assertEqual(signatures[0].args, (self.prs[0].id,))
+
+            self.assertEqual(check_new_comments(), 1)
+            signatures = list(group_mock.call_args.args[0])
+            self.assertEqual(signatures[0].args, (self.prs[1].id,))
+
+    @patch("automate.tasks.group")
+    def test_prs_are_dispatched_when_due(self, group_mock):
+        """Assert PRs aren't dispatched before their next check."""
+        History.objects.filter(id=self.prs[0].id).update(
+            next_check_at=timezone.now() + timedelta(minutes=5)
+        )
+        History.objects.filter(id=self.prs[1].id).update(
+            next_check_at=timezone.now() - timedelta(minutes=5)
+        )
+        self.assertEqual(check_new_comments(), 1)
+        signatures = list(group_mock.call_args.args[0])
+        self.assertEqual(signatures[0].args, (self.prs[1].id,))
+
+    @patch("automate.tasks.group")
+    def test_only_changed_prs_are_synced(self, group_mock):
+        """Assert PRs are looked up in batches and only those merged or
+        reviewed since their last sync are dispatched."""
+        History.objects.filter(id=self.prs[0].id).update(review_count=2)
+        reviewed = {"merged": False, "state": "OPEN", "reviews": 3}
+        self.statuses_mock.return_value = {
+            self.prs[0].url: {"merged": False, "state": "OPEN", "reviews": 2},
+            self.prs[1].url: reviewed,
+        }
+        with override_settings(GITHUB_STATUS_BATCH_SIZE=1):
+            self.assertEqual(check_new_comments(), 1)
+        self.assertEqual(self.statuses_mock.call_count, 2)
+        signatures = list(group_mock.call_args.args[0])
+        self.assertEqual(signatures[0].args, (self.prs[1].id,))
+        # The status is passed on, so the sync doesn't ask for it again
+        self.assertEqual(signatures[0].kwargs, {"status": reviewed})
+
+        # The idle PR waits for its next poll, and isn't pending meanwhile
+        self.prs[0].refresh_from_db()
+        self.assertEqual(self.prs[0].poll_interval, 60)
+        self.assertGreater(self.prs[0].next_check_at, timezone.now())
+        self.assertTrue(cache.add(f"comments:pending:{self.prs[0].id}", True))
+
+        with self.subTest("Merged PRs and failed lookups are synced"):
+            cache.clear()
+            History.objects.filter(id=self.prs[0].id).update(next_check_at=None)
+            self.statuses_mock.return_value = {
+                self.prs[0].url: {"merged": True, "state": "MERGED", "reviews": 2}
+            }
+            self.assertEqual(check_new_comments(), 2)
+
+        with self.subTest("PRs closed without a merge aren't polled anymore"):
+            cache.clear()
+            History.objects.filter(id=self.prs[0].id).update(next_check_at=None)
+            self.statuses_mock.return_value = {
+                self.prs[0].url: {
+                    "merged": False,
+                    "state": "CLOSED",
+                    "closed_at": "2023-01-22T10:00:00Z",
+                    "reviews": 2,
+                }
+            }
+            self.assertEqual(check_new_comments(), 1)
+            self.prs[0].refresh_from_db()
+            self.assertEqual(self.prs[0].action, "closed")
+            self.assertEqual(
+                self.prs[0].closed_at.isoformat(), "2023-01-22T10:00:00+00:00"
+            )
+
+    @patch("automate.tasks.sync_pr")
+    def test_sync_concurrency_is_bounded(self, sync_pr_mock):
+        """Assert a PR sync waits while every slot is taken."""
+        with override_settings(COMMENT_SYNC_CONCURRENCY=1):
+            with cache_lock("comments:slot:0", 60):
+                with self.assertRaises(Retry):
+                    sync_pull_request.run(self.prs[0].id)
+            self.assertFalse(sync_pr_mock.called)
+
+            status = {"merged": False, "state": "OPEN", "reviews": 4}
+            sync_pull_request.run(self.prs[0].id, status=status)
+            sync_pr_mock.assert_called_once_with(self.prs[0], status)
+            self.prs[0].refresh_from_db()
+            self.assertEqual(self.prs[0].review_count, 4)
+
+            with self.subTest("Syncs stop retrying once the PR is due again"):
+                cache.add(f"comments:pending:{self.prs[1].id}", True)
+                sync_pull_request.push_request(retries=3)
+                with cache_lock("comments:slot:0", 60):
+                    sync_pull_request.run(self.prs[1].id)
+                sync_pull_request.pop_request()
+                self.assertTrue(cache.add(f"comments:pending:{self.prs[1].id}", True))
+
+            with self.subTest("PRs closed in the meantime are skipped"):
+                sync_pull_request.run(self.prs[2].id)
+                sync_pr_mock.assert_called_once()
+
+            with self.subTest("Incomplete syncs don't record the review count"):
+                sync_pr_mock.return_value = False
+                sync_pull_request.run(self.prs[0].id, status={**status, "reviews": 5})
+                self.prs[0].refresh_from_db()
+                self.assertEqual(self.prs[0].review_count, 4)
+
+            with self.subTest("Failing providers free the slot"):
+                sync_pr_mock.side_effect = CircuitOpenError
+                sync_pull_request.run(self.prs[1].id)
+                with cache_lock("comments:slot:0", 60) as acquired:
+                    self.assertTrue(acquired)
+                self.prs[1].refresh_from_db()
+                self.assertGreater(self.prs[1].next_check_at, timezone.now())
+
+            with self.subTest("Crashed syncs free the PR and back off"):
+                sync_pr_mock.side_effect = KeyError
+                cache.add(f"comments:pending:{self.prs[0].id}", True)
+                with self.assertRaises(KeyError):
+                    sync_pull_request.run(self.prs[0].id)
+                self.assertTrue(cache.add(f"comments:pending:{self.prs[0].id}", True))
+                self.prs[0].refresh_from_db()
+                self.assertGreater(self.prs[0].next_check_at, timezone.now())
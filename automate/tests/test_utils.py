@@ -1,26 +1,51 @@
 import json
+import os
+import time
+from contextlib import ExitStack
+from io import StringIO
 from unittest import TestCase
 from unittest.mock import patch
 
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from requests import ConnectionError as RequestsConnectionError
+from requests import Response
+from requests.exceptions import RequestException
 from rest_framework.reverse import reverse
 
 from automate.choices import RepoTypeChoices
-from automate.encryptor import Crypt
+from automate.encryptor import crypt
 from automate.factories import ProjectFactory
 from automate.serializers import ProjectSerializer
-from automate.utils import add_hook_to_repo
+from automate.utils import (
+    add_hook_to_repo,
+    add_secondary_hook_to_repo,
+    bitbucket_token_key,
+    get_bitbucket_access_token,
+    register_hook,
+)
+from automate.webhooks import webhook_secret
 from repo.testing.model import BaseModelTestCase
-from repo.utils import MakeRequest
-
-crypt = Crypt()
+from repo.testing.server import LocalHTTPSServer
+from repo.utils import (
+    LOW_PRIORITY,
+    CircuitBreaker,
+    CircuitOpenError,
+    MakeRequest,
+    RateLimitedError,
+    cache_lock,
+)
 
 
 class ProjectUtilsTestCase(BaseModelTestCase):
     """Test class for Project utils."""
 
-    @patch("automate.utils.requests.post")
-    def test_add_hook_to_repo(self, post_mock):
+    @patch("automate.utils.get_session")
+    def test_add_hook_to_repo(self, get_session_mock):
         """Assert add_hook_to_repo is called with the expected data."""
+        post_mock = get_session_mock.return_value.post
         # Assert for GitHub
         with self.subTest("Assert GitHub Webhook creation"):
             project = ProjectFactory(
@@ -48,6 +73,7 @@ class ProjectUtilsTestCase(BaseModelTestCase):
                     "url": url,
                     "content_type": "json",
                     "insecure_ssl": "1",
+                    "secret": webhook_secret(project.id),
                 },
             }
             expected_headers = {
@@ -60,7 +86,7 @@ class ProjectUtilsTestCase(BaseModelTestCase):
                 project.primary_repo_webhook_url,
                 data=json.dumps(expected_payload),
                 headers=expected_headers,
-                timeout=3000,
+                timeout=settings.HTTP_TIMEOUT,
             )
 
         with self.subTest("Assert BitBucket Webhook creation"):
@@ -99,6 +125,7 @@ class ProjectUtilsTestCase(BaseModelTestCase):
                     "issue:updated",
                 ],
                 "skip_cert_verification": True,
+                "secret": webhook_secret(project.id),
             }
             post_mock.assert_called_with(
                 project.primary_repo_webhook_url.replace(
@@ -106,15 +133,191 @@ class ProjectUtilsTestCase(BaseModelTestCase):
                 ),
                 data=json.dumps(expected_payload),
                 headers=expected_headers,
-                timeout=3000,
+                timeout=settings.HTTP_TIMEOUT,
+            )
+
+    @patch("automate.utils.get_bitbucket_access_token", return_value="access")
+    @patch("automate.utils.get_session")
+    def test_add_secondary_hook_to_repo(self, get_session_mock, token_mock):
+        """Assert the comment and merge webhook is added to the secondary
+        repository."""
+        post_mock = get_session_mock.return_value.post
+        post_mock.return_value.status_code = 201
+        project = ProjectFactory(
+            secondary_repo_owner="fidepad",
+            secondary_repo_name="secondary",
+            secondary_repo_token=crypt.encrypt("secondary token"),
+            secondary_repo_type=RepoTypeChoices.GITHUB,
+        )
+        url = "https://example.com" + reverse(
+            "project:project-secondary-webhook", args=(project.slug,)
+        )
+        add_secondary_hook_to_repo(url, project.id)
+
+        self.assertEqual(
+            post_mock.call_args.args[0],
+            "https://api.github.com/repos/fidepad/secondary/hooks",
+        )
+        payload = json.loads(post_mock.call_args.kwargs["data"])
+        self.assertEqual(
+            payload["events"], ["pull_request", "pull_request_review_comment"]
+        )
+        self.assertEqual(payload["config"]["url"], url)
+        self.assertEqual(payload["config"]["secret"], webhook_secret(project.id))
+        self.assertEqual(
+            post_mock.call_args.kwargs["headers"]["Authorization"],
+            "Bearer secondary token",
+        )
+        self.assertTrue(project.projectactivities_set.get().status)
+
+        with self.subTest("Assert BitBucket Webhook creation"):
+            project.secondary_repo_type = RepoTypeChoices.BITBUCKET
+            project.save()
+            add_secondary_hook_to_repo(url, project.id)
+            self.assertEqual(
+                post_mock.call_args.args[0],
+                "https://api.bitbucket.org/2.0/repositories/fidepad/secondary/hooks",
+            )
+            payload = json.loads(post_mock.call_args.kwargs["data"])
+            self.assertEqual(
+                payload["events"],
+                ["pullrequest:comment_created", "pullrequest:fulfilled"],
+            )
+            self.assertEqual(
+                post_mock.call_args.kwargs["headers"]["Authorization"],
+                "Bearer access",
+            )
+
+        with self.subTest("Local urls are replaced like the primary's"):
+            local_url = "http://localhost:8000" + reverse(
+                "project:project-secondary-webhook", args=(project.slug,)
             )
+            add_secondary_hook_to_repo(local_url, project.id)
+            payload = json.loads(post_mock.call_args.kwargs["data"])
+            self.assertEqual(
+                payload["url"],
+                "https://localtestsite.com"
+                + reverse("project:project-secondary-webhook", args=(project.slug,)),
+            )
+
+        with self.subTest("Unreachable Bitbucket skips the webhook"):
+            post_mock.reset_mock()
+            token_mock.side_effect = CircuitOpenError("bitbucket.org keeps failing")
+            self.assertIsNone(add_secondary_hook_to_repo(url, project.id))
+            self.assertFalse(post_mock.called)
+
+    @patch("automate.utils.get_session")
+    def test_register_webhooks(self, get_session_mock):
+        """Assert existing hooks get the project secret and missing ones are
+        added."""
+        session = get_session_mock.return_value
+        project = ProjectFactory(
+            primary_repo_owner="fidepad",
+            primary_repo_name="primary",
+            primary_repo_token=crypt.encrypt("primary token"),
+            primary_repo_type=RepoTypeChoices.GITHUB,
+            secondary_repo_token=crypt.encrypt("secondary token"),
+            secondary_repo_type=RepoTypeChoices.GITHUB,
+        )
+        path = reverse("project:project-webhook", args=(project.slug,))
+        # The project's hook is on the second page of the primary's hooks
+        first_page = TestConditionalRequest.make_response(
+            200,
+            json.dumps(
+                [{"id": 6, "config": {"url": "https://other.example.com/"}}]
+            ).encode(),
+            {"Link": f'<{project.primary_repo_webhook_url}?page=2>; rel="next"'},
+        )
+        second_page = TestConditionalRequest.make_response(
+            200,
+            json.dumps(
+                [{"id": 7, "config": {"url": "https://old.example.com" + path}}]
+            ).encode(),
+        )
+        secondary_hooks = TestConditionalRequest.make_response(200, b"[]")
+        session.get.side_effect = [first_page, second_page, secondary_hooks]
+        session.patch.return_value.status_code = 200
+        session.post.return_value.status_code = 201
+
+        output = StringIO()
+        call_command("register_webhooks", "--domain=https://example.com", stdout=output)
+
+        self.assertEqual(
+            session.patch.call_args.args[0], project.primary_repo_webhook_url + "/7"
+        )
+        payload = json.loads(session.patch.call_args.kwargs["data"])
+        self.assertEqual(payload["config"]["url"], "https://example.com" + path)
+        self.assertEqual(payload["config"]["secret"], webhook_secret(project.id))
+        # The secondary repository had no hook of the project yet
+        self.assertEqual(
+            session.post.call_args.args[0], project.secondary_repo_webhook_url
+        )
+        self.assertEqual(
+            output.getvalue(),
+            f"{project.slug}\tprimary\t200\n{project.slug}\tsecondary\t201\n",
+        )
+
+    @patch("automate.utils.get_session")
+    def test_hooks_that_cant_be_listed_are_left_alone(self, get_session_mock):
+        """Assert no hook is added when the existing ones can't be listed."""
+        session = get_session_mock.return_value
+        session.get.return_value = TestConditionalRequest.make_response(
+            401, b'{"type": "error"}'
+        )
+        payload = {"url": "https://example.com/webhook", "secret": "secret"}
+
+        response = register_hook(
+            "https://api.bitbucket.org/2.0/workspaces/fidepad/hooks", payload, {}
+        )
+
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(session.post.called)
+        self.assertFalse(session.put.called)
+
+        with self.subTest("A failing project doesn't stop the others"):
+            projects = [ProjectFactory(), ProjectFactory()]
+            output, errors = StringIO(), StringIO()
+            with patch(
+                "automate.management.commands.register_webhooks.Command.register",
+                side_effect=[AttributeError("broken"), None],
+            ) as register_mock:
+                call_command(
+                    "register_webhooks",
+                    "--domain=https://example.com",
+                    stdout=output,
+                    stderr=errors,
+                )
+            self.assertEqual(register_mock.call_count, 2)
+            self.assertIn(f"{projects[0].slug}\tfailed", errors.getvalue())
+
+
+def echo(handler):
+    """Answer like httpbin, echoing the url and JSON body of the request."""
+    body = handler.server.requests[-1][3]
+    return (
+        200,
+        {},
+        {
+            "url": handler.server.url + handler.path,
+            "json": json.loads(body) if body else None,
+        },
+    )
 
 
 class TestMakeRequest(TestCase):
     """This tests the make request class."""
 
     def setUp(self):
-        self.url = "https://httpbin.org/"  # This is an endpoint for testing requests
+        # Failures of other tests must not leave the circuit open
+        cache.clear()
+        stack = ExitStack()
+        self.addCleanup(stack.close)
+        server = stack.enter_context(LocalHTTPSServer(echo))
+        patcher = patch.dict(os.environ, {"REQUESTS_CA_BUNDLE": server.ca_bundle})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.url = server.url + "/"
         self.headers = {"Content-Type": "application/json"}
         self.data = {"key": "value"}
         self.make_request = MakeRequest(self.url, self.headers)
@@ -139,10 +342,318 @@ class TestMakeRequest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(content["json"], self.data)
 
+    @override_settings(HTTP_RETRIES=0)
     def test_that_exception_works(self):
         """Test to ensure exceptions are handled."""
-        self.url = "https://examplebadnotworking.com/"
+        # Nothing listens on port 1
+        self.url = "https://127.0.0.1:1/"
         self.make_request = MakeRequest(self.url)
         response = self.make_request.get()
 
         self.assertIn("HTTPSConnectionPool", response["data"]["error"])
+
+
+@override_settings(HTTP_RETRIES=2, HTTP_BREAKER_THRESHOLD=3)
+class TestRetries(SimpleTestCase):
+    """This tests the retries and circuit breaker of the make request class."""
+
+    def setUp(self):
+        cache.clear()
+        self.url = "https://api.github.com/repos/fidepad/repo/pulls/1"
+        self.make_request = MakeRequest(self.url)
+        patcher = patch("repo.utils.get_session")
+        self.session = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        patcher = patch("repo.utils.time.sleep")
+        self.sleep_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failures_are_retried_with_backoff(self):
+        """Assert 5xx responses and connection errors are retried, waiting at
+        least what Retry-After asks."""
+        self.session.get.side_effect = [
+            RequestsConnectionError("reset"),
+            TestConditionalRequest.make_response(503, headers={"Retry-After": "3"}),
+            TestConditionalRequest.make_response(200, b"{}"),
+        ]
+        self.assertEqual(self.make_request.get().status_code, 200)
+        self.assertEqual(self.session.get.call_count, 3)
+        delays = [call.args[0] for call in self.sleep_mock.call_args_list]
+        self.assertLessEqual(delays[0], settings.HTTP_RETRY_BACKOFF)
+        self.assertGreaterEqual(delays[1], 3)
+
+        with self.subTest("Retries give up"):
+            self.session.get.side_effect = None
+            self.session.get.return_value = TestConditionalRequest.make_response(502)
+            self.assertEqual(self.make_request.get().status_code, 502)
+
+        with self.subTest("Long waits are left to the caller"):
+            cache.clear()
+            self.session.get.reset_mock()
+            self.session.get.return_value = TestConditionalRequest.make_response(
+                429, headers={"Retry-After": "3600"}
+            )
+            self.assertEqual(self.make_request.get().status_code, 429)
+            self.session.get.assert_called_once()
+
+    def test_posts_are_only_retried_when_refused(self):
+        """Assert a post is retried on 429, but not on a 5xx the provider may
+        have acted on."""
+        self.session.post.side_effect = [
+            TestConditionalRequest.make_response(429),
+            TestConditionalRequest.make_response(502),
+            TestConditionalRequest.make_response(201),
+        ]
+        self.assertEqual(self.make_request.post({}, json=True).status_code, 502)
+        self.assertEqual(self.session.post.call_count, 2)
+
+    def test_failing_hosts_are_not_called(self):
+        """Assert the circuit opens after repeated failures, and a single trial
+        call is made once it cools down."""
+        self.session.get.side_effect = RequestsConnectionError("refused")
+        response = self.make_request.get()
+        self.assertIn("refused", response["data"]["error"])
+        # The circuit opened on the third attempt
+        self.assertEqual(self.session.get.call_count, 3)
+
+        self.session.get.reset_mock()
+        response = self.make_request.get()
+        self.assertIn("isn't called for now", response["data"]["error"])
+        self.session.get.assert_not_called()
+        with self.assertRaises(CircuitOpenError):
+            MakeRequest(self.url, raise_errors=True).get()
+
+        with self.subTest("Other hosts are still called"):
+            self.session.get.side_effect = None
+            self.session.get.return_value = TestConditionalRequest.make_response(200)
+            MakeRequest("https://api.bitbucket.org/2.0/repositories").get()
+            self.session.get.assert_called_once()
+
+        with self.subTest("Trial call"):
+            self.session.get.reset_mock()
+            breaker = CircuitBreaker("api.github.com")
+            cache.delete(breaker.key + ":open")
+            self.session.get.side_effect = RequestsConnectionError("refused")
+            self.make_request.get()
+            self.session.get.assert_called_once()
+            self.assertTrue(breaker.is_open())
+
+            cache.delete(breaker.key + ":open")
+            self.session.get.side_effect = None
+            self.assertEqual(self.make_request.get().status_code, 200)
+            self.assertIsNone(cache.get(breaker.key))
+
+
+@override_settings(HTTP_RATELIMIT_RESERVE=1)
+class TestRateLimit(SimpleTestCase):
+    """This tests that requests share the rate limit budget of their
+    credential."""
+
+    def setUp(self):
+        cache.clear()
+        self.url = "https://api.github.com/repos/fidepad/repo/pulls/1"
+        self.headers = {"Authorization": "Bearer token"}
+        patcher = patch("repo.utils.get_session")
+        self.get_mock = patcher.start().return_value.get
+        self.addCleanup(patcher.stop)
+        patcher = patch("repo.utils.time.sleep")
+        self.sleep_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def make_response(remaining, reset_in):
+        """Return a response with rate limit headers."""
+        return TestConditionalRequest.make_response(
+            200,
+            b"{}",
+            {
+                "X-RateLimit-Remaining": str(remaining),
+                "X-RateLimit-Reset": str(int(time.time() + reset_in)),
+            },
+        )
+
+    def test_polling_leaves_a_reserve(self):
+        """Assert low priority requests stop at the reserve, which high
+        priority requests may spend."""
+        self.get_mock.side_effect = [
+            self.make_response(remaining, 3600) for remaining in (2, 1, 0)
+        ]
+        poll = MakeRequest(
+            self.url, self.headers, raise_errors=True, priority=LOW_PRIORITY
+        )
+        poll.get()
+        poll.get()
+        # The budget is shared by every request of the credential
+        with self.assertRaises(RateLimitedError) as context:
+            MakeRequest(
+                self.url, self.headers, raise_errors=True, priority=LOW_PRIORITY
+            ).get()
+        self.assertGreater(context.exception.retry_in, 3500)
+        self.assertEqual(self.get_mock.call_count, 2)
+
+        with self.subTest("High priority requests use the reserve"):
+            self.assertEqual(MakeRequest(self.url, self.headers).get().status_code, 200)
+
+        with self.subTest("Other credentials have their own budget"):
+            self.get_mock.side_effect = None
+            self.get_mock.return_value = self.make_response(5000, 3600)
+            other = MakeRequest(
+                self.url, {"Authorization": "Bearer other"}, priority=LOW_PRIORITY
+            )
+            self.assertEqual(other.get().status_code, 200)
+
+    def test_high_priority_requests_wait_for_a_close_reset(self):
+        """Assert an exhausted budget is waited for when it resets soon."""
+        self.get_mock.return_value = self.make_response(0, 5)
+        make_request = MakeRequest(self.url, self.headers)
+        make_request.get()
+        make_request.get()
+        self.assertEqual(self.get_mock.call_count, 2)
+        self.assertGreater(self.sleep_mock.call_args.args[0], 3)
+
+        with self.subTest("Distant resets"):
+            self.get_mock.return_value = self.make_response(0, 3600)
+            cache.clear()
+            make_request.get()
+            self.get_mock.reset_mock()
+            response = make_request.get()
+            self.assertIn("resets in", response["data"]["error"])
+            self.get_mock.assert_not_called()
+
+
+class TestConditionalRequest(TestCase):
+    """This tests the conditional requests of the make request class."""
+
+    def setUp(self):
+        cache.clear()
+        self.url = "https://api.github.com/repos/fidepad/repo/pulls/1"
+        self.make_request = MakeRequest(
+            self.url, {"Authorization": "Bearer token"}, conditional=True
+        )
+
+    @staticmethod
+    def make_response(status_code, content=b"", headers=None):
+        """Return a requests response."""
+        response = Response()
+        response.status_code = status_code
+        response._content = content  # pylint: disable=protected-access
+        response.headers.update(headers or {})
+        return response
+
+    @patch("repo.utils.get_session")
+    def test_not_modified_responses_are_served_from_cache(self, get_session_mock):
+        """Assert a 304 returns the cached body."""
+        get_mock = get_session_mock.return_value.get
+        get_mock.return_value = self.make_response(
+            200, b'{"merged": false}', {"ETag": '"abc"'}
+        )
+        response = self.make_request.get()
+        self.assertFalse(response.not_modified)
+        self.assertNotIn("If-None-Match", get_mock.call_args.kwargs["headers"])
+
+        get_mock.return_value = self.make_response(304)
+        response = self.make_request.get()
+        self.assertEqual(get_mock.call_args.kwargs["headers"]["If-None-Match"], '"abc"')
+        self.assertTrue(response.not_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"merged": False})
+
+        with self.subTest("Other credentials don't share the cache"):
+            other = MakeRequest(self.url, {"Authorization": "Bearer other"}, True)
+            get_mock.return_value = self.make_response(200, b"{}")
+            other.get()
+            self.assertNotIn("If-None-Match", get_mock.call_args.kwargs["headers"])
+
+
+class TestBitbucketTokenCache(TestCase):
+    """This tests the bitbucket access token cache."""
+
+    def setUp(self):
+        cache.clear()
+        self.credentials = {
+            "client_id": "client",
+            "client_secret": "secret",
+            "refresh_token": "refresh",
+        }
+        patcher = patch("automate.utils.MakeRequest")
+        self.post_mock = patcher.start().return_value.post
+        self.addCleanup(patcher.stop)
+        self.post_mock.return_value = TestConditionalRequest.make_response(
+            200, b'{"access_token": "fresh", "expires_in": 7200}'
+        )
+
+    def test_token_is_refreshed_once(self):
+        """Assert a token is reused until shortly before it expires."""
+        self.assertEqual(get_bitbucket_access_token(self.credentials), "fresh")
+        self.assertEqual(get_bitbucket_access_token(self.credentials), "fresh")
+        self.assertEqual(self.post_mock.call_count, 1)
+
+        cached = cache.get(bitbucket_token_key(self.credentials))
+        self.assertNotEqual(cached, "fresh")
+        self.assertEqual(crypt.decrypt(cached), "fresh")
+
+        with self.subTest("Short lived tokens aren't cached"):
+            cache.clear()
+            self.post_mock.return_value = TestConditionalRequest.make_response(
+                200, b'{"access_token": "brief", "expires_in": 60}'
+            )
+            self.assertEqual(get_bitbucket_access_token(self.credentials), "brief")
+            self.assertIsNone(cache.get(bitbucket_token_key(self.credentials)))
+
+    @override_settings(HTTP_RETRIES=0)
+    def test_unreachable_bitbucket_raises(self):
+        """Assert a refresh Bitbucket can't answer raises a request error
+        instead of crashing on the failure's dict."""
+        with patch("automate.utils.MakeRequest", MakeRequest), patch(
+            "repo.utils.get_session"
+        ) as get_session_mock:
+            get_session_mock.return_value.post.side_effect = RequestsConnectionError(
+                "reset"
+            )
+            with self.assertRaises(RequestException):
+                get_bitbucket_access_token(self.credentials)
+
+    def test_concurrent_refresh_waits_for_token(self):
+        """Assert a worker waits for the refresh already in flight."""
+        key = bitbucket_token_key(self.credentials)
+
+        def refreshed_elsewhere(_):
+            cache.set(key, crypt.encrypt("other"))
+
+        with cache_lock(key + ":refresh", 60):
+            with patch("automate.utils.time.sleep", side_effect=refreshed_elsewhere):
+                self.assertEqual(get_bitbucket_access_token(self.credentials), "other")
+        self.post_mock.assert_not_called()
+
+
+class TestPooledSessions(TestCase):
+    """This tests that provider calls reuse their connections."""
+
+    def test_connections_are_reused(self):
+        """Assert a poll's requests to a host share one TLS connection."""
+        with LocalHTTPSServer() as server:
+            with patch.dict(os.environ, {"REQUESTS_CA_BUNDLE": server.ca_bundle}):
+                make_request = MakeRequest(server.url + "/repos/fidepad/repo/pulls/1")
+                for _ in range(3):
+                    self.assertEqual(make_request.get().status_code, 200)
+                    self.assertEqual(
+                        make_request.get(make_request.url + "/comments").status_code,
+                        200,
+                    )
+                self.assertEqual(make_request.post({}, json=True).status_code, 200)
+
+            self.assertEqual(len(server.requests), 7)
+            self.assertEqual(server.connections, 1)
+
+    def test_cookies_are_not_shared(self):
+        """Assert cookies set for a credential aren't sent with the requests of
+        others."""
+        with LocalHTTPSServer(
+            lambda handler: (200, {"Set-Cookie": "session=tenant; Path=/"}, {})
+        ) as server:
+            with patch.dict(os.environ, {"REQUESTS_CA_BUNDLE": server.ca_bundle}):
+                url = server.url + "/repos/fidepad/repo/pulls/1"
+                MakeRequest(url, {"Authorization": "Bearer one"}).get()
+                MakeRequest(url, {"Authorization": "Bearer two"}).get()
+
+        self.assertNotIn("Cookie", server.requests[1][2])
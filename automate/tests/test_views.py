@@ -1,12 +1,26 @@
+import asyncio
+import hashlib
+import hmac
+import json
+from datetime import timedelta
+from io import StringIO
 from unittest.mock import patch
 
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError
 from django.shortcuts import reverse
+from django.test import AsyncClient
+from django.utils import timezone
 from faker import Faker
 
-from automate.choices import RepoTypeChoices
+from automate.choices import RepoTypeChoices, WebhookEventStatusChoices
 from automate.factories import ProjectFactory, UserFactory
-from automate.models import Project
+from automate.models import History, Project, ProjectActivities, WebhookEvent
 from automate.serializers import ProjectSerializer
+from automate.views import SECONDARY_WEBHOOK_ROUTES, WEBHOOK_ROUTES
+from automate.webhooks import route_counters, webhook_secret
 from repo.testing.api import BaseAPITestCase
 
 fake = Faker()
@@ -58,7 +72,7 @@ class ProjectAPITestCase(BaseAPITestCase):
         response = self.client.get(self.url_list)
         content = response.data
         self.assertEqual(response.status_code, 200)
-        self.assertTrue(len(content) == 1)
+        self.assertTrue(len(content["results"]) == 1)
 
         with self.subTest("Test to ensure you only get projects you created"):
             user = UserFactory(email="adam@a.com")
@@ -66,11 +80,85 @@ class ProjectAPITestCase(BaseAPITestCase):
             response = client.get(self.url_list)
             content = response.data
             self.assertEqual(response.status_code, 200)
-            self.assertTrue(len(content) == 0)
+            self.assertTrue(len(content["results"]) == 0)
 
+    def test_activities_and_history_are_paginated(self):
+        """Test to page through a project's activities and history, newest
+        first."""
+        self.client.force_authenticate(self.user)
+        for index in range(3):
+            ProjectActivities.objects.create(
+                user=self.user, project=self.repo1, action=f"activity {index}"
+            )
+            History.objects.create(
+                project=self.repo1,
+                pr_id=index,
+                url=fake.url(),
+                primary_url=fake.url(),
+                author=fake.user_name(),
+            )
+
+        for name, field, expected in (
+            (
+                "project-activities",
+                "action",
+                ["activity 2", "activity 1", "activity 0"],
+            ),
+            ("project-history", "pr_id", [2, 1, 0]),
+        ):
+            with self.subTest(name):
+                url = reverse(f"project:{name}", kwargs={"slug": self.repo1.slug})
+                response = self.client.get(url, {"page_size": 2})
+                self.assertEqual(response.status_code, 200)
+                first = [item[field] for item in response.data["results"]]
+                self.assertIsNone(response.data["previous"])
+
+                response = self.client.get(response.data["next"])
+                second = [item[field] for item in response.data["results"]]
+                self.assertIsNone(response.data["next"])
+                self.assertEqual(first + second, expected)
+
+    def test_search_ranks_projects(self):
+        """Test to search projects by prefix, name matches first."""
+        self.client.force_authenticate(self.user)
+        by_repo = ProjectFactory(
+            owner=self.user, name="Mirror", primary_repo_name="replicator-tools"
+        )
+        by_name = ProjectFactory(owner=self.user, name="Replicator Hub")
+        ProjectFactory(owner=UserFactory(email="eve@a.com"), name="Replicator")
+
+        with self.subTest("Ranked pages"):
+            response = self.client.get(
+                self.url_list, {"search": "replic", "page_size": 1}
+            )
+            self.assertEqual(response.status_code, 200)
+            first = [item["slug"] for item in response.data["results"]]
+            response = self.client.get(response.data["next"])
+            second = [item["slug"] for item in response.data["results"]]
+            self.assertIsNone(response.data["next"])
+            self.assertEqual(first + second, [by_name.slug, by_repo.slug])
+
+        with self.subTest("Every term must match"):
+            response = self.client.get(self.url_list, {"search": "replicator hub"})
+            self.assertEqual(
+                [item["slug"] for item in response.data["results"]], [by_name.slug]
+            )
+
+        with self.subTest("Terms without words are ignored"):
+            response = self.client.get(self.url_list, {"search": "&!:*"})
+            self.assertEqual(len(response.data["results"]), 3)
+
+    @patch("automate.tasks.warm_mirror_task.delay")
+    @patch("automate.tasks.add_secondary_hook_task.delay")
     @patch("automate.tasks.add_hook_to_repo_task.delay")
     @patch("automate.serializers.ProjectSerializer.validate_repo")
-    def test_create_project(self, validate_repo_mock, add_hook_to_repo_mock):
+    def test_create_project(
+        self,
+        validate_repo_mock,
+        add_hook_to_repo_mock,
+        add_secondary_hook_mock,
+        warm_mirror_mock,
+    ):
         """Test creating of a project."""
         response = self.client.post(self.url_list, data=self.data)
         self.assertEqual(response.status_code, 201)
@@ -87,7 +175,14 @@ class ProjectAPITestCase(BaseAPITestCase):
             project_.data,
         )
 
+        add_secondary_hook_mock.assert_called_with(
+            "http://testserver"
+            + reverse("project:project-secondary-webhook", args=[project.slug]),
+            project.id,
+        )
+
         self.assertTrue(validate_repo_mock.called)
+        warm_mirror_mock.assert_called_with(project.id)
 
     def test_to_retrieve_and_update_project(self):
         """Test to Get and Updates project."""
@@ -111,6 +206,7 @@ class TestWebhook(BaseAPITestCase):
     """Test for Webhook."""
 
     def setUp(self) -> None:
+        cache.clear()
         self.user = UserFactory()
         self.project = ProjectFactory(owner=self.user)
         self.url = reverse(
@@ -128,26 +224,270 @@ class TestWebhook(BaseAPITestCase):
             },
         }
 
+    def post(self, data, secret=None, **headers):
+        """Post a webhook delivery signed with the project's secret."""
+        body = json.dumps(data).encode()
+        return self.client.generic(
+            "POST",
+            self.url,
+            body,
+            content_type="application/json",
+            HTTP_X_HUB_SIGNATURE_256=self.sign(body, secret),
+            **headers,
+        )
+
+    def sign(self, body, secret=None):
+        """Return the signature header of a webhook delivery."""
+        digest = hmac.new(
+            (secret or webhook_secret(self.project.id)).encode(), body, hashlib.sha256
+        ).hexdigest()
+        return f"sha256={digest}"
+
+    def other_pull_request(self):
+        """Return the closed event of another pull request."""
+        pull_request = {**self.data["pull_request"], "id": fake.random_number(9)}
+        return {**self.data, "pull_request": pull_request}
+
     def test_to_ensure_webhook_gets_data(self):
         """this test throws a validation if webhook is called without data."""
-        response = self.client.post(self.url)
+        response = self.post({"action": "closed"})
         content = response.json()
 
         self.assertTrue(response.status_code == 400)
-        self.assertEqual(content.get("action"), ["This field is required."])
         self.assertEqual(content.get("pull_request"), ["This field is required."])
 
-    @patch("automate.tasks.init_run_git.delay")
-    def test_to_ensure_webhook_works(self, run):
+        with self.subTest("Deliveries without an action are dropped"):
+            response = self.post({"zen": "Keep it logically awesome."})
+            self.assertEqual(response.status_code, 200)
+            response = self.post({"hook_id": 1}, HTTP_X_GITHUB_EVENT="ping")
+            self.assertEqual(response.json(), {"queued": False})
+
+    @patch("automate.tasks.drain_webhook_events.delay")
+    def test_to_ensure_webhook_works(self, drain):
         """This is a mocked test to ensure our webhook works."""
-        response = self.client.post(self.url, data=self.data, format="json")
-        content = response.json()
-        self.assertEqual(response.status_code, 201)
-        self.assertTrue(content.get("action") == self.data.get("action"))
-        self.assertTrue(
-            content["pull_request"]["url"] == self.data["pull_request"]["url"]
+        response = self.post(self.data)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {"queued": True})
+        self.assertTrue(drain.called)
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.project, self.project)
+        self.assertEqual(event.status, WebhookEventStatusChoices.PENDING)
+        data = event.payload
+        self.assertEqual(data["action"], self.data["action"])
+        self.assertEqual(data["pull_request"]["url"], self.data["pull_request"]["url"])
+        self.assertEqual(
+            data["pull_request"]["head"], self.data["pull_request"]["head"]
         )
+        self.assertNotIn("state", data["pull_request"])
+
+        with self.subTest("A delivery is a single insert"):
+            with self.assertNumQueries(1):
+                self.post(self.other_pull_request())
+
+        with self.subTest("Deliveries are kept while the broker is down"):
+            cache.clear()
+            drain.side_effect = ConnectionError
+            response = self.post(self.other_pull_request())
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(WebhookEvent.objects.count(), 3)
+
+    @patch("automate.tasks.drain_webhook_events.delay")
+    def test_deleted_projects_are_not_found(self, _):
+        """Assert deliveries for a deleted project get a 404 once its id was
+        cached."""
+        self.assertEqual(self.post(self.data).status_code, 202)
+        secret = webhook_secret(self.project.id)
+        self.project.delete()
+
+        response = self.post(self.other_pull_request(), secret)
+        self.assertEqual(response.status_code, 404)
+
+        with self.subTest("Deletions racing a delivery"):
+            project = ProjectFactory(owner=self.user)
+            self.url = reverse("project:project-webhook", kwargs={"slug": project.slug})
+            self.project = project
+            with patch(
+                "automate.views.WebhookEvent.objects.create",
+                side_effect=IntegrityError,
+            ):
+                response = self.post(self.other_pull_request())
+            self.assertEqual(response.status_code, 404)
+            self.assertIsNone(cache.get(f"webhook:project:{project.slug}"))
+
+    @patch("automate.tasks.drain_webhook_events.delay")
+    def test_redeliveries_are_dropped(self, _):
+        """Assert a delivery is only queued once."""
+        response = self.post(self.data, HTTP_X_GITHUB_DELIVERY="delivery-1")
+        self.assertEqual(response.status_code, 202)
+
+        response = self.post(self.data, HTTP_X_GITHUB_DELIVERY="delivery-1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"queued": False, "duplicate": True})
+
+        with self.subTest("The same event under another delivery id is dropped"):
+            response = self.post(self.data, HTTP_X_REQUEST_UUID="delivery-2")
+            self.assertTrue(response.json()["duplicate"])
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+        with self.subTest("Failed deliveries can be redelivered"):
+            data = self.other_pull_request()
+            with patch.object(
+                WebhookEvent.objects, "create", side_effect=DatabaseError
+            ):
+                with self.assertRaises(DatabaseError):
+                    self.post(data, HTTP_X_GITHUB_DELIVERY="delivery-3")
+            response = self.post(data, HTTP_X_GITHUB_DELIVERY="delivery-3")
+            self.assertEqual(response.status_code, 202)
+
+    @patch("automate.tasks.drain_webhook_events.delay")
+    def test_non_actionable_events_are_dropped(self, drain):
+        """Assert only routed events reach the inbox, and are counted."""
+        for action in ("opened", "synchronize", "edited"):
+            response = self.post({**self.data, "action": action})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), {"queued": False})
+        response = self.post(self.data, HTTP_X_GITHUB_EVENT="push")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(drain.called)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+        self.post(self.data)
+        self.post(self.data)
+        counters = route_counters(WEBHOOK_ROUTES)
         self.assertEqual(
-            content["pull_request"]["head"], self.data["pull_request"]["head"]
+            counters["github", "pull_request", "closed"],
+            {"queued": 1, "duplicate": 1, "dropped": 0},
+        )
+        self.assertEqual(counters["github", "pull_request", "*"]["dropped"], 3)
+        self.assertEqual(counters["github", "*", "*"]["dropped"], 1)
+
+        with self.subTest("Counters are listed by a management command"):
+            output = StringIO()
+            call_command("webhook_routes", stdout=output)
+            self.assertIn("github\tpull_request\tclosed\t1\t1\t0", output.getvalue())
+
+    @patch("automate.tasks.drain_webhook_events.delay")
+    async def test_concurrent_deliveries_under_asgi(self, drain):
+        """Assert the async webhook serves concurrent deliveries."""
+        bodies = [json.dumps(self.other_pull_request()).encode() for _ in range(5)]
+        client = AsyncClient()
+        responses = await asyncio.gather(
+            *(
+                client.generic(
+                    "POST",
+                    self.url,
+                    body,
+                    content_type="application/json",
+                    **{"X-Hub-Signature-256": self.sign(body)},
+                )
+                for body in bodies
+            )
+        )
+        self.assertEqual([response.status_code for response in responses], [202] * 5)
+        self.assertEqual(await sync_to_async(WebhookEvent.objects.count)(), 5)
+        self.assertTrue(drain.called)
+
+        with self.subTest("Only POST is allowed"):
+            response = await client.get(self.url)
+            self.assertEqual(response.status_code, 405)
+
+    @patch("automate.tasks.drain_webhook_events.delay")
+    def test_webhook_rejects_bad_signatures(self, drain):
+        """Assert deliveries that aren't signed with the project secret are
+        rejected."""
+        response = self.post(self.data, secret="guessed")
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.generic(
+            "POST",
+            self.url,
+            json.dumps(self.data),
+            content_type="application/json",
+            HTTP_X_HUB_SIGNATURE_256="sha256=é",
+        )
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.post(self.url, data=self.data, format="json")
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(drain.called)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+        with self.subTest("Unknown projects are not found"):
+            self.url = reverse("project:project-webhook", kwargs={"slug": "unknown"})
+            self.assertEqual(self.post(self.data).status_code, 404)
+
+
+class TestSecondaryWebhook(BaseAPITestCase):
+    """Test for the webhook of the secondary repository."""
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.project = ProjectFactory()
+        self.url = reverse(
+            "project:project-secondary-webhook", kwargs={"slug": self.project.slug}
+        )
+        self.pr = History.objects.create(
+            project=self.project,
+            pr_id=7,
+            action="open",
+            url="https://api.github.com/repos/fidepad/secondary/pulls/7",
+            primary_url="https://api.github.com/repos/fidepad/primary/pulls/7",
+            author="fidepad",
+            next_check_at=timezone.now() + timedelta(hours=1),
+        )
+
+    def post(self, data, **headers):
+        """Post a webhook delivery signed with the project's secret."""
+        body = json.dumps(data).encode()
+        digest = hmac.new(
+            webhook_secret(self.project.id).encode(), body, hashlib.sha256
+        ).hexdigest()
+        return self.client.generic(
+            "POST",
+            self.url,
+            body,
+            content_type="application/json",
+            HTTP_X_HUB_SIGNATURE_256=f"sha256={digest}",
+            **headers,
         )
-        self.assertTrue(run.called)
+
+    @patch("automate.tasks.check_new_comments.delay")
+    def test_comments_get_the_pr_synced(self, check):
+        """Assert a new comment marks its PR due and wakes the comment
+        check."""
+        data = {"action": "created", "pull_request": {"url": self.pr.url}}
+        response = self.post(data, HTTP_X_GITHUB_EVENT="pull_request_review_comment")
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(check.called)
+        self.pr.refresh_from_db()
+        self.assertLessEqual(self.pr.next_check_at, timezone.now())
+
+        with self.subTest("Bitbucket merges are routed too"):
+            self.pr.url = (
+                "https://api.bitbucket.org/2.0/repositories/w/r/pullrequests/1"
+            )
+            self.pr.save()
+            data = {"pullrequest": {"links": {"self": {"href": self.pr.url}}}}
+            response = self.post(data, HTTP_X_EVENT_KEY="pullrequest:fulfilled")
+            self.assertEqual(response.status_code, 202)
+
+        with self.subTest("Unknown PRs and other events are dropped"):
+            check.reset_mock()
+            data = {"action": "created", "pull_request": {"url": "https://a.com/1"}}
+            response = self.post(
+                data, HTTP_X_GITHUB_EVENT="pull_request_review_comment"
+            )
+            self.assertEqual(response.json(), {"queued": False})
+            response = self.post({"action": "opened", "pull_request": {}})
+            self.assertEqual(response.json(), {"queued": False})
+            self.assertFalse(check.called)
+
+        with self.subTest("Counters are kept apart from the primary's"):
+            counters = route_counters(SECONDARY_WEBHOOK_ROUTES, "secondary")
+            self.assertEqual(
+                counters["github", "pull_request_review_comment", "created"],
+                {"queued": 1, "duplicate": 0, "dropped": 1},
+            )
+            counters = route_counters(WEBHOOK_ROUTES)
+            self.assertEqual(counters["github", "pull_request", "*"]["dropped"], 0)
@@ -1,10 +1,18 @@
+from django.urls import path
 from rest_framework.routers import DefaultRouter
 
-from automate.views import ProjectViewSets
+from automate.views import ProjectViewSets, project_webhook, secondary_webhook
 
 app_name = "project"
 
 router = DefaultRouter()
 router.register("", ProjectViewSets)
 
-urlpatterns = router.urls
+urlpatterns = [
+    path("<slug:slug>/webhook/", project_webhook, name="project-webhook"),
+    path(
+        "<slug:slug>/webhook/secondary/",
+        secondary_webhook,
+        name="project-secondary-webhook",
+    ),
+] + router.urls
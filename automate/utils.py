@@ -1,34 +1,48 @@
+import hashlib
 import json
+import time
+from urllib.parse import urlsplit
 
-import requests
+from django.conf import settings
+from django.core.cache import cache
 from requests import ConnectionError as RequestError
 from requests import ConnectTimeout as RequestTimeout
 from requests import Timeout as ResponseTimeout
+from requests.exceptions import RequestException
 
 from accounts.models import User
+from automate.activity import log_activity
 from automate.choices import RepoTypeChoices
-from automate.encryptor import Crypt
-from automate.models import Project, ProjectActivities
-from repo.utils import MakeRequest
-
-crypt = Crypt()
-
-
-def log_activity(user, activity, project, status=None):
-    """Log activity function."""
-    ProjectActivities.objects.create(
-        user=user, project=project, action=activity, status=status
-    )
-
+from automate.encryptor import crypt
+from automate.models import Project
+from automate.webhooks import webhook_secret
+from repo.utils import MakeRequest, cache_lock, get_session, logger
 
 # pylint: disable=duplicate-code
 
+# Hosts providers won't deliver webhooks to
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "0.0.0.0")
+
 
 def clean_url(url):
     """Simple function to remove spaces in url and turn them to hyphens."""
     return url.replace(" ", "-").strip().lower()
 
 
+def public_webhook_url(url):
+    """Return the url a provider is asked to deliver webhooks to.
+
+    Providers refuse local urls, so those are pointed at a placeholder
+    host to pass their validation.
+    """
+    parts = urlsplit(url)
+    if parts.hostname in LOCAL_HOSTS:
+        return (
+            "https://localtestsite.com" + parts._replace(scheme="", netloc="").geturl()
+        )
+    return url
+
+
 def add_hook_to_repo(project_webhook_url, user, project_data):
     """Add a webhook to a repository.
 
@@ -45,6 +59,27 @@ def add_hook_to_repo(project_webhook_url, user, project_data):
         project_data["secondary_repo_token"]
     )
 
+    webhook_url, payload, headers = primary_hook(project_webhook_url, project_data)
+    response = create_hook(webhook_url, payload, headers)
+    if response:
+        status = False
+        user = User.objects.get(email=user)
+        project = Project.objects.get(id=project_data["id"])
+        activity = f"{user} initialized a project, webhook create status -> {response.status_code}"
+        if response.status_code in [200, 201]:
+
+            status = True
+        log_activity(user=user, activity=activity, status=status, project=project)
+
+    return response
+
+
+def primary_hook(project_webhook_url, project_data):
+    """Return the hooks url of the primary repository, and the payload and
+    headers adding the project's webhook to it.
+
+    The tokens of project_data must be decrypted.
+    """
     if project_data["primary_repo_type"] == RepoTypeChoices.GITHUB:
         # Modify webhook_url for github to find it. Change "Repo Name" to "repo-name" to suite git_url
         _url = f"https://api.github.com/repos/{project_data['primary_repo_owner']}/{project_data['primary_repo_name']}/hooks"
@@ -54,20 +89,12 @@ def add_hook_to_repo(project_webhook_url, user, project_data):
             "active": True,
             "events": ["pull_request"],
             "config": {
-                "url": project_webhook_url,
+                "url": public_webhook_url(project_webhook_url),
                 "content_type": "json",
                 "insecure_ssl": "1",
+                "secret": webhook_secret(project_data["id"]),
             },
         }
-        not_allowed = ["127.0.0.1", "localhost", "0.0.0.0"]
-        # Modify payload url if it's localhost to not fail validation
-        for host in not_allowed:
-            if host in payload["config"]["url"]:
-                # Get the remaining endpoint after localhost
-                url = project_webhook_url[21:]
-                payload["config"]["url"] = "https://localtestsite.com" + url
-                break  # To stop the loop
-
         headers = {
             "Accept": "application/vnd.github+json",
             "Authorization": f"Bearer {project_data['primary_repo_token']}",
@@ -90,37 +117,141 @@ def add_hook_to_repo(project_webhook_url, user, project_data):
                 "issue:updated",
             ],
             "skip_cert_verification": True,
+            "secret": webhook_secret(project_data["id"]),
         }
         headers = {
             "Accept": "application/json",
             "Authorization": f"Bearer {project_data['primary_repo_token']}",
         }
 
+    return webhook_url, payload, headers
+
+
+def add_secondary_hook_to_repo(project_webhook_url, project_id):
+    """Add the webhook reporting new comments and merges to the secondary
+    repository.
+
+    Its deliveries get the PR synced right away, the polling of open PRs
+    only catches the ones that were lost.
+    """
+    project = Project.objects.get(id=project_id)
+    try:
+        webhook_url, payload, headers = secondary_hook(project_webhook_url, project)
+    except RequestException as err:
+        # Bitbucket couldn't be reached for an access token
+        logger.warning("Could not add the secondary webhook: %s", err)
+        return None
+    response = create_hook(webhook_url, payload, headers)
+    if response is not None:
+        activity = f"{project.owner} added the secondary repository webhook, webhook create status -> {response.status_code}"
+        log_activity(
+            user=project.owner,
+            activity=activity,
+            status=response.status_code in (200, 201),
+            project=project,
+        )
+    return response
+
+
+def secondary_hook(project_webhook_url, project):
+    """Return the hooks url of the secondary repository, and the payload and
+    headers adding the project's webhook to it."""
+    webhook_url = clean_url(project.secondary_repo_webhook_url)
+    project_webhook_url = public_webhook_url(project_webhook_url)
+    if project.secondary_repo_type == RepoTypeChoices.GITHUB:
+        payload = {
+            "name": "web",
+            "active": True,
+            "events": ["pull_request", "pull_request_review_comment"],
+            "config": {
+                "url": project_webhook_url,
+                "content_type": "json",
+                "secret": webhook_secret(project.id),
+            },
+        }
+        headers = {
+            "Accept": "application/vnd.github+json",
+            "Authorization": f"Bearer {crypt.decrypt(project.secondary_repo_token)}",
+            "X-GitHub-Api-Version": "2022-11-28",
+        }
+    else:
+        credentials = {
+            "refresh_token": project.secondary_refresh_token,
+            "client_id": project.secondary_client_id,
+            "client_secret": project.secondary_client_secret,
+        }
+        token = get_bitbucket_access_token(crypt.multi_decrypt(credentials))
+        payload = {
+            "description": f"Auto webhook from {project.primary_repo_name}",
+            "url": project_webhook_url,
+            "active": True,
+            "events": ["pullrequest:comment_created", "pullrequest:fulfilled"],
+            "secret": webhook_secret(project.id),
+        }
+        headers = {"Accept": "application/json", "Authorization": f"Bearer {token}"}
+
+    return webhook_url, payload, headers
+
+
+def create_hook(webhook_url, payload, headers):
+    """Post a webhook to a provider, returning None when it can't be
+    reached."""
     try:
-        response = requests.post(
+        return get_session(webhook_url).post(
             webhook_url,
             data=json.dumps(payload),
             headers=headers,
-            timeout=3000,
+            timeout=settings.HTTP_TIMEOUT,
         )
     except (RequestError, RequestTimeout, ResponseTimeout):
-        response = None
-    if response:
-        status = False
-        user = User.objects.get(email=user)
-        project = Project.objects.get(id=project_data["id"])
-        activity = f"{user} initialized a project, webhook create status -> {response.status_code}"
-        if response.status_code in [200, 201]:
+        return None
 
-            status = True
-        log_activity(user=user, activity=activity, status=status, project=project)
 
-    return response
+def bitbucket_token_key(credentials: dict):
+    """Cache key of the access token of a set of Bitbucket credentials."""
+    identity = f"{credentials['client_id']}|{credentials['refresh_token']}"
+    return f"bitbucket:token:{hashlib.sha256(identity.encode()).hexdigest()}"
+
+
+def cached_bitbucket_token(credentials: dict):
+    """Return the cached access token of the credentials, if still fresh."""
+    return crypt.decrypt(cache.get(bitbucket_token_key(credentials)))
+
+
+def get_bitbucket_access_token(credentials: dict):
+    """Return an access token for the credentials, only refreshing it when the
+    cached one is close to expiry.
+
+    A single worker refreshes a given set of credentials at a time,
+    others wait for its token instead of refreshing it again.
+    """
+    token = cached_bitbucket_token(credentials)
+    if token:
+        return token
+
+    lock_key = bitbucket_token_key(credentials) + ":refresh"
+    deadline = time.monotonic() + settings.BITBUCKET_TOKEN_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        with cache_lock(lock_key, settings.BITBUCKET_TOKEN_LOCK_TIMEOUT) as acquired:
+            if acquired:
+                # The previous holder may have refreshed it while we waited
+                return cached_bitbucket_token(credentials) or refresh_bitbucket_token(
+                    credentials
+                )
+        time.sleep(0.1)
+        token = cached_bitbucket_token(credentials)
+        if token:
+            return token
+    return refresh_bitbucket_token(credentials)
 
 
 def refresh_bitbucket_token(credentials: dict):
     """This function accepts a dictionary of credentials needed to generate a
-    new access token."""
+    new access token.
+
+    The token is cached, encrypted, until shortly before it expires.
+    Raises RequestException when Bitbucket can't be reached.
+    """
     url = "https://bitbucket.org/site/oauth2/access_token"
     data = {
         "grant_type": "refresh_token",
@@ -128,10 +259,57 @@ def refresh_bitbucket_token(credentials: dict):
         "client_id": credentials["client_id"],
         "client_secret": credentials["client_secret"],
     }
-    req = MakeRequest(url)
+    req = MakeRequest(url, raise_errors=True)
     response = req.post(data)
     content = response.json()
     status = response.status_code
     if status == 200:
-        return content.get("access_token")
+        token = content.get("access_token")
+        timeout = content.get("expires_in", 0) - settings.BITBUCKET_TOKEN_EXPIRY_MARGIN
+        if timeout > 0:
+            cache.set(bitbucket_token_key(credentials), crypt.encrypt(token), timeout)
+        return token
     return content
+
+
+def register_hook(hooks_url, payload, headers):
+    """Update the repository's hook delivering to the payload's url, or add it
+    when the repository has none.
+
+    Hooks are matched on the path of their url, the host they deliver to
+    may have been rewritten for the provider. Every page of hooks is
+    looked at. The listing's response is returned when the hooks can't
+    be listed, None when the provider can't be reached.
+    """
+    github = "config" in payload
+    webhook_path = urlsplit(payload["config"]["url"] if github else payload["url"]).path
+    session = get_session(hooks_url)
+    hooks, url = [], hooks_url
+    while url:
+        try:
+            response = session.get(url, headers=headers, timeout=settings.HTTP_TIMEOUT)
+        except (RequestError, RequestTimeout, ResponseTimeout):
+            return None
+        if response.status_code != 200:
+            # Registering blindly could add the hook a second time
+            return response
+        content = response.json()
+        if github:
+            hooks.extend(content)
+            url = response.links.get("next", {}).get("url")
+        else:
+            hooks.extend(content.get("values", []))
+            url = content.get("next")
+
+    for hook in hooks:
+        hook_url = hook["config"].get("url", "") if github else hook.get("url", "")
+        if urlsplit(hook_url).path == webhook_path:
+            hook_id = hook["id"] if github else hook["uuid"]
+            # GitHub edits hooks with PATCH, Bitbucket with PUT
+            return getattr(session, "patch" if github else "put")(
+                f"{hooks_url}/{hook_id}",
+                data=json.dumps(payload),
+                headers=headers,
+                timeout=settings.HTTP_TIMEOUT,
+            )
+    return create_hook(hooks_url, payload, headers)
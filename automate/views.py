@@ -1,13 +1,34 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.http import HttpResponseNotAllowed, JsonResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import filters, status, viewsets
+from rest_framework import filters, viewsets
 from rest_framework.decorators import action
-from rest_framework.permissions import AllowAny
-from rest_framework.response import Response
 
-from .filtersets import RepositoryFilter
-from .models import Project
-from .serializers import ProjectSerializer, WebHookSerializer
+from repo.pagination import CreatedCursorPagination
+
+from .choices import RepoTypeChoices
+from .filtersets import ProjectSearchFilter, RepositoryFilter
+from .models import History, Project, WebhookEvent
+from .serializers import HistorySerializer, ProjectActivitySerializer, ProjectSerializer
+from .tasks import wake_comment_sync, wake_drain
+from .webhooks import (
+    claim_delivery,
+    count_route,
+    delivery_route,
+    event_errors,
+    event_pull_request_url,
+    payload_errors,
+    project_cache_key,
+    project_id_for,
+    slim_payload,
+    verify_signature,
+)
 
 
 class ProjectViewSets(viewsets.ModelViewSet):
@@ -25,19 +46,12 @@ class ProjectViewSets(viewsets.ModelViewSet):
     # Added filter backends to settings and they stopped working along with knox auth
     filter_backends = [
         DjangoFilterBackend,
-        filters.SearchFilter,
+        ProjectSearchFilter,
         filters.OrderingFilter,
     ]
     filterset_class = RepositoryFilter
-    search_fields = [
-        "id",
-        "name",
-        "slug",
-        "primary_repo",
-        "secondary_repo",
-        "primary_repo_type",
-        "secondary_repo_type",
-    ]
+    # Default ordering of the cursor pagination, see CreatedCursorPagination
+    ordering = CreatedCursorPagination.ordering
 
     def get_queryset(self):
         owner = self.request.user
@@ -48,17 +62,163 @@ class ProjectViewSets(viewsets.ModelViewSet):
         context["owner"] = self.request.user
         return context
 
-    @action(
-        detail=False,
-        methods=["POST"],
-        url_path="(?P<slug>[\w-]+)/webhook",
-        permission_classes=[AllowAny],
-    )
-    def webhook(self, request, slug):
-        """This is the webhook action called by the PR on PR changes."""
-        queryset = get_object_or_404(Project, slug=slug)
-        serializer = WebHookSerializer(
-            data=request.data, context={"queryset": queryset}
+    @staticmethod
+    def paginated_response(request, queryset, serializer_class):
+        """Return a page of queryset, newest first."""
+        paginator = CreatedCursorPagination()
+        page = paginator.paginate_queryset(queryset, request)
+        serializer = serializer_class(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=["GET"])
+    def activities(self, request, slug=None):
+        """List the activities of a project, newest first."""
+        project = get_object_or_404(self.get_queryset(), slug=slug)
+        return self.paginated_response(
+            request, project.projectactivities_set.all(), ProjectActivitySerializer
         )
-        serializer.is_valid(raise_exception=True)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=["GET"])
+    def history(self, request, slug=None):
+        """List the PRs replicated for a project, newest first."""
+        project = get_object_or_404(self.get_queryset(), slug=slug)
+        return self.paginated_response(
+            request, project.history_set.all(), HistorySerializer
+        )
+
+
+def replicate_pull_request(headers, project_id, data):
+    """Write a pull request event to the webhook inbox for its PR to be
+    replicated."""
+    # Redeliveries are acknowledged without queueing the job again
+    keys = claim_delivery(project_id, data, headers)
+    if keys is None:
+        return "duplicate"
+    try:
+        WebhookEvent.objects.create(project_id=project_id, payload=slim_payload(data))
+    except Exception:
+        # Let the provider's retry through
+        cache.delete_many(keys)
+        raise
+    return "queued"
+
+
+def sync_secondary_pull_request(_headers, project_id, data):
+    """Mark the open PR a secondary repository event is about as due a sync.
+
+    The comment check picks it up, so a burst of comments on a PR is
+    synced once.
+    """
+    url = event_pull_request_url(data)
+    updated = url and (
+        History.objects.filter(
+            project_id=project_id, url=url, action="open", merged_at=None
+        ).update(next_check_at=timezone.now())
+    )
+    return "queued" if updated else "dropped"
+
+
+# (provider, event, action) -> handler of the deliveries worth acting on.
+# Other deliveries are acknowledged and dropped.
+WEBHOOK_ROUTES = {
+    (RepoTypeChoices.GITHUB.value, "pull_request", "closed"): replicate_pull_request,
+}
+
+# Comments and merges on the secondary repository
+SECONDARY_WEBHOOK_ROUTES = dict.fromkeys(
+    [
+        (RepoTypeChoices.GITHUB.value, "pull_request_review_comment", "created"),
+        (RepoTypeChoices.GITHUB.value, "pull_request", "closed"),
+        (RepoTypeChoices.BITBUCKET.value, "pullrequest", "comment_created"),
+        (RepoTypeChoices.BITBUCKET.value, "pullrequest", "fulfilled"),
+    ],
+    sync_secondary_pull_request,
+)
+
+# repository -> routes of its deliveries and the validation of routed ones
+WEBHOOK_REPOS = {
+    "primary": (WEBHOOK_ROUTES, payload_errors),
+    "secondary": (SECONDARY_WEBHOOK_ROUTES, event_errors),
+}
+
+WEBHOOK_RESPONSES = {
+    "queued": ({"queued": True}, 202),
+    "duplicate": ({"queued": False, "duplicate": True}, 200),
+    "dropped": ({"queued": False}, 200),
+}
+
+
+def ingest_webhook(slug, body, headers, repo="primary"):
+    """Verify and route a webhook delivery from one of a project's
+    repositories, returning the outcome and the response content and status.
+
+    This is the blocking part of the webhook, it only touches the cache
+    and makes a single write.
+    """
+    project_id = project_id_for(slug)
+    if project_id is None:
+        return "missing", {"detail": "Not found."}, 404
+    if not verify_signature(project_id, body, headers):
+        return "forbidden", {"detail": "Invalid signature."}, 403
+
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        return "invalid", {"detail": "Invalid JSON."}, 400
+
+    routes, validate = WEBHOOK_REPOS[repo]
+    route = delivery_route(headers, data)
+    handler = routes.get(route)
+    # Only the deliveries acted on are validated, pings and pushes are dropped
+    errors = validate(data) if handler else None
+    if errors:
+        return "invalid", errors, 400
+    try:
+        outcome = "dropped" if handler is None else handler(headers, project_id, data)
+    except IntegrityError:
+        # The project was deleted since its id was cached
+        cache.delete(project_cache_key(slug))
+        return "missing", {"detail": "Not found."}, 404
+    count_route(route, routes, outcome, repo)
+    return (outcome, *WEBHOOK_RESPONSES[outcome])
+
+
+async def receive_webhook(request, slug, repo, wake):
+    """Ingest a webhook delivery and wake the task acting on it when it was
+    queued."""
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    outcome, content, status = await sync_to_async(ingest_webhook)(
+        slug, request.body, request.META, repo
+    )
+    if outcome == "queued":
+        # The broker may be slow or down, keep it off the database thread
+        await sync_to_async(wake, thread_sensitive=False)()
+    return JsonResponse(content, status=status)
+
+
+async def project_webhook(request, slug):
+    """This is the webhook called by the PR on PR changes.
+
+    It only verifies the delivery and routes it, writing the events
+    worth acting on to the webhook inbox. Providers get an answer in
+    milliseconds even when the broker is down. The view is async, so
+    under ASGI a worker holds many slow deliveries at once while only
+    the short database work runs in a thread.
+    """
+    return await receive_webhook(request, slug, "primary", wake_drain)
+
+
+async def secondary_webhook(request, slug):
+    """This is the webhook called by the secondary repository on new comments
+    and merges.
+
+    The PR they are about is marked due and synced right away, instead
+    of waiting for its next poll.
+    """
+    return await receive_webhook(request, slug, "secondary", wake_comment_sync)
+
+
+# Django's csrf_exempt decorator hides coroutine views from Django 3.2
+project_webhook.csrf_exempt = True
+secondary_webhook.csrf_exempt = True
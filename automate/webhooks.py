@@ -0,0 +1,232 @@
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import force_bytes
+
+from automate.choices import RepoTypeChoices
+from automate.models import Project
+
+SIGNATURE_HEADERS = ("HTTP_X_HUB_SIGNATURE_256", "HTTP_X_HUB_SIGNATURE")
+DELIVERY_HEADERS = ("HTTP_X_GITHUB_DELIVERY", "HTTP_X_REQUEST_UUID")
+PAYLOAD_FIELDS = ("action", "pull_request")
+PULL_REQUEST_FIELDS = ("id", "url", "title", "head")
+ROUTE_OUTCOMES = ("queued", "duplicate", "dropped")
+
+
+def webhook_secret(project_id):
+    """Return the secret providers sign the webhook deliveries of a project
+    with.
+
+    It is derived from SECRET_KEY, so it never needs to be stored.
+    """
+    return hmac.new(
+        force_bytes(settings.SECRET_KEY),
+        f"webhook:{project_id}".encode(),
+        hashlib.sha256,
+    ).hexdigest()
+
+
+def verify_signature(project_id, body, headers):
+    """Check the sha256 HMAC signature of a webhook delivery.
+
+    Unsigned deliveries are accepted only when WEBHOOK_REQUIRE_SIGNATURE
+    is off.
+    """
+    signature = next(
+        (headers[header] for header in SIGNATURE_HEADERS if headers.get(header)),
+        None,
+    )
+    if signature is None:
+        return not settings.WEBHOOK_REQUIRE_SIGNATURE
+    digest = hmac.new(
+        webhook_secret(project_id).encode(), body, hashlib.sha256
+    ).hexdigest()
+    try:
+        # compare_digest only takes ASCII strings, forged headers may hold others
+        signature = signature.encode("ascii")
+    except UnicodeEncodeError:
+        return False
+    return hmac.compare_digest(signature, f"sha256={digest}".encode())
+
+
+def project_cache_key(slug):
+    """Return the cache key of the id of the project a webhook slug belongs
+    to."""
+    return f"webhook:project:{slug}"
+
+
+def project_id_for(slug):
+    """Return the id of the project a webhook slug belongs to, if any."""
+    key = project_cache_key(slug)
+    project_id = cache.get(key)
+    if project_id is None:
+        project_id = (
+            Project.objects.filter(slug=slug).values_list("id", flat=True).first()
+        )
+        if project_id is not None:
+            cache.set(key, project_id, settings.WEBHOOK_PROJECT_CACHE_TIMEOUT)
+    return project_id
+
+
+def delivery_route(headers, data):
+    """Return the (provider, event, action) a webhook delivery is routed by.
+
+    Bitbucket names both in X-Event-Key, e.g. "pullrequest:fulfilled".
+    Deliveries without an event header are GitHub pull request events.
+    """
+    event_key = headers.get("HTTP_X_EVENT_KEY")
+    if event_key:
+        event, _, action = event_key.partition(":")
+        return RepoTypeChoices.BITBUCKET.value, event, action
+    action = data.get("action") if isinstance(data, dict) else None
+    return (
+        RepoTypeChoices.GITHUB.value,
+        headers.get("HTTP_X_GITHUB_EVENT", "pull_request"),
+        action if isinstance(action, str) else "",
+    )
+
+
+def route_counter(route, routes):
+    """Return the counter a delivery is accounted under.
+
+    Routed deliveries count under their route, others under their event
+    when it has routes, or else under their provider.
+    """
+    provider, event, _ = route
+    if route in routes:
+        return route
+    if any(key[:2] == (provider, event) for key in routes):
+        return provider, event, "*"
+    return provider, "*", "*"
+
+
+def route_key(repo, counter, outcome):
+    """Return the cache key of a counter of a repository's deliveries."""
+    return "webhook:route:{}:{}:{}:{}:{}".format(repo, *counter, outcome)
+
+
+def count_route(route, routes, outcome, repo="primary"):
+    """Add a delivery to the counter of its route."""
+    key = route_key(repo, route_counter(route, routes), outcome)
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # The counter was evicted in between
+            cache.add(key, 1, None)
+
+
+def route_counters(routes, repo="primary"):
+    """Return the queued, duplicate and dropped deliveries of every counter."""
+    counters = set(routes)
+    for provider, event, _ in routes:
+        counters.add((provider, event, "*"))
+    counters.update((provider, "*", "*") for provider in RepoTypeChoices.values)
+
+    keys = {
+        (counter, outcome): route_key(repo, counter, outcome)
+        for counter in counters
+        for outcome in ROUTE_OUTCOMES
+    }
+    values = cache.get_many(keys.values())
+    return {
+        counter: {
+            outcome: values.get(keys[counter, outcome], 0) for outcome in ROUTE_OUTCOMES
+        }
+        for counter in sorted(counters)
+    }
+
+
+def claim_delivery(project_id, data, headers):
+    """Record a webhook delivery by its delivery id and by its (project, PR,
+    action).
+
+    Returns the recorded cache keys, or None when the delivery or the
+    same event was seen within the last WEBHOOK_DEDUP_TIMEOUT seconds.
+    """
+    keys = []
+    delivery = next(
+        (headers[header] for header in DELIVERY_HEADERS if headers.get(header)),
+        None,
+    )
+    if delivery:
+        keys.append(f"webhook:delivery:{delivery}")
+    keys.append(
+        f"webhook:event:{project_id}:{data['pull_request']['id']}:{data['action']}"
+    )
+
+    claimed = []
+    for key in keys:
+        if not cache.add(key, True, settings.WEBHOOK_DEDUP_TIMEOUT):
+            cache.delete_many(claimed)
+            return None
+        claimed.append(key)
+    return claimed
+
+
+def payload_errors(data):
+    """Return the required fields missing from a pull request event."""
+    if not isinstance(data, dict):
+        return {"non_field_errors": ["Invalid data. Expected a dictionary."]}
+    errors = {
+        field: ["This field is required."]
+        for field in PAYLOAD_FIELDS
+        if data.get(field) in (None, "")
+    }
+    pull_request = data.get("pull_request")
+    if isinstance(pull_request, dict):
+        missing = {
+            field: ["This field is required."]
+            for field in PULL_REQUEST_FIELDS
+            if pull_request.get(field) in (None, "")
+        }
+        head = pull_request.get("head") or {}
+        if not head.get("ref"):
+            missing["head"] = {"ref": ["This field is required."]}
+        if missing:
+            errors["pull_request"] = missing
+    return errors
+
+
+def slim_payload(data):
+    """Return the fields of a pull request event the git job needs."""
+    pull_request = data["pull_request"]
+    head = pull_request["head"]
+    return {
+        "action": data["action"],
+        "pull_request": {
+            "id": pull_request["id"],
+            "url": pull_request["url"],
+            "title": pull_request["title"],
+            "body": pull_request.get("body"),
+            "head": {
+                "ref": head["ref"],
+                "repo": {"name": (head.get("repo") or {}).get("name")},
+            },
+        },
+    }
+
+
+def event_errors(data):
+    """Return why a secondary repository event can't be read, if it can't."""
+    if not isinstance(data, dict):
+        return {"non_field_errors": ["Invalid data. Expected a dictionary."]}
+    return {}
+
+
+def event_pull_request_url(data):
+    """Return the API url of the pull request a secondary repository event is
+    about.
+
+    GitHub sends it with the pull request, Bitbucket as the pull
+    request's self link.
+    """
+    pull_request = data.get("pull_request")
+    if isinstance(pull_request, dict):
+        return pull_request.get("url")
+    pull_request = data.get("pullrequest")
+    if isinstance(pull_request, dict):
+        return ((pull_request.get("links") or {}).get("self") or {}).get("href")
+    return None
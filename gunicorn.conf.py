@@ -0,0 +1,24 @@
+"""Gunicorn settings of the API and of the webhook service.
+
+The API runs threaded WSGI workers, so a request blocked on a provider
+only holds its own thread. Webhook deliveries are served by the same
+settings with uvicorn workers, see docker-compose.yml:
+
+    gunicorn -c gunicorn.conf.py repo.wsgi:application
+    GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker \
+        gunicorn -c gunicorn.conf.py repo.asgi:application
+"""
+import decouple
+
+# Gunicorn treats the names defined here as settings, "config" being one of them
+bind = decouple.config("GUNICORN_BIND", default="0.0.0.0:8000")
+workers = decouple.config("GUNICORN_WORKERS", default=2, cast=int)
+worker_class = decouple.config("GUNICORN_WORKER_CLASS", default="gthread")
+threads = decouple.config("GUNICORN_THREADS", default=8, cast=int)
+# gthread workers cut off requests running longer than this many seconds, uvicorn
+# workers only use it as a heartbeat timeout. Idle keep-alive connections are closed
+# after keepalive seconds.
+timeout = decouple.config("GUNICORN_TIMEOUT", default=30, cast=int)
+keepalive = decouple.config("GUNICORN_KEEPALIVE", default=5, cast=int)
+reload = decouple.config("DEBUG", default=False, cast=bool)
+accesslog = "-"
@@ -11,8 +11,16 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
 
 app.conf.beat_schedule = {
-    "check-for-comment-updates-every-30-minutes": {
-        "task": "tasks.check_new_comments",
-        "schedule": timedelta(minutes=30),
-    }
+    "check-for-due-comment-updates-every-minute": {
+        "task": "automate.tasks.check_new_comments",
+        "schedule": timedelta(minutes=1),
+    },
+    "drain-webhook-inbox-every-10-seconds": {
+        "task": "automate.tasks.drain_webhook_events",
+        "schedule": timedelta(seconds=10),
+    },
+    "purge-processed-webhook-events-every-hour": {
+        "task": "automate.tasks.purge_webhook_events",
+        "schedule": timedelta(hours=1),
+    },
 }
@@ -0,0 +1,13 @@
+from rest_framework.pagination import CursorPagination
+
+
+class CreatedCursorPagination(CursorPagination):
+    """Keyset pagination over the newest rows first.
+
+    Pages are fetched with a ``created_at`` range on an index instead of
+    an offset, so deep pages cost as much as the first one.
+    """
+
+    ordering = ("-created_at", "-id")
+    page_size_query_param = "page_size"
+    max_page_size = 100
@@ -11,7 +11,8 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 
 from pathlib import Path
 
-from decouple import config
+from decouple import Choices, config
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management.utils import get_random_secret_key
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -39,6 +40,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "automate",
     "repo",
     "accounts",
@@ -52,6 +54,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -133,6 +136,10 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/4.1/howto/static-files/
 
 STATIC_URL = "static/"
+STATIC_ROOT = BASE_DIR / "staticfiles"
+# Gunicorn doesn't serve static files, whitenoise serves them from the apps
+# until collectstatic has filled STATIC_ROOT
+WHITENOISE_USE_FINDERS = True
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
@@ -147,6 +154,8 @@ REST_FRAMEWORK = {
     ),
     "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.IsAuthenticated",),
     "DEFAULT_FILTER_BACKENDS": ("django_filters.rest_framework.DjangoFilterBackend",),
+    "DEFAULT_PAGINATION_CLASS": "repo.pagination.CreatedCursorPagination",
+    "PAGE_SIZE": config("PAGE_SIZE", default=20, cast=int),
 }
 
 SPECTACULAR_SETTINGS = {
@@ -166,14 +175,142 @@ REST_KNOX = {
     "AUTO_REFRESH": False,
 }
 
-CELERY_BROKER_URL = "redis://redis:6379"
-CELERY_RESULT_BACKEND = "redis://redis:6379"
+# Cache shared by the web and celery processes for locks and short lived state.
+# The in-memory default only suits a single process while developing.
+CACHES = {
+    "default": {
+        "BACKEND": config(
+            "CACHE_BACKEND", default="django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": config("CACHE_LOCATION", default=""),
+    }
+}
+
+# Locks, dedup keys, sync slots, breakers and rate limit budgets live in the cache,
+# a per-process cache would let every process take them for itself
+if not DEBUG and CACHES["default"]["BACKEND"].endswith("LocMemCache"):
+    raise ImproperlyConfigured(
+        "CACHE_BACKEND must be shared by every process when DEBUG is off, "
+        "e.g. django_redis.cache.RedisCache"
+    )
+
+CELERY_BROKER_URL = config("CELERY_BROKER_URL", default="redis://redis:6379")
+CELERY_RESULT_BACKEND = config("CELERY_RESULT_BACKEND", default="redis://redis:6379")
 # CELERY_BROKER_URL = "redis://127.0.0.1:6379/0"
 # CELERY_RESULT_BACKEND = "redis://127.0.0.1:6379/0"
 
+# Keep-alive connections to provider APIs, pooled per process and host.
+# Requests give up after HTTP_CONNECT_TIMEOUT seconds connecting or HTTP_READ_TIMEOUT seconds waiting for data.
+HTTP_POOL_CONNECTIONS = config("HTTP_POOL_CONNECTIONS", default=4, cast=int)
+HTTP_POOL_MAXSIZE = config("HTTP_POOL_MAXSIZE", default=10, cast=int)
+HTTP_CONNECT_TIMEOUT = config("HTTP_CONNECT_TIMEOUT", default=5, cast=float)
+HTTP_READ_TIMEOUT = config("HTTP_READ_TIMEOUT", default=60, cast=float)
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+# Failed requests are retried HTTP_RETRIES times, waiting a random delay of up to
+# HTTP_RETRY_BACKOFF * 2 ** attempt seconds, or what Retry-After asks. Requests that would
+# wait longer than HTTP_RETRY_MAX_DELAY seconds are not retried.
+HTTP_RETRIES = config("HTTP_RETRIES", default=3, cast=int)
+HTTP_RETRY_BACKOFF = config("HTTP_RETRY_BACKOFF", default=0.5, cast=float)
+HTTP_RETRY_MAX_DELAY = config("HTTP_RETRY_MAX_DELAY", default=10, cast=float)
+# A host failing HTTP_BREAKER_THRESHOLD times in a row isn't called for HTTP_BREAKER_COOLDOWN seconds
+HTTP_BREAKER_THRESHOLD = config("HTTP_BREAKER_THRESHOLD", default=5, cast=int)
+HTTP_BREAKER_COOLDOWN = config("HTTP_BREAKER_COOLDOWN", default=60, cast=int)
+# Requests of a credential left to merges and PR creation by the comment polling
+HTTP_RATELIMIT_RESERVE = config("HTTP_RATELIMIT_RESERVE", default=500, cast=int)
+
+# Webhook deliveries must carry a valid X-Hub-Signature-256 signature.
+# Hooks created before signing was introduced get their secret from
+# `manage.py register_webhooks --domain <url>`, turn this off until it has run.
+WEBHOOK_REQUIRE_SIGNATURE = config("WEBHOOK_REQUIRE_SIGNATURE", default=True, cast=bool)
+# Scheme and host of the webhooks service hooks are registered with, the API's own when empty
+WEBHOOK_DOMAIN = config("WEBHOOK_DOMAIN", default="")
+# How long the project id of a webhook slug is cached, in seconds
+WEBHOOK_PROJECT_CACHE_TIMEOUT = config(
+    "WEBHOOK_PROJECT_CACHE_TIMEOUT", default=5 * 60, cast=int
+)
+
+# Webhook deliveries seen again within this many seconds, by delivery id or by project,
+# PR and action, are dropped
+WEBHOOK_DEDUP_TIMEOUT = config("WEBHOOK_DEDUP_TIMEOUT", default=10 * 60, cast=int)
+
+# Decrypted credentials kept in each process' memory, and for how many seconds
+CREDENTIAL_CACHE_SIZE = config("CREDENTIAL_CACHE_SIZE", default=256, cast=int)
+CREDENTIAL_CACHE_TIMEOUT = config("CREDENTIAL_CACHE_TIMEOUT", default=5 * 60, cast=int)
+
+# Bitbucket access tokens are refreshed this many seconds before they expire.
+# Workers wait up to BITBUCKET_TOKEN_LOCK_TIMEOUT seconds for another worker's refresh.
+BITBUCKET_TOKEN_EXPIRY_MARGIN = config(
+    "BITBUCKET_TOKEN_EXPIRY_MARGIN", default=5 * 60, cast=int
+)
+BITBUCKET_TOKEN_LOCK_TIMEOUT = config(
+    "BITBUCKET_TOKEN_LOCK_TIMEOUT", default=10, cast=int
+)
+
+# Open PRs synced at the same time by check_new_comments, it only dispatches as many as
+# there are free slots. Syncs that still find none retry every COMMENT_SYNC_RETRY_DELAY
+# seconds, COMMENT_SYNC_MAX_RETRIES times, then wait for the next dispatch.
+# A sync holds its slot for COMMENT_SYNC_SLOT_TIMEOUT at most.
+COMMENT_SYNC_CONCURRENCY = config("COMMENT_SYNC_CONCURRENCY", default=4, cast=int)
+COMMENT_SYNC_RETRY_DELAY = config("COMMENT_SYNC_RETRY_DELAY", default=10, cast=int)
+COMMENT_SYNC_MAX_RETRIES = config("COMMENT_SYNC_MAX_RETRIES", default=3, cast=int)
+COMMENT_SYNC_SLOT_TIMEOUT = config(
+    "COMMENT_SYNC_SLOT_TIMEOUT", default=10 * 60, cast=int
+)
+# A PR is not dispatched again while its previous sync is pending, for this long at most
+COMMENT_SYNC_TIMEOUT = config("COMMENT_SYNC_TIMEOUT", default=30 * 60, cast=int)
+# PRs with new comments are polled every COMMENT_POLL_MIN_INTERVAL seconds, idle ones
+# twice as rarely on each poll, up to every COMMENT_POLL_MAX_INTERVAL seconds
+COMMENT_POLL_MIN_INTERVAL = config("COMMENT_POLL_MIN_INTERVAL", default=60, cast=int)
+COMMENT_POLL_MAX_INTERVAL = config(
+    "COMMENT_POLL_MAX_INTERVAL", default=6 * 60 * 60, cast=int
+)
+# Open PRs of GitHub secondaries are looked up this many at a time in one GraphQL query
+GITHUB_STATUS_BATCH_SIZE = config("GITHUB_STATUS_BATCH_SIZE", default=100, cast=int)
+
+# How long conditional GET responses are kept for revalidation, in seconds
+HTTP_VALIDATOR_CACHE_TIMEOUT = config(
+    "HTTP_VALIDATOR_CACHE_TIMEOUT", default=24 * 60 * 60, cast=int
+)
+
 GITHUB_BASE_URL = "https://api.github.com"
 BITBUCKET_BASE_URL = "https://api.bitbucket.org/2.0"
 
+# Bare mirrors of primary repositories, reused across replications
+GIT_MIRROR_ROOT = config("GIT_MIRROR_ROOT", default=str(BASE_DIR / "mirrors"))
+GIT_MIRROR_QUOTA = config("GIT_MIRROR_QUOTA", default=10 * 1024**3, cast=int)
+
+# "mirror" reuses the mirrors above, "refs" fetches only the PR branch into a throwaway bare repo
+# Other values are refused, see automate.choices.ReplicationModeChoices
+GIT_REPLICATION_MODE = config(
+    "GIT_REPLICATION_MODE", default="mirror", cast=Choices(["mirror", "refs"])
+)
+# Partial clone filter and history depth used by the "refs" mode. Empty disables them.
+GIT_FETCH_FILTER = config("GIT_FETCH_FILTER", default="blob:none")
+GIT_FETCH_DEPTH = config("GIT_FETCH_DEPTH", default=0, cast=int)
+
+# Git jobs of a project run one at a time, waiting jobs retry after GIT_JOB_RETRY_DELAY seconds
+GIT_JOB_LOCK_TIMEOUT = config("GIT_JOB_LOCK_TIMEOUT", default=60 * 60, cast=int)
+GIT_JOB_RETRY_DELAY = config("GIT_JOB_RETRY_DELAY", default=30, cast=int)
+
+# Webhook events claimed from the inbox per drain. Claims not finished within
+# WEBHOOK_CLAIM_TIMEOUT seconds are given to the next drain.
+WEBHOOK_DRAIN_BATCH_SIZE = config("WEBHOOK_DRAIN_BATCH_SIZE", default=100, cast=int)
+WEBHOOK_CLAIM_TIMEOUT = config("WEBHOOK_CLAIM_TIMEOUT", default=2 * 60 * 60, cast=int)
+# Failed events are drained again after WEBHOOK_RETRY_DELAY * 2 ** attempt seconds, and
+# given up after WEBHOOK_MAX_ATTEMPTS. Processed events are deleted after
+# WEBHOOK_RETENTION seconds.
+WEBHOOK_MAX_ATTEMPTS = config("WEBHOOK_MAX_ATTEMPTS", default=5, cast=int)
+WEBHOOK_RETRY_DELAY = config("WEBHOOK_RETRY_DELAY", default=60, cast=int)
+WEBHOOK_RETENTION = config("WEBHOOK_RETENTION", default=7 * 24 * 60 * 60, cast=int)
+
+# "database" writes buffered activities from the task that logged them, "queue"
+# sends them through the broker for a worker to write. Other values are refused, see
+# automate.choices.ActivitySinkChoices
+ACTIVITY_SINK = config(
+    "ACTIVITY_SINK", default="database", cast=Choices(["database", "queue"])
+)
+
 
 # Custom User
 AUTH_USER_MODEL = "accounts.User"
@@ -0,0 +1,126 @@
+import datetime
+import ipaddress
+import json
+import os
+import shutil
+import ssl
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+
+def make_certificate(directory):
+    """Write a self-signed certificate for 127.0.0.1 and its key to directory
+    and return their paths."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.utcnow()
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as file:
+        file.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as file:
+        file.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return cert_path, key_path
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Request handler answering every request through the server's ``respond``
+    callable."""
+
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        """Answer the request with the status, headers and JSON body returned
+        by the server's respond callable."""
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.server.requests.append((self.command, self.path, dict(self.headers), body))
+        status, headers, data = self.server.respond(self)
+        content = json.dumps(data).encode() if data is not None else b""
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = handle_request
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keep test output quiet."""
+
+
+class LocalHTTPSServer(ThreadingHTTPServer):
+    """HTTPS stand-in for provider APIs, counting the TLS connections it
+    accepts.
+
+    Use it as a context manager. ``respond`` receives the request
+    handler and returns a (status, headers, JSON data) tuple, and
+    ``ca_bundle`` is the certificate clients must trust.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, respond=None):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.respond = respond or (lambda handler: (200, {}, {}))
+        self.requests = []
+        self.connections = 0
+        self._directory = tempfile.mkdtemp()
+        self.ca_bundle, key_path = make_certificate(self._directory)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.ca_bundle, key_path)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """Base url of the server."""
+        return f"https://127.0.0.1:{self.server_address[1]}"
+
+    def get_request(self):
+        """Accept a connection, completing its TLS handshake."""
+        request = super().get_request()
+        self.connections += 1
+        return request
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+        shutil.rmtree(self._directory, ignore_errors=True)
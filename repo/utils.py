@@ -1,72 +1,392 @@
+import hashlib
 import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
 
 import requests
-from requests.exceptions import RequestException
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectTimeout, RequestException
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Responses worth retrying. Other methods than IDEMPOTENT_METHODS are only
+# retried when the provider surely didn't act on them.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("get", "head", "put", "delete")
+
+# User visible requests, like merges and PR creation, are high priority.
+# Background polling is low priority and leaves them a reserve of requests.
+HIGH_PRIORITY = "high"
+LOW_PRIORITY = "low"
+
+
+def get_session(url):
+    """Return the keep-alive session this process uses for the url's host.
+
+    Sessions are pooled per process and host so provider calls reuse
+    their TCP and TLS connections instead of opening new ones.
+    """
+    parts = urlsplit(url)
+    # Keyed by pid too, as forked workers mustn't share their parent's sockets
+    key = (os.getpid(), parts.scheme, parts.netloc)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                # Sessions are shared by every credential, cookies set for one mustn't reach the others
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = HTTPAdapter(
+                    pool_connections=settings.HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _sessions[key] = session
+    return session
+
+
+@contextmanager
+def cache_lock(key, timeout):
+    """Hold a lock shared by every process using the cache.
+
+    Yields True when the lock was acquired and False when it is held
+    elsewhere. The lock expires after ``timeout`` seconds in case its
+    holder dies.
+    """
+    token = uuid.uuid4().hex
+    acquired = cache.add(key, token, timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired and cache.get(key) == token:
+            cache.delete(key)
+
+
+class CircuitOpenError(RequestException):
+    """Raised instead of calling a host that keeps failing."""
+
+
+class CircuitBreaker:
+    """Count the failures of a host across every process using the cache.
+
+    After HTTP_BREAKER_THRESHOLD failures in a row the circuit opens and
+    the host isn't called for HTTP_BREAKER_COOLDOWN seconds. The first
+    call after that is a trial, a single failure opens the circuit
+    again.
+    """
+
+    def __init__(self, host):
+        self.key = f"http:breaker:{host}"
+
+    def is_open(self):
+        """Whether calls to the host should fail fast."""
+        return bool(cache.get(self.key + ":open"))
+
+    def failure(self):
+        """Record a failed call, opening the circuit after too many."""
+        cooldown = settings.HTTP_BREAKER_COOLDOWN
+        if cache.add(self.key, 1, cooldown):
+            failures = 1
+        else:
+            try:
+                failures = cache.incr(self.key)
+            except ValueError:
+                # The counter expired in between
+                failures = 1
+                cache.add(self.key, 1, cooldown)
+        if failures >= settings.HTTP_BREAKER_THRESHOLD:
+            logger.warning("Circuit open for %s", self.key)
+            cache.set(self.key + ":open", True, cooldown)
+            # Outlive the open circuit, so the trial call decides alone
+            cache.set(self.key, settings.HTTP_BREAKER_THRESHOLD - 1, cooldown * 2)
+
+    def success(self):
+        """Record a successful call, closing the circuit."""
+        if cache.get(self.key):
+            cache.delete(self.key)
+
+
+class RateLimitedError(RequestException):
+    """Raised instead of spending the request budget a credential keeps for
+    more urgent work."""
+
+    def __init__(self, *args, retry_in=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_in = retry_in
+
+
+class RateLimit:
+    """Request budget of a credential on a host, shared by every process using
+    the cache.
+
+    The budget is the X-RateLimit-Remaining of the latest response,
+    taken from by every request until X-RateLimit-Reset. Low priority
+    requests leave HTTP_RATELIMIT_RESERVE requests to high priority
+    ones. Hosts that send no rate limit headers have no budget. GraphQL
+    endpoints have a budget of their own.
+    """
+
+    def __init__(self, url, headers):
+        parts = urlsplit(url)
+        resource = "graphql" if parts.path.rstrip("/").endswith("/graphql") else ""
+        identity = f"{parts.netloc}|{resource}|{headers.get('Authorization', '')}"
+        self.key = f"http:ratelimit:{hashlib.sha256(identity.encode()).hexdigest()}"
+
+    def acquire(self, priority):
+        """Take a request from the budget.
+
+        Returns 0, or the seconds until the budget resets when the
+        request has to wait for it.
+        """
+        reset = cache.get(self.key + ":reset")
+        if reset is None or reset <= time.time():
+            return 0
+        try:
+            remaining = cache.decr(self.key + ":remaining")
+        except ValueError:
+            return 0
+        reserve = settings.HTTP_RATELIMIT_RESERVE if priority == LOW_PRIORITY else 0
+        if remaining >= reserve:
+            return 0
+        # Give the request back, it isn't made
+        cache.incr(self.key + ":remaining")
+        return reset - time.time()
+
+    def update(self, response):
+        """Track the budget left according to a response."""
+        remaining = response.headers.get("X-RateLimit-Remaining", "")
+        reset = response.headers.get("X-RateLimit-Reset", "")
+        if not (remaining.isdigit() and reset.isdigit()):
+            return
+        timeout = int(reset) - time.time()
+        if timeout > 0:
+            cache.set_many(
+                {
+                    self.key + ":remaining": int(remaining),
+                    self.key + ":reset": int(reset),
+                },
+                timeout,
+            )
+
+
+def retry_after(response):
+    """Return the seconds a response asks to wait before retrying, if any."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+
+def backoff_delay(attempt, response=None):
+    """Return the seconds to wait before retry number ``attempt``.
+
+    The delay is drawn at random up to an exponential bound, so workers
+    failing together don't retry together, and is at least what the
+    Retry-After header asks. Returns None when that's longer than
+    HTTP_RETRY_MAX_DELAY, as the worker is better off doing something
+    else.
+    """
+    delay = random.uniform(0, settings.HTTP_RETRY_BACKOFF * 2**attempt)
+    if response is not None:
+        delay = max(delay, retry_after(response) or 0)
+    return delay if delay <= settings.HTTP_RETRY_MAX_DELAY else None
+
+
 class MakeRequest:
-    """This class handles all requests I make with exception handling."""
+    """This class handles all requests I make with exception handling.
+
+    With ``conditional`` on, GET responses are cached with their ETag or
+    Last-Modified validators and revalidated on the next request. An
+    unchanged resource then comes back as a 304, which GitHub doesn't
+    count against the rate limit, and the cached body is returned.
 
-    def __init__(self, url, headers=None):
+    Failed requests are retried up to HTTP_RETRIES times with backoff,
+    and hosts that keep failing are not called until their circuit
+    closes. Requests are taken from the rate limit budget of their
+    credential, see RateLimit. What is left of a failure is returned as
+    ``{"data": {"error": ...}}``, or raised with ``raise_errors`` on.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        url,
+        headers=None,
+        conditional=False,
+        raise_errors=False,
+        priority=HIGH_PRIORITY,
+    ):
         if headers is None:
             headers = {}
 
         self.url = url
         self.headers = headers
+        self.conditional = conditional
+        self.raise_errors = raise_errors
+        self.priority = priority
+
+    def wait_for_budget(self, ratelimit, host):
+        """Take a request from the rate limit budget of the credential in use.
+
+        High priority requests wait for a budget that resets soon,
+        others raise RateLimitedError.
+        """
+        wait = ratelimit.acquire(self.priority)
+        if not wait:
+            return
+        if self.priority == HIGH_PRIORITY and wait <= settings.HTTP_RETRY_MAX_DELAY:
+            time.sleep(wait)
+            return
+        raise RateLimitedError(
+            f"The rate limit of {host} resets in {wait:.0f}s",
+            retry_in=wait,
+        )
+
+    def validator_key(self, url):
+        """Cache key of a url's response for the credentials in use."""
+        identity = f"{url}|{self.headers.get('Authorization', '')}"
+        return f"http:validators:{hashlib.sha256(identity.encode()).hexdigest()}"
+
+    def revalidate(self, key, response, cached):
+        """Serve a 304 response from cache, or cache a fresh response that has
+        validators."""
+        if response.status_code == 304 and cached:
+            response.status_code = cached["status_code"]
+            response._content = cached["content"]  # pylint: disable=protected-access
+            response.encoding = cached["encoding"]
+            if cached.get("link"):
+                # Pages of a listing are followed by their Link header
+                response.headers["Link"] = cached["link"]
+            response.not_modified = True
+            return response
+
+        response.not_modified = False
+        validators = {}
+        if response.headers.get("ETag"):
+            validators["If-None-Match"] = response.headers["ETag"]
+        if response.headers.get("Last-Modified"):
+            validators["If-Modified-Since"] = response.headers["Last-Modified"]
+        if response.status_code == 200 and validators:
+            cached = {
+                "validators": validators,
+                "status_code": response.status_code,
+                "content": response.content,
+                "encoding": response.encoding,
+                "link": response.headers.get("Link"),
+            }
+            cache.set(key, cached, settings.HTTP_VALIDATOR_CACHE_TIMEOUT)
+        return response
+
+    def send(self, method, url, **kwargs):
+        """Make a request, retrying failures that are worth it.
+
+        Raises the last error when the request never got a response.
+        """
+        host = urlsplit(url).netloc
+        breaker = CircuitBreaker(host)
+        if breaker.is_open():
+            raise CircuitOpenError(f"{host} keeps failing, it isn't called for now")
+
+        ratelimit = RateLimit(url, kwargs.get("headers") or {})
+        idempotent = method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            self.wait_for_budget(ratelimit, host)
+            try:
+                response = getattr(get_session(url), method)(
+                    url, timeout=settings.HTTP_TIMEOUT, **kwargs
+                )
+            except RequestException as err:
+                breaker.failure()
+                # Connecting timed out before the request was sent
+                retryable = idempotent or isinstance(err, ConnectTimeout)
+                delay = None
+                if retryable and attempt < settings.HTTP_RETRIES:
+                    delay = backoff_delay(attempt)
+                if delay is None or breaker.is_open():
+                    raise
+                reason = str(err)
+            else:
+                ratelimit.update(response)
+                status = response.status_code
+                if status >= 500:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                # A 429 was refused before the provider acted on it
+                retryable = status in RETRY_STATUSES and (idempotent or status == 429)
+                delay = None
+                if retryable and attempt < settings.HTTP_RETRIES:
+                    delay = backoff_delay(attempt, response)
+                if delay is None or breaker.is_open():
+                    return response
+                reason = f"status {status}"
+
+            logger.warning(
+                "Retrying %s %s in %.1fs after %s", method.upper(), url, delay, reason
+            )
+            time.sleep(delay)
+            attempt += 1
+
+    def request(self, method, url, **kwargs):
+        """Send a request, returning or raising its failure as configured."""
+        try:
+            return self.send(method, url, **kwargs)
+        except RequestException as err:
+            if self.raise_errors:
+                raise
+            logger.exception(err)
+            return {"data": {"error": str(err)}}
 
     def get(self, url=None):
         """This makes a get requests."""
-        response = {}
         if not url:
             url = self.url
-        try:
-            response = requests.get(url, headers=self.headers, timeout=300)
-        except (RequestException, requests.Timeout) as err:
-            logger.exception(err)
-            response["data"] = {"error": str(err)}
-        finally:
-            return response
+        headers = self.headers
+        key = cached = None
+        if self.conditional:
+            key = self.validator_key(url)
+            cached = cache.get(key)
+            if cached:
+                headers = {**self.headers, **cached["validators"]}
+        response = self.request("get", url, headers=headers)
+        if self.conditional and not isinstance(response, dict):
+            response = self.revalidate(key, response, cached)
+        return response
 
     def post(self, data, json=False, url=None):
         """This handles the post requests."""
-        response = {}
         if not url:
             url = self.url
-        try:
-            if json:
-                response = requests.post(
-                    url, json=data, headers=self.headers, timeout=300
-                )
-            else:
-                response = requests.post(
-                    url, data=data, headers=self.headers, timeout=300
-                )
-        except (RequestException, requests.Timeout) as err:
-            logger.exception(err)
-            response["data"] = {"error": str(err)}
-        finally:
-            return response
+        body = {"json": data} if json else {"data": data}
+        return self.request("post", url, headers=self.headers, **body)
 
     def put(self, data, json=False, url=None):
         """This handles the put requests."""
-        response = {}
         if not url:
             url = self.url
-        try:
-            if json:
-                response = requests.put(
-                    url, json=data, headers=self.headers, timeout=300
-                )
-            else:
-                response = requests.put(
-                    url, data=data, headers=self.headers, timeout=300
-                )
-        except (RequestException, requests.Timeout) as err:
-            logger.exception(err)
-            response["data"] = {"error": str(err)}
-        finally:
-            return response
+        body = {"json": data} if json else {"data": data}
+        return self.request("put", url, headers=self.headers, **body)